@@ -2,16 +2,33 @@
 """
 This is an API for selected Data Workspaces management functions.
 """
-from typing import Optional, NamedTuple, List, Iterable, cast, Tuple
+import datetime
+from itertools import islice
+from typing import (
+    Optional,
+    NamedTuple,
+    List,
+    Dict,
+    Iterable,
+    Iterator,
+    Callable,
+    Union,
+    cast,
+    Tuple,
+)
 
 from dataworkspaces import __version__
 from dataworkspaces.workspace import (
     find_and_load_workspace,
     LocalStateResourceMixin,
     SnapshotWorkspaceMixin,
+    SnapshotMetadata,
+    MetricValue,
     JSONDict,
+    FileDiff,
 )
 from dataworkspaces.commands.snapshot import snapshot_command
+from dataworkspaces.commands.diff import file_diff_for_resource
 from dataworkspaces.commands.restore import restore_command
 from dataworkspaces.commands.lineage import lineage_graph_command
 from dataworkspaces.commands.report import _get_results
@@ -103,25 +120,135 @@ def get_snapshot_history(
     """
     workspace = find_and_load_workspace(True, verbose, workspace_uri_or_path)
     assert isinstance(workspace, SnapshotWorkspaceMixin)
+    history = islice(
+        workspace.iter_snapshots(
+            reverse=reverse, page_size=max_count if max_count is not None and max_count > 0 else 100
+        ),
+        max_count,
+    )
     if not reverse:
         return [
             SnapshotInfo(
                 snapshot_idx + 1, md.hashval, md.tags, md.timestamp, md.message, md.metrics
             )
-            for (snapshot_idx, md) in enumerate(
-                workspace.list_snapshots(reverse=False, max_count=max_count)
-            )
+            for (snapshot_idx, md) in enumerate(history)
         ]
     else:
-        last_snapshot_no = workspace.get_next_snapshot_number() - 1
+        last_snapshot_no = workspace.count_snapshots()
         return [
             SnapshotInfo(
                 last_snapshot_no - i, md.hashval, md.tags, md.timestamp, md.message, md.metrics
             )
-            for (i, md) in enumerate(workspace.list_snapshots(reverse=True, max_count=max_count))
+            for (i, md) in enumerate(history)
         ]
 
 
+def _timestamp_str(t: Union[str, datetime.datetime, None]) -> Optional[str]:
+    return t.isoformat() if isinstance(t, datetime.datetime) else t
+
+
+def iter_snapshot_history(
+    workspace_uri_or_path: Optional[str] = None,
+    reverse: bool = True,
+    page_size: int = 100,
+    start_time: Union[str, datetime.datetime, None] = None,
+    end_time: Union[str, datetime.datetime, None] = None,
+    tag: Optional[str] = None,
+    hostname: Optional[str] = None,
+    metric_filter: Optional[Callable[[JSONDict], bool]] = None,
+    verbose: bool = False,
+) -> Iterator[SnapshotMetadata]:
+    """Iterate through the history of snapshots, starting with the most recent
+    (unless :reverse: is False). Snapshots are read lazily, :page_size: at a time,
+    so that looking at the last few snapshots is fast even when there are many.
+    The following filters may be specified:
+
+    * ``start_time`` and ``end_time`` - only return snapshots taken at or after
+      start_time and before end_time (datetimes or ISO format strings).
+    * ``tag`` - only return the snapshot with this tag.
+    * ``hostname`` - only return snapshots taken on this host.
+    * ``metric_filter`` - only return snapshots with metrics for which this
+      function returns True (e.g. ``lambda m: m.get('accuracy', 0) > 0.9``).
+
+    Unlike :func:`~get_snapshot_history`, this returns the snapshots'
+    :class:`~dataworkspaces.workspace.SnapshotMetadata`, which includes the
+    hostname and the number of the snapshot on that host.
+    """
+    workspace = find_and_load_workspace(True, verbose, workspace_uri_or_path)
+    assert isinstance(workspace, SnapshotWorkspaceMixin)
+    return workspace.iter_snapshots(
+        reverse=reverse,
+        page_size=page_size,
+        start_time=_timestamp_str(start_time),
+        end_time=_timestamp_str(end_time),
+        tag=tag,
+        hostname=hostname,
+        metric_filter=metric_filter,
+    )
+
+
+def query_metrics(
+    metric: str,
+    top_k: Optional[int] = None,
+    where: Iterable[Tuple[str, str, float]] = (),
+    maximize: bool = True,
+    workspace_uri_or_path: Optional[str] = None,
+    verbose: bool = False,
+) -> List[MetricValue]:
+    """Return the values of a metric across the snapshots of the workspace, best
+    first (largest first, unless :maximize: is False). If :top_k: is specified,
+    only that many values are returned. Only top-level metrics with numeric values
+    can be queried.
+
+    :where: is a list of conditions on the snapshot's other metrics, each a triple
+    of metric name, comparison operator (one of ``<``, ``<=``, ``>``, ``>=``, ``=``,
+    ``!=``), and value. For example, the five snapshots with the highest accuracy,
+    among those with a loss below 0.5, are returned by::
+
+        query_metrics('accuracy', top_k=5, where=[('loss', '<', 0.5)])
+
+    Each result is a :class:`~dataworkspaces.workspace.MetricValue`, with the
+    hash, timestamp, and tags of the snapshot, and the value of the metric.
+    """
+    workspace = find_and_load_workspace(True, verbose, workspace_uri_or_path)
+    assert isinstance(workspace, SnapshotWorkspaceMixin)
+    return workspace.query_metrics(metric, top_k=top_k, where=where, maximize=maximize)
+
+
+def get_metric_values(
+    workspace_uri_or_path: Optional[str] = None,
+    metrics: Optional[List[str]] = None,
+    snapshot_hashes: Optional[List[str]] = None,
+    verbose: bool = False,
+) -> Dict[str, Dict[str, float]]:
+    """Return the values of the numeric metrics (or just those listed in :metrics:)
+    across the snapshots of the workspace (or just those listed in :snapshot_hashes:),
+    as a map from metric name to a map from snapshot hash to value. Snapshots without
+    a metric are omitted from its map.
+    """
+    workspace = find_and_load_workspace(True, verbose, workspace_uri_or_path)
+    assert isinstance(workspace, SnapshotWorkspaceMixin)
+    if metrics is None:
+        metrics = workspace.list_metrics()
+    return {metric: workspace.get_metric_values(metric, snapshot_hashes) for metric in metrics}
+
+
+def get_file_diff(
+    resource_name: str,
+    snapshot_or_tag1: str,
+    snapshot_or_tag2: str,
+    workspace_uri_or_path: Optional[str] = None,
+    verbose: bool = False,
+) -> FileDiff:
+    """Return the files that were added, removed, and modified in the specified
+    resource between the two snapshots, as a :class:`~dataworkspaces.workspace.FileDiff`
+    named tuple. The resource must support file-level differences (e.g. local files).
+    This only uses the data saved with the snapshots, not the current contents of the resource.
+    """
+    workspace = find_and_load_workspace(True, verbose, workspace_uri_or_path)
+    return file_diff_for_resource(workspace, resource_name, snapshot_or_tag1, snapshot_or_tag2)
+
+
 def restore(
     tag_or_hash: str,
     workspace_uri_or_path: Optional[str] = None,
@@ -7,6 +7,7 @@ from os.path import (
     exists,
     join,
     isdir,
+    isfile,
     basename,
     isabs,
     abspath,
@@ -17,10 +18,9 @@ from os.path import (
 )
 import shutil
 import json
-import re
 import uuid
 from urllib.parse import ParseResult, urlparse
-from typing import Any, Iterable, Optional, List, Dict, Tuple, cast
+from typing import Any, Callable, Iterable, Iterator, Optional, List, Dict, Tuple, cast
 
 assert Dict  # make pyflakes happy
 
@@ -29,7 +29,7 @@ import click
 import dataworkspaces.workspace as ws
 from dataworkspaces.workspace import JSONDict, SnapshotMetadata
 from dataworkspaces.errors import ConfigurationError, InternalError
-from dataworkspaces.utils.subprocess_utils import call_subprocess
+from dataworkspaces.utils.subprocess_utils import call_subprocess, call_subprocess_for_rc
 from dataworkspaces.utils.git_utils import (
     commit_changes_in_repo,
     git_init,
@@ -37,10 +37,13 @@ from dataworkspaces.utils.git_utils import (
     is_git_dirty,
     is_pull_needed_from_remote,
     GIT_EXE_PATH,
+    get_git_repo_lock,
     set_remote_origin,
     verify_git_config_initialized,
     git_remove_file,
+    git_remove_many,
     git_remove_subtree,
+    git_remove_subtrees,
     ensure_entry_in_gitignore,
     echo_git_status_for_user,
 )
@@ -65,6 +68,16 @@ from dataworkspaces.utils.param_utils import (
     get_scratch_directory,
     SCRATCH_DIRECTORY,
     LOCAL_SCRATCH_DIRECTORY,
+    SNAPSHOT_METADATA_LAYOUT,
+    FLAT_LAYOUT,
+    SHARDED_LAYOUT,
+)
+from dataworkspaces.utils.snapshot_index import SnapshotIndex
+from dataworkspaces.utils.metrics_utils import Condition, check_conditions
+from dataworkspaces.utils.lock_utils import (
+    file_lock,
+    atomic_write,
+    write_json_atomically,
 )
 from dataworkspaces.utils.lineage_utils import (
     FileLineageStore,
@@ -84,6 +97,132 @@ SNAPSHOT_DIR_PATH = ".dataworkspace/snapshots"
 SNAPSHOT_METADATA_DIR_PATH = ".dataworkspace/snapshot_metadata"
 CURRENT_LINEAGE_DIR_PATH = ".dataworkspace/current_lineage"
 SNAPSHOT_LINEAGE_DIR_PATH = ".dataworkspace/snapshot_lineage"
+# The index of the snapshot metadata is local state, kept in the scratch directory
+SNAPSHOT_INDEX_FILENAME = "snapshot_index.sqlite"
+
+# The last snapshot number allocated for each hostname, also kept in the scratch
+# directory, along with the lock file that protects it
+SNAPSHOT_NUMBERS_FILENAME = "snapshot_numbers.json"
+SNAPSHOT_NUMBERS_LOCK_FILENAME = "snapshot_numbers.lock"
+
+# Lock files for groups of workspace files, kept in the git directory, as it is
+# local to each copy of the workspace and never committed
+LOCK_DIR_NAME = "dws_locks"
+WORKSPACE_LOCK_FILENAME = "workspace.lock"  # config, params and resources files
+SNAPSHOT_METADATA_LOCK_FILENAME = "snapshot_metadata.lock"
+LINEAGE_LOCK_FILENAME = "lineage.lock"
+SNAPSHOT_LOCK_FILENAME = "snapshot.lock"  # shared by snapshots, exclusive for gc
+
+
+def _get_snapshot_file_relpaths(hash_val: str, layout: str) -> Tuple[str, str]:
+    """Return the paths, relative to the workspace, of the manifest and metadata
+    files of a snapshot in the specified layout. In the sharded layout, the files
+    are in subdirectories named by the first two characters of the hash, as with
+    git's objects.
+    """
+    manifest_filename = "snapshot-%s.json" % hash_val
+    md_filename = "%s_md.json" % hash_val
+    if layout == SHARDED_LAYOUT:
+        return (
+            join(SNAPSHOT_DIR_PATH, hash_val[0:2], manifest_filename),
+            join(SNAPSHOT_METADATA_DIR_PATH, hash_val[0:2], md_filename),
+        )
+    else:
+        return (
+            join(SNAPSHOT_DIR_PATH, manifest_filename),
+            join(SNAPSHOT_METADATA_DIR_PATH, md_filename),
+        )
+
+
+def _get_lock_dir(workspace_dir: str) -> str:
+    """Return the directory for lock files, creating it if needed"""
+    git_dir = join(workspace_dir, ".git")
+    if isfile(git_dir):
+        # a worktree or submodule, where .git is a file pointing to the git directory
+        with open(git_dir, "r") as f:
+            data = f.read().strip()
+        if data.startswith("gitdir:"):
+            git_dir = join(workspace_dir, data[len("gitdir:") :].strip())
+    lock_dir = join(git_dir, LOCK_DIR_NAME)
+    os.makedirs(lock_dir, exist_ok=True)
+    return lock_dir
+
+
+class SnapshotTransaction:
+    """The changes made to the workspace's repo while a snapshot is taken. Rather
+    than committing their changes, resources stage them here, and the snapshot
+    command's final call to Workspace.save() commits everything, including the
+    snapshot metadata, with a single index update and a single commit.
+    """
+
+    def __init__(self, workspace_dir: str, verbose: bool):
+        self.workspace_dir = workspace_dir
+        self.verbose = verbose
+        self.staged_subdirs = []  # type: List[str]
+        self.staged_paths = []  # type: List[str]
+
+    def stage_subdir(self, relpath: str) -> str:
+        """Stage all the changes to the subdirectory :relpath: of the repo and return
+        the hash of its tree. The subdirectory is not restaged by commit(), so that the
+        commit contains exactly this tree."""
+        with get_git_repo_lock(self.workspace_dir):
+            call_subprocess(
+                [GIT_EXE_PATH, "add", "-A", "--", relpath],
+                cwd=self.workspace_dir,
+                verbose=self.verbose,
+            )
+            treehash = call_subprocess(
+                [GIT_EXE_PATH, "write-tree", "--prefix=%s/" % relpath],
+                cwd=self.workspace_dir,
+                verbose=self.verbose,
+            ).strip()
+            self.staged_subdirs.append(relpath)
+        return treehash
+
+    def record_staged(self, relpath: str) -> None:
+        """Record that changes to :relpath: (a file or directory of the repo) were
+        staged directly, e.g. by git_add_many(), so that abort() unstages them.
+        Unlike the subdirectories of stage_subdir(), they are restaged by commit()."""
+        self.staged_paths.append(relpath)
+
+    def commit(self, message: str) -> None:
+        """Stage the remaining changes in the repo and commit, if there is anything
+        to commit"""
+        with get_git_repo_lock(self.workspace_dir):
+            call_subprocess(
+                [GIT_EXE_PATH, "add", "-A", "--", "."]
+                + [":(exclude)%s" % relpath for relpath in self.staged_subdirs],
+                cwd=self.workspace_dir,
+                verbose=self.verbose,
+            )
+            if (
+                call_subprocess_for_rc(
+                    [GIT_EXE_PATH, "diff", "--cached", "--quiet"],
+                    cwd=self.workspace_dir,
+                    verbose=self.verbose,
+                )
+                != 0
+            ):
+                call_subprocess(
+                    [GIT_EXE_PATH, "commit", "-m", message],
+                    cwd=self.workspace_dir,
+                    verbose=self.verbose,
+                )
+
+    def abort(self) -> None:
+        """Unstage the changes staged by stage_subdir() or recorded by record_staged().
+        The working tree is left as is, so that no data (e.g. results moved to the
+        snapshot's subdirectory) is lost. The changes are picked up again by the next
+        snapshot."""
+        paths = self.staged_subdirs + self.staged_paths
+        if len(paths) == 0:
+            return
+        with get_git_repo_lock(self.workspace_dir):
+            call_subprocess(
+                [GIT_EXE_PATH, "reset", "-q", "--"] + paths,
+                cwd=self.workspace_dir,
+                verbose=self.verbose,
+            )
 
 
 class GitFileLineageStore(FileLineageStore):
@@ -96,10 +235,13 @@ class GitFileLineageStore(FileLineageStore):
             cast(Workspace, workspace).get_instance(),
             join(workspace.workspace_dir, CURRENT_LINEAGE_DIR_PATH),
             join(workspace.workspace_dir, SNAPSHOT_LINEAGE_DIR_PATH),
+            lock_path=join(workspace.lock_dir, LINEAGE_LOCK_FILENAME),
         )
         self.workspace = workspace
 
     def _add_to_git(self, path: str):
+        if self.workspace.snapshot_transaction is not None:
+            return  # added when the transaction is committed
         ws_dir = cast(str, self.workspace.workspace_dir)
         git_add(
             ws_dir,
@@ -133,14 +275,27 @@ class GitFileLineageStore(FileLineageStore):
         """Delete any lineage data associated with the specified snapshot.
         """
         lineage_relative_path = join(SNAPSHOT_LINEAGE_DIR_PATH, snapshot_hash)
-        git_remove_subtree(
-            self.workspace.workspace_dir, lineage_relative_path, verbose=self.workspace.verbose
-        )
+        with self._lock():
+            git_remove_subtree(
+                self.workspace.workspace_dir, lineage_relative_path, verbose=self.workspace.verbose
+            )
+
+    def delete_snapshots_lineage(self, instance: str, snapshot_hashes: List[str]) -> None:
+        with self._lock(), get_git_repo_lock(self.workspace.workspace_dir):
+            git_remove_subtrees(
+                self.workspace.workspace_dir,
+                [
+                    join(SNAPSHOT_LINEAGE_DIR_PATH, snapshot_hash)
+                    for snapshot_hash in snapshot_hashes
+                ],
+                verbose=self.workspace.verbose,
+            )
 
 
 class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin):
     def __init__(self, workspace_dir: str, batch: bool = False, verbose: bool = False):
         self.workspace_dir = workspace_dir  # type: str
+        self.lock_dir = _get_lock_dir(workspace_dir)
         cf_data = self._load_json_file(CONFIG_FILE_PATH)
         super().__init__(cf_data["name"], cf_data["dws-version"], batch, verbose)
         self.global_params = cf_data["global_params"]
@@ -161,6 +316,9 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
         self.scratch_dir = get_scratch_directory(
             self.workspace_dir, self.global_params, self.local_params
         )
+        # set while a snapshot is being taken, see snapshot() and save()
+        self.snapshot_transaction = None  # type: Optional[SnapshotTransaction]
+        self.snapshot_index = None  # type: Optional[SnapshotIndex]
 
     def get_instance(self) -> str:
         return self.instance
@@ -180,17 +338,22 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
                 % (SCRATCH_DIRECTORY, LOCAL_SCRATCH_DIRECTORY)
             )
 
+    def _lock(self, lock_filename: str, shared: bool = False):
+        """Return a context manager that holds the specified lock"""
+        return file_lock(join(self.lock_dir, lock_filename), shared=shared)
+
     def _load_json_file(self, relative_path):
         f_path = join(self.workspace_dir, relative_path)
         if not exists(f_path):
             raise ConfigurationError("Did not find workspace metadata file %s" % f_path)
-        with open(f_path, "r") as f:
-            return json.load(f)
+        with self._lock(WORKSPACE_LOCK_FILENAME, shared=True):
+            with open(f_path, "r") as f:
+                return json.load(f)
 
     def _save_json_to_file(self, obj, relative_path):
         f_path = join(self.workspace_dir, relative_path)
-        with open(f_path, "w") as f:
-            json.dump(obj, f, indent=2)
+        with self._lock(WORKSPACE_LOCK_FILENAME):
+            write_json_atomically(f_path, obj)
 
     def _get_global_params(self) -> JSONDict:
         """Get a dict of configuration parameters for this workspace,
@@ -336,18 +499,26 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
                 raise InternalError(
                     "Scratch path '%s' for resource %s is missing" % (scratch_path, resource_name)
                 )
-            os.makedirs(scratch_path)
-            ensure_entry_in_gitignore(
-                self.workspace_dir,
-                ".dataworkspace/.gitignore",
-                "/scratch/%s/" % resource_name,
-                commit=True,
-            )
+            # resources may be snapshotted concurrently
+            with get_git_repo_lock(self.workspace_dir):
+                os.makedirs(scratch_path, exist_ok=True)
+                ensure_entry_in_gitignore(
+                    self.workspace_dir,
+                    ".dataworkspace/.gitignore",
+                    "/scratch/%s/" % resource_name,
+                    commit=True,
+                )
         return scratch_path
 
     def save(self, message: str) -> None:
-        """Save the current state of the workspace"""
-        commit_changes_in_repo(self.workspace_dir, message, verbose=self.verbose)
+        """Save the current state of the workspace. If a snapshot is being taken,
+        this commits its transaction."""
+        if self.snapshot_transaction is not None:
+            transaction = self.snapshot_transaction
+            self.snapshot_transaction = None
+            transaction.commit(message)
+        else:
+            commit_changes_in_repo(self.workspace_dir, message, verbose=self.verbose)
 
     def pull_workspace(self) -> ws.SyncedWorkspaceMixin:
         # first, check for problems
@@ -400,35 +571,76 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
             raise InternalError("publish takes one argument: remote_repository, got %s" % args)
         set_remote_origin(self.workspace_dir, args[0], verbose=self.verbose)
 
+    def _get_snapshot_index(self) -> SnapshotIndex:
+        """Return the index of the snapshot metadata files, synchronized with any
+        changes to them (e.g. from a pull). If there is no scratch directory, the
+        index is built in memory.
+        """
+        if self.snapshot_index is None:
+            if self.scratch_dir is not None:
+                os.makedirs(self.scratch_dir, exist_ok=True)
+                db_path = join(self.scratch_dir, SNAPSHOT_INDEX_FILENAME)  # type: Optional[str]
+            else:
+                db_path = None
+            self.snapshot_index = SnapshotIndex(
+                db_path, join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH)
+            )
+        self.snapshot_index.sync()
+        return self.snapshot_index
+
     def get_next_snapshot_number(self) -> int:
-        """Snapshot numbers are assigned based on how many snapshots have
-        already been taken. Counting starts at 1. Note that snaphsot
-        numbers are not necessarily unique, as people could simultaneously
-        take snapshots in different copies of the workspace. Thus, we
-        usually combine the snapshot with the hostname.
+        """Snapshot numbers are allocated from a counter for the current hostname,
+        kept in the scratch directory. The counter is read and incremented while
+        holding a lock, so that concurrent snapshots (e.g. from several jobs sharing
+        the workspace) get different numbers. The number is also always greater than
+        the number of snapshots and than any number recorded for this hostname in
+        the snapshot metadata, so the counter catches up with snapshots from other
+        copies of the workspace after a pull. Counting starts at 1. Note that snaphsot
+        numbers are not unique across hosts. Thus, we usually combine the snapshot
+        number with the hostname.
         """
-        md_dirpath = join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH)
-        if not isdir(md_dirpath):
-            return 1  # first snapshot
-        # we recursively walk the tree to be future-proof in case we
-        # find that we need to start putting metadata into subdirectories.
-        def process_dir(dirpath):
-            cnt = 0
-            for f in os.listdir(dirpath):
-                p = join(dirpath, f)
-                if isdir(p):
-                    cnt += process_dir(p)
-                elif f.endswith("_md.json"):
-                    cnt += 1
-            return cnt
-
-        return 1 + process_dir(md_dirpath)
+        hostname = self.get_local_param(HOSTNAME)
+        if self.scratch_dir is None:
+            index = self._get_snapshot_index()
+            return 1 + max(index.count(), index.max_snapshot_number(hostname))
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        numbers_path = join(self.scratch_dir, SNAPSHOT_NUMBERS_FILENAME)
+        with file_lock(join(self.scratch_dir, SNAPSHOT_NUMBERS_LOCK_FILENAME)):
+            if exists(numbers_path):
+                with open(numbers_path, "r") as f:
+                    numbers = json.load(f)
+            else:
+                numbers = {}
+            index = self._get_snapshot_index()
+            number = 1 + max(
+                numbers.get(hostname, 0), index.count(), index.max_snapshot_number(hostname)
+            )
+            numbers[hostname] = number
+            write_json_atomically(numbers_path, numbers)
+        return number
+
+    def _find_snapshot_files(self, hash_val: str) -> Tuple[str, str]:
+        """Return the paths, relative to the workspace, of the manifest and metadata
+        files of a snapshot. Files are looked for in both layouts, so that snapshots
+        saved before a workspace was migrated to the sharded layout can still be read.
+        If a file does not exist in either layout, its path in the workspace's
+        layout is returned.
+        """
+        hash_val = hash_val.lower()
+        layout = self.get_global_param(SNAPSHOT_METADATA_LAYOUT)
+        other_layout = FLAT_LAYOUT if layout == SHARDED_LAYOUT else SHARDED_LAYOUT
+        paths = list(_get_snapshot_file_relpaths(hash_val, layout))
+        other_paths = _get_snapshot_file_relpaths(hash_val, other_layout)
+        for i in range(len(paths)):
+            if not exists(join(self.workspace_dir, paths[i])) and exists(
+                join(self.workspace_dir, other_paths[i])
+            ):
+                paths[i] = other_paths[i]
+        return (paths[0], paths[1])
 
     def get_snapshot_metadata(self, hash_val: str) -> SnapshotMetadata:
         hash_val = hash_val.lower()
-        md_filename = join(
-            join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH), "%s_md.json" % hash_val
-        )
+        md_filename = join(self.workspace_dir, self._find_snapshot_files(hash_val)[1])
         if not exists(md_filename):
             raise ConfigurationError("No metadata entry for snapshot %s" % hash_val)
         with open(md_filename, "r") as f:
@@ -439,20 +651,11 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
 
     def get_snapshot_by_tag(self, tag: str) -> SnapshotMetadata:
         """Given a tag, return the asssociated snapshot metadata.
-        This lookup could be slower ,if a reverse index is not kept."""
-        md_dir = join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH)
-        regexp = re.compile(re.escape(tag))
-        for fname in os.listdir(md_dir):
-            if not fname.endswith("_md.json"):
-                continue
-            fpath = join(md_dir, fname)
-            with open(fpath, "r") as f:
-                raw_data = f.read()
-            if regexp.search(raw_data) is not None:
-                md = SnapshotMetadata.from_json(json.loads(raw_data))
-                if md.has_tag(tag):
-                    return md
-        raise ConfigurationError("Snapshot for tag %s not found" % tag)
+        The lookup uses the snapshot index."""
+        data = self._get_snapshot_index().get_by_tag(tag)
+        if data is None:
+            raise ConfigurationError("Snapshot for tag %s not found" % tag)
+        return SnapshotMetadata.from_json(data)
 
     def get_snapshot_by_partial_hash(self, partial_hash: str) -> SnapshotMetadata:
         """Given a partial hash for the snapshot, find the snapshot whose hash
@@ -460,19 +663,13 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
         asssociated with the snapshot.
         """
         partial_hash = partial_hash.lower()
-        md_dir = join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH)
-        for fname in os.listdir(md_dir):
-            if not fname.endswith("_md.json"):
-                continue
-            hashval = fname[0:-8].lower()
-            if not hashval.startswith(partial_hash):
-                continue
-            return self.get_snapshot_metadata(hashval)
-        raise ConfigurationError("Snapshot match for partial hash %s not found" % partial_hash)
+        data = self._get_snapshot_index().get_by_partial_hash(partial_hash)
+        if data is None:
+            raise ConfigurationError("Snapshot match for partial hash %s not found" % partial_hash)
+        return SnapshotMetadata.from_json(data)
 
     def _get_snapshot_manifest_as_bytes(self, hash_val: str) -> bytes:
-        snapshot_dir = join(self.workspace_dir, SNAPSHOT_DIR_PATH)
-        snapshot_file = join(snapshot_dir, "snapshot-%s.json" % hash_val.lower())
+        snapshot_file = join(self.workspace_dir, self._find_snapshot_files(hash_val)[0])
         if not exists(snapshot_file):
             raise ConfigurationError("No snapshot found for hash value %s" % hash_val)
         with open(snapshot_file, "rb") as f:
@@ -485,23 +682,105 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
         (or descending if reverse is True). If max_count is specified, return at
         most that many snaphsots.
         """
-        md_dir = join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH)
-        snapshots = []
-        for fname in os.listdir(md_dir):
-            if not fname.endswith("_md.json"):
-                continue
-            with open(join(md_dir, fname), "r") as f:
-                snapshots.append(SnapshotMetadata.from_json(json.load(f)))
-        snapshots.sort(key=lambda md: md.timestamp, reverse=reverse)
-        return snapshots if max_count is None else snapshots[0:max_count]
+        return [
+            SnapshotMetadata.from_json(data)
+            for data in self._get_snapshot_index().list(reverse=reverse, max_count=max_count)
+        ]
+
+    def iter_snapshots(
+        self,
+        reverse: bool = True,
+        page_size: int = 100,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+        tag: Optional[str] = None,
+        hostname: Optional[str] = None,
+        metric_filter: Optional[Callable[[JSONDict], bool]] = None,
+    ) -> Iterator[SnapshotMetadata]:
+        """Reads the snapshots lazily from the snapshot index. All filters except
+        the metric filter are applied by the index query.
+        """
+        for data in self._get_snapshot_index().iter(
+            reverse=reverse,
+            page_size=page_size,
+            start_time=start_time,
+            end_time=end_time,
+            tag=tag,
+            hostname=hostname,
+        ):
+            md = SnapshotMetadata.from_json(data)
+            if ws.metrics_match(md, metric_filter):
+                yield md
+
+    def count_snapshots(self) -> int:
+        return self._get_snapshot_index().count()
+
+    def list_metrics(self) -> List[str]:
+        return self._get_snapshot_index().list_metrics()
+
+    def get_metric_values(
+        self, metric: str, hashvals: Optional[Iterable[str]] = None
+    ) -> Dict[str, float]:
+        return self._get_snapshot_index().get_metric_values(metric, hashvals)
+
+    def query_metrics(
+        self,
+        metric: str,
+        top_k: Optional[int] = None,
+        where: Iterable[Condition] = (),
+        maximize: bool = True,
+    ) -> List[ws.MetricValue]:
+        """Reads the metric values from the snapshot index's table of metrics."""
+        where = list(where)
+        check_conditions(where)
+        return [
+            ws.MetricValue(*row)
+            for row in self._get_snapshot_index().query_metrics(
+                metric, top_k=top_k, where=where, maximize=maximize
+            )
+        ]
 
     def _delete_snapshot_metadata_and_manifest(self, hash_val: str) -> None:
         """Given a snapshot hash, delete the associated metadata.
         """
-        rel_snapshot_file = join(SNAPSHOT_DIR_PATH, "snapshot-%s.json" % hash_val.lower())
-        git_remove_file(self.workspace_dir, rel_snapshot_file, verbose=self.verbose)
-        rel_metadata_file = join(SNAPSHOT_METADATA_DIR_PATH, "%s_md.json" % hash_val.lower())
-        git_remove_file(self.workspace_dir, rel_metadata_file, verbose=self.verbose)
+        with self._lock(SNAPSHOT_METADATA_LOCK_FILENAME):
+            rel_snapshot_file, rel_metadata_file = self._find_snapshot_files(hash_val)
+            git_remove_file(self.workspace_dir, rel_snapshot_file, verbose=self.verbose)
+            git_remove_file(self.workspace_dir, rel_metadata_file, verbose=self.verbose)
+            self._get_snapshot_index().remove(hash_val.lower())
+
+    def _delete_snapshots_metadata_and_manifests(self, hash_vals: List[str]) -> None:
+        """Removes the files of all the snapshots from the index with one git call."""
+        with self._lock(SNAPSHOT_METADATA_LOCK_FILENAME):
+            relpaths = []  # type: List[str]
+            for hash_val in hash_vals:
+                relpaths.extend(self._find_snapshot_files(hash_val))
+            with get_git_repo_lock(self.workspace_dir):
+                git_remove_many(self.workspace_dir, relpaths, verbose=self.verbose)
+            for relpath in relpaths:
+                path = join(self.workspace_dir, relpath)
+                if exists(path):
+                    os.remove(path)
+            self._get_snapshot_index().remove_many([hash_val.lower() for hash_val in hash_vals])
+
+    def snapshot(
+        self, tag: Optional[str] = None, message: str = "", rehash: bool = False
+    ) -> Tuple[SnapshotMetadata, bytes]:
+        """The resources in the workspace's repo stage their changes into a
+        SnapshotTransaction, which is committed when the snapshot command saves
+        the workspace.
+        """
+        self.snapshot_transaction = SnapshotTransaction(self.workspace_dir, self.verbose)
+        return super().snapshot(tag, message, rehash)
+
+    def abort_snapshot(self) -> None:
+        if self.snapshot_transaction is not None:
+            transaction = self.snapshot_transaction
+            self.snapshot_transaction = None
+            transaction.abort()
+
+    def snapshot_lock(self, shared: bool = False):
+        return self._lock(SNAPSHOT_LOCK_FILENAME, shared=shared)
 
     def _snapshot_precheck(self, current_resources: Iterable[ws.Resource]) -> None:
         """Run any prechecks before taking a snapshot. This should throw
@@ -539,36 +818,82 @@ class Workspace(ws.Workspace, ws.SyncedWorkspaceMixin, ws.SnapshotWorkspaceMixin
         """Remove the specified tag from the specified snapshot. Throw an
         InternalError if either the snapshot or the tag do not exist.
         """
-        md_filename = join(
-            join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH), "%s_md.json" % hash_val.lower()
-        )
-        if not exists(md_filename):
-            raise InternalError("No metadata entry for snapshot %s" % hash_val)
-        with open(md_filename, "r") as f:
-            data = json.load(f)
-        md = ws.SnapshotMetadata.from_json(data)
-        assert md.hashval == hash_val
-        if tag not in md.tags:
-            raise InternalError("Tag %s not found in snapshot %s" % (tag, hash_val))
-        md.tags = [tag for tag in md.tags if tag != tag]
-        with open(md_filename, "w") as f:
-            json.dump(md.to_json(), f, indent=2)
+        with self._lock(SNAPSHOT_METADATA_LOCK_FILENAME):
+            md_relpath = self._find_snapshot_files(hash_val)[1]
+            md_filename = join(self.workspace_dir, md_relpath)
+            if not exists(md_filename):
+                raise InternalError("No metadata entry for snapshot %s" % hash_val)
+            with open(md_filename, "r") as f:
+                data = json.load(f)
+            md = ws.SnapshotMetadata.from_json(data)
+            assert md.hashval == hash_val
+            if tag not in md.tags:
+                raise InternalError("Tag %s not found in snapshot %s" % (tag, hash_val))
+            md.tags = [t for t in md.tags if t != tag]
+            write_json_atomically(md_filename, md.to_json())
+            self._get_snapshot_index().update(
+                os.path.relpath(md_relpath, SNAPSHOT_METADATA_DIR_PATH)
+            )
 
     def save_snapshot_metadata_and_manifest(
         self, metadata: SnapshotMetadata, manifest: bytes
     ) -> None:
-        snapshot_dir_path = join(self.workspace_dir, SNAPSHOT_DIR_PATH)
-        if not exists(snapshot_dir_path):
-            os.makedirs(snapshot_dir_path)
-        snapshot_manifest_path = join(snapshot_dir_path, "snapshot-%s.json" % metadata.hashval)
-        with open(snapshot_manifest_path, "wb") as f:
-            f.write(manifest)
-        snapshot_md_dir = join(self.workspace_dir, SNAPSHOT_METADATA_DIR_PATH)
-        if not exists(snapshot_md_dir):
-            os.makedirs(snapshot_md_dir)
-        snapshot_metadata_path = join(snapshot_md_dir, "%s_md.json" % metadata.hashval)
-        with open(snapshot_metadata_path, "w") as mdf:
-            json.dump(metadata.to_json(), mdf, indent=2)
+        with self._lock(SNAPSHOT_METADATA_LOCK_FILENAME):
+            # an existing snapshot's files are rewritten in place, whatever their layout
+            manifest_relpath, md_relpath = self._find_snapshot_files(metadata.hashval)
+            snapshot_manifest_path = join(self.workspace_dir, manifest_relpath)
+            snapshot_metadata_path = join(self.workspace_dir, md_relpath)
+            for path in (snapshot_manifest_path, snapshot_metadata_path):
+                os.makedirs(dirname(path), exist_ok=True)
+            with atomic_write(snapshot_manifest_path, "wb") as f:
+                f.write(manifest)
+            write_json_atomically(snapshot_metadata_path, metadata.to_json())
+            self._get_snapshot_index().update(
+                os.path.relpath(md_relpath, SNAPSHOT_METADATA_DIR_PATH)
+            )
+
+    def migrate_snapshot_layout(self) -> int:
+        """Move the snapshot manifest and metadata files stored in the flat layout to
+        the sharded layout. The moves are staged, but not committed. The layout parameter
+        of the workspace is not changed here, that is up to the caller.
+        Returns the number of files moved.
+        """
+        moved = []  # type: List[str]
+        with self._lock(SNAPSHOT_METADATA_LOCK_FILENAME):
+            for dir_relpath, prefix, suffix in [
+                (SNAPSHOT_DIR_PATH, "snapshot-", ".json"),
+                (SNAPSHOT_METADATA_DIR_PATH, "", "_md.json"),
+            ]:
+                dir_path = join(self.workspace_dir, dir_relpath)
+                if not isdir(dir_path):
+                    continue
+                for fname in sorted(os.listdir(dir_path)):
+                    if not (
+                        fname.startswith(prefix)
+                        and fname.endswith(suffix)
+                        and isfile(join(dir_path, fname))
+                    ):
+                        continue
+                    shard = fname[len(prefix) : len(prefix) + 2]
+                    os.makedirs(join(dir_path, shard), exist_ok=True)
+                    os.rename(join(dir_path, fname), join(dir_path, shard, fname))
+                    moved.append(join(dir_relpath, fname))
+            if len(moved) > 0:
+                # stage all the moves with a single git call
+                with get_git_repo_lock(self.workspace_dir):
+                    call_subprocess(
+                        [
+                            GIT_EXE_PATH,
+                            "add",
+                            "-A",
+                            "--",
+                            SNAPSHOT_DIR_PATH,
+                            SNAPSHOT_METADATA_DIR_PATH,
+                        ],
+                        cwd=self.workspace_dir,
+                        verbose=self.verbose,
+                    )
+        return len(moved)
 
     def as_snapshot_ws(self) -> ws.SnapshotWorkspaceMixin:
         """If this workspace supports snapshots, cast
@@ -616,6 +941,7 @@ class WorkspaceFactory(ws.WorkspaceFactory):
         git_fat_port: Optional[int] = None,
         git_fat_attributes: Optional[str] = None,
         git_lfs_attributes: Optional[str] = None,
+        snapshot_metadata_layout: str = SHARDED_LAYOUT,
     ) -> ws.Workspace:
         if not exists(workspace_dir):
             raise ConfigurationError(
@@ -637,6 +963,8 @@ class WorkspaceFactory(ws.WorkspaceFactory):
         (abs_scratch_dir, scratch_dir_gitignore) = init_scratch_directory(
             scratch_dir, workspace_dir, global_params, local_params
         )
+        # the flat layout is the param's default only for workspaces created before sharding
+        global_params[SNAPSHOT_METADATA_LAYOUT] = snapshot_metadata_layout
         with open(join(workspace_dir, CONFIG_FILE_PATH), "w") as f:
             json.dump(
                 {
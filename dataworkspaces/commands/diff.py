@@ -2,7 +2,13 @@
 
 import click
 
-from dataworkspaces.workspace import Workspace, SnapshotWorkspaceMixin
+from dataworkspaces.workspace import (
+    Workspace,
+    SnapshotWorkspaceMixin,
+    SnapshotMetadata,
+    FileDiffResourceMixin,
+    FileDiff,
+)
 from dataworkspaces.errors import ConfigurationError
 
 
@@ -39,7 +45,55 @@ from dataworkspaces.errors import ConfigurationError
 #         return '  Step %s has no lineage differences.\n' % data1['step_name']
 
 
-def diff_command(workspace: Workspace, snapshot_or_tag1: str, snapshot_or_tag2: str) -> None:
+def _get_resource_hash(
+    workspace: SnapshotWorkspaceMixin, md: SnapshotMetadata, resource_name: str
+) -> str:
+    for r in workspace.get_snapshot_manifest(md.hashval):
+        if r["name"] == resource_name:
+            if r["hash"] is None:
+                raise ConfigurationError(
+                    "Resource %s has no hash in snapshot %s" % (resource_name, md.hashval)
+                )
+            return r["hash"]
+    raise ConfigurationError("Resource %s is not in snapshot %s" % (resource_name, md.hashval))
+
+
+def file_diff_for_resource(
+    workspace: Workspace, resource_name: str, snapshot_or_tag1: str, snapshot_or_tag2: str
+) -> FileDiff:
+    """Return the files added, removed, and modified in the specified resource between
+    the two snapshots.
+    """
+    if not isinstance(workspace, SnapshotWorkspaceMixin):
+        raise ConfigurationError(
+            "Diff command not supported for workspace %s as backend does not support snapshots"
+            % workspace.name
+        )
+    if resource_name not in workspace.get_resource_names():
+        raise ConfigurationError("No resource in this workspace with name '%s'" % resource_name)
+    resource = workspace.get_resource(resource_name)
+    if not isinstance(resource, FileDiffResourceMixin):
+        raise ConfigurationError(
+            "Resource %s does not support file-level differences" % resource_name
+        )
+    h1 = _get_resource_hash(
+        workspace, workspace.get_snapshot_by_tag_or_hash(snapshot_or_tag1), resource_name
+    )
+    h2 = _get_resource_hash(
+        workspace, workspace.get_snapshot_by_tag_or_hash(snapshot_or_tag2), resource_name
+    )
+    return resource.diff_snapshots(h1, h2)
+
+
+def _print_file_diff(diff: FileDiff) -> None:
+    for status, paths in (("A", diff.added), ("D", diff.removed), ("M", diff.modified)):
+        for path in paths:
+            click.echo("      %s %s" % (status, path))
+
+
+def diff_command(
+    workspace: Workspace, snapshot_or_tag1: str, snapshot_or_tag2: str, show_files: bool = False
+) -> None:
     if not isinstance(workspace, SnapshotWorkspaceMixin):
         raise ConfigurationError(
             "Diff command not supported for workspace %s as backend does not support snapshots"
@@ -75,6 +129,19 @@ def diff_command(workspace: Workspace, snapshot_or_tag1: str, snapshot_or_tag2:
         click.echo("  Resources with different values:")
         for name in different_resources:
             click.echo("    " + name)
+            if show_files and name in workspace.get_resource_names():
+                resource = workspace.get_resource(name)
+                h1 = manifest1[name]["hash"]
+                h2 = manifest2[name]["hash"]
+                if (
+                    isinstance(resource, FileDiffResourceMixin)
+                    and h1 is not None
+                    and h2 is not None
+                ):
+                    try:
+                        _print_file_diff(resource.diff_snapshots(h1, h2))
+                    except ConfigurationError as e:
+                        click.echo("      Unable to compare files: %s" % e, err=True)
     else:
         click.echo("  Resources with different values: None")
     added_resources = sorted(sn2_names.difference(sn1_names))
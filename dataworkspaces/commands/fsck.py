@@ -0,0 +1,147 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Check the integrity of the data stored for each snapshot.
+"""
+
+import os
+import json
+import tempfile
+from typing import Dict, List, Optional, Set, Tuple, cast
+
+import click
+
+from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.workspace import (
+    Workspace,
+    SnapshotWorkspaceMixin,
+    IntegrityCheckResourceMixin,
+    JSONDict,
+)
+
+# Progress is saved in the workspace's scratch directory after each resource
+# hash is checked, so that an interrupted run can pick up where it left off.
+FSCK_CHECKPOINT_FILE = "fsck_checkpoint.json"
+
+OBJECTS_CHECK = "objects"
+DATA_CHECK = "data"
+
+
+def _load_checkpoint(checkpoint_path: str) -> Optional[JSONDict]:
+    try:
+        with open(checkpoint_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        click.echo("Ignoring unreadable fsck checkpoint %s" % checkpoint_path, err=True)
+        return None
+
+
+def _save_checkpoint(checkpoint_path: Optional[str], state: JSONDict) -> None:
+    if checkpoint_path is None:
+        return
+    # write to a temp file and rename, so that an interruption does not leave
+    # a partial checkpoint
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(checkpoint_path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmpname, checkpoint_path)
+
+
+def fsck_command(
+    workspace: Workspace,
+    check_data: bool = False,
+    num_workers: Optional[int] = None,
+    restart: bool = False,
+) -> JSONDict:
+    """Check that, for each snapshot, the objects stored by each resource that
+    supports integrity checks are present and intact. If check_data is True,
+    also compare the current contents of these resources to the most recent
+    snapshot, hashing with num_workers workers (if specified).
+
+    Unless restart is True, a run that was interrupted is resumed from its checkpoint.
+    Returns the report, a JSON-serializable dict, with a list of problems found.
+    """
+    if not isinstance(workspace, SnapshotWorkspaceMixin):
+        raise ConfigurationError("Workspace %s does not support snapshots." % workspace.name)
+    mixin = cast(SnapshotWorkspaceMixin, workspace)
+    resources = {
+        r.name: cast(IntegrityCheckResourceMixin, r)
+        for r in workspace.get_resources()
+        if isinstance(r, IntegrityCheckResourceMixin)
+    }
+
+    # The (resource, hash) pairs to check, with the snapshots that refer to them,
+    # oldest first. The hash of the most recent snapshot is used to check the data.
+    snapshots_by_hash: Dict[Tuple[str, str], List[str]] = {}
+    latest_hashes: Dict[str, str] = {}
+    num_snapshots = 0
+    for md in mixin.list_snapshots(reverse=False):
+        num_snapshots += 1
+        for entry in mixin.get_snapshot_manifest(md.hashval):
+            if entry["name"] in resources and entry.get("hash") is not None:
+                snapshots_by_hash.setdefault((entry["name"], entry["hash"]), []).append(md.hashval)
+                latest_hashes[entry["name"]] = entry["hash"]
+    tasks = [(OBJECTS_CHECK, rname, h) for (rname, h) in snapshots_by_hash.keys()]
+    if check_data:
+        tasks.extend([(DATA_CHECK, rname, h) for (rname, h) in sorted(latest_hashes.items())])
+
+    try:
+        checkpoint_path = os.path.join(
+            workspace.get_scratch_directory(), FSCK_CHECKPOINT_FILE
+        )  # type: Optional[str]
+    except ConfigurationError:
+        click.echo("No scratch directory configured, progress will not be saved", err=True)
+        checkpoint_path = None
+    state = None if (restart or checkpoint_path is None) else _load_checkpoint(checkpoint_path)
+    if state is not None and state.get("check_data") == check_data:
+        click.echo(
+            "Resuming fsck from checkpoint: %d of %d checks already done"
+            % (len(state["done"]), len(tasks)),
+            err=True,
+        )
+    else:
+        state = {"check_data": check_data, "done": [], "problems": []}
+    done = set([tuple(task) for task in state["done"]])
+
+    # the objects found to be intact or bad so far, by resource
+    verified: Dict[str, Set[str]] = {}
+    bad: Dict[str, Dict[str, str]] = {}
+    for task in tasks:
+        if task in done:
+            continue
+        check, rname, h = task
+        r = resources[rname]
+        if workspace.verbose:
+            click.echo("Checking %s of resource %s for hash %s" % (check, rname, h), err=True)
+        if check == OBJECTS_CHECK:
+            problems = r.check_snapshot_objects(
+                h, verified.setdefault(rname, set()), bad.setdefault(rname, {})
+            )
+        else:
+            problems = r.check_current_data(h, num_workers=num_workers)
+        for path, message in problems:
+            state["problems"].append(
+                {
+                    "check": check,
+                    "resource": rname,
+                    "hash": h,
+                    "snapshots": snapshots_by_hash[(rname, h)],
+                    "path": path,
+                    "message": message,
+                }
+            )
+        state["done"].append(list(task))
+        _save_checkpoint(checkpoint_path, state)
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return {
+        "ok": len(state["problems"]) == 0,
+        "snapshots_checked": num_snapshots,
+        "resources_checked": sorted(resources.keys()),
+        "hashes_checked": len(snapshots_by_hash),
+        "data_checked": check_data,
+        "problems": state["problems"],
+    }
@@ -0,0 +1,78 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+from typing import List, Tuple, cast
+
+import click
+
+from dataworkspaces.errors import ConfigurationError, UserAbort
+from dataworkspaces.workspace import (
+    Workspace,
+    SnapshotWorkspaceMixin,
+    GarbageCollectionResourceMixin,
+    UnreachableObjects,
+)
+
+
+def _format_size(num_bytes: int) -> str:
+    size = float(num_bytes)
+    for unit in ["bytes", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            break
+        size = size / 1024
+    return ("%d %s" % (size, unit)) if unit == "bytes" else ("%.1f %s" % (size, unit))
+
+
+def gc_command(workspace: Workspace, dry_run: bool = False) -> None:
+    """Remove the objects stored by resources (e.g. hash trees) that are no
+    longer reachable from any snapshot. All removals are saved in a single commit.
+    """
+    if not isinstance(workspace, SnapshotWorkspaceMixin):
+        raise ConfigurationError("Workspace %s does not support snapshots." % workspace.name)
+    mixin = cast(SnapshotWorkspaceMixin, workspace)
+    # a snapshot in progress has written objects that are not referenced yet
+    with mixin.snapshot_lock():
+        live_hashes = mixin.get_snapshot_hashes_by_resource()
+        garbage: List[Tuple[GarbageCollectionResourceMixin, str, UnreachableObjects]] = []
+        for r in workspace.get_resources():
+            if not isinstance(r, GarbageCollectionResourceMixin):
+                continue
+            unreachable = cast(GarbageCollectionResourceMixin, r).find_unreachable_objects(
+                live_hashes.get(r.name, set())
+            )
+            if unreachable.num_objects > 0:
+                garbage.append((r, r.name, unreachable))
+                click.echo(
+                    "Resource '%s': %d unreachable objects (%s), %d files to remove or rewrite"
+                    % (
+                        r.name,
+                        unreachable.num_objects,
+                        _format_size(unreachable.num_bytes),
+                        len(unreachable.paths),
+                    )
+                )
+        total_objects = sum([unreachable.num_objects for (_, _, unreachable) in garbage])
+        total_bytes = sum([unreachable.num_bytes for (_, _, unreachable) in garbage])
+        if total_objects == 0:
+            click.echo("No unreachable objects found.")
+            return
+        if dry_run:
+            click.echo(
+                "Would remove %d objects (%s). Rerun without --dry-run to remove them."
+                % (total_objects, _format_size(total_bytes))
+            )
+            return
+        if not workspace.batch:
+            if not click.confirm(
+                "Should I remove %d unreachable objects (%s)?"
+                % (total_objects, _format_size(total_bytes))
+            ):
+                raise UserAbort()
+        for gc_r, name, unreachable in garbage:
+            gc_r.remove_objects(unreachable.paths, live_hashes.get(name, set()))
+        workspace.save(
+            "Garbage collection: removed %d unreachable objects from resources %s"
+            % (total_objects, ", ".join([name for (_, name, _) in garbage]))
+        )
+        click.echo(
+            "Removed %d unreachable objects, reclaiming %s."
+            % (total_objects, _format_size(total_bytes))
+        )
@@ -0,0 +1,33 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Move the snapshot metadata of a workspace from the flat layout to the sharded layout.
+"""
+
+import click
+
+from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.workspace import Workspace
+from dataworkspaces.utils.param_utils import SNAPSHOT_METADATA_LAYOUT, SHARDED_LAYOUT
+import dataworkspaces.backends.git as git_backend
+
+
+def migrate_snapshot_layout_command(workspace: Workspace) -> None:
+    """Move the snapshot manifest and metadata files into subdirectories by hash
+    prefix, and save the change in a single commit. Snapshots saved in the flat
+    layout remain readable, so this can be run at any time. Other copies of the
+    workspace pick up the new layout when they pull.
+    """
+    if not isinstance(workspace, git_backend.Workspace):
+        raise ConfigurationError(
+            "Workspace %s does not store its snapshot metadata in files, nothing to migrate."
+            % workspace.name
+        )
+    # switch the layout first, so that new snapshots are not saved in the flat layout
+    if workspace.get_global_param(SNAPSHOT_METADATA_LAYOUT) != SHARDED_LAYOUT:
+        workspace.set_global_param(SNAPSHOT_METADATA_LAYOUT, SHARDED_LAYOUT)
+    num_moved = workspace.migrate_snapshot_layout()
+    workspace.save("Migrated %d snapshot metadata files to the sharded layout" % num_moved)
+    if num_moved > 0:
+        click.echo("Moved %d snapshot metadata files to the sharded layout." % num_moved)
+    else:
+        click.echo("No snapshot metadata files in the flat layout, the workspace is now sharded.")
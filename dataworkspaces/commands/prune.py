@@ -0,0 +1,110 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+from typing import List, Optional, Set, Tuple, cast
+
+import click
+
+from dataworkspaces.errors import ConfigurationError, UserAbort
+from dataworkspaces.workspace import Workspace, SnapshotWorkspaceMixin, SnapshotMetadata
+
+
+def select_snapshots_to_keep(
+    workspace: SnapshotWorkspaceMixin,
+    snapshots: List[SnapshotMetadata],
+    keep_last: Optional[int] = None,
+    keep_tagged: bool = False,
+    keep_best: Optional[Tuple[str, int]] = None,
+    minimize: bool = False,
+    keep_daily: bool = False,
+) -> Set[str]:
+    """Given the snapshots of the workspace, most recent first, return the hashes
+    of those kept by any of the retention policies:
+
+    * keep_last: the specified number of most recent snapshots
+    * keep_tagged: all snapshots with at least one tag
+    * keep_best: a (metric, count) pair, the count snapshots with the best
+      values for the metric (the largest, or the smallest if minimize is True)
+    * keep_daily: the most recent snapshot of each day
+    """
+    keep = set()  # type: Set[str]
+    if keep_last is not None:
+        keep.update([md.hashval for md in snapshots[0:keep_last]])
+    if keep_tagged:
+        keep.update([md.hashval for md in snapshots if len(md.tags) > 0])
+    if keep_best is not None:
+        metric, count = keep_best
+        keep.update(
+            [r.hashval for r in workspace.query_metrics(metric, top_k=count, maximize=not minimize)]
+        )
+    if keep_daily:
+        days = set()  # type: Set[str]
+        for md in snapshots:
+            day = md.timestamp[0:10]
+            if day not in days:
+                days.add(day)
+                keep.add(md.hashval)
+    return keep
+
+
+def prune_command(
+    workspace: Workspace,
+    keep_last: Optional[int] = None,
+    keep_tagged: bool = False,
+    keep_best: Optional[Tuple[str, int]] = None,
+    minimize: bool = False,
+    keep_daily: bool = False,
+    dry_run: bool = False,
+    no_include_resources: bool = False,
+) -> None:
+    """Delete all the snapshots which are not kept by any of the retention policies.
+    The set of snapshots to delete is computed first, and then they are deleted
+    together, with all the changes saved in a single commit.
+    """
+    if not isinstance(workspace, SnapshotWorkspaceMixin):
+        raise ConfigurationError("Workspace %s does not support snapshots." % workspace.name)
+    if keep_last is None and (not keep_tagged) and keep_best is None and (not keep_daily):
+        raise ConfigurationError(
+            "Please specify at least one retention policy: --keep-last, --keep-tagged, "
+            + "--keep-best, or --keep-daily"
+        )
+    mixin = cast(SnapshotWorkspaceMixin, workspace)
+    snapshots = list(mixin.iter_snapshots(reverse=True))
+    keep = select_snapshots_to_keep(
+        mixin,
+        snapshots,
+        keep_last=keep_last,
+        keep_tagged=keep_tagged,
+        keep_best=keep_best,
+        minimize=minimize,
+        keep_daily=keep_daily,
+    )
+    to_delete = [md for md in snapshots if md.hashval not in keep]
+    if len(to_delete) == 0:
+        click.echo("All %d snapshots are kept by the retention policies." % len(snapshots))
+        return
+    if dry_run or workspace.verbose:
+        for md in to_delete:
+            click.echo(
+                "  %s %s%s"
+                % (
+                    md.hashval[0:8],
+                    md.timestamp[0:19],
+                    (" (Tagged as: %s)" % ", ".join(md.tags)) if len(md.tags) > 0 else "",
+                )
+            )
+    if dry_run:
+        click.echo(
+            "Would delete %d of %d snapshots. Rerun without --dry-run to delete them."
+            % (len(to_delete), len(snapshots))
+        )
+        return
+    if not workspace.batch:
+        if not click.confirm(
+            "Should I delete %d of %d snapshots? This is not reversible."
+            % (len(to_delete), len(snapshots))
+        ):
+            raise UserAbort()
+    mixin.delete_snapshots(
+        [md.hashval for md in to_delete], include_resources=not no_include_resources
+    )
+    workspace.save("Pruned %d snapshots" % len(to_delete))
+    click.echo("Successfully deleted %d snapshots, kept %d." % (len(to_delete), len(keep)))
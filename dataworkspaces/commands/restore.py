@@ -1,8 +1,11 @@
 # Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+from os.path import join
 from typing import Optional, List, cast
 import click
 
 from dataworkspaces.errors import ConfigurationError, UserAbort, InternalError, ApiParamError
+from dataworkspaces.utils.param_utils import TIMINGS_LOG
+from dataworkspaces.utils import timing_utils
 from dataworkspaces.workspace import (
     Workspace,
     SnapshotWorkspaceMixin,
@@ -17,9 +20,32 @@ def restore_command(
     only: Optional[List[str]] = None,
     leave: Optional[List[str]] = None,
     strict: bool = False,
+    timings: bool = False,
 ) -> int:
     """Run the restore and return the number of resources affected.
+    If timings is True, print the time and resources used by each phase of the restore.
     """
+    log_timings = workspace.get_local_param(TIMINGS_LOG)
+    with timing_utils.recording("restore", enabled=timings or log_timings) as recorder:
+        num_restored = _restore(workspace, tag_or_hash, only, leave, strict)
+    if recorder is not None:
+        if timings:
+            click.echo(recorder.format_report(), err=True)
+        if log_timings:
+            recorder.append_to_log(
+                join(workspace.get_scratch_directory(), timing_utils.TIMINGS_LOG_FILE),
+                tag_or_hash=tag_or_hash,
+            )
+    return num_restored
+
+
+def _restore(
+    workspace: Workspace,
+    tag_or_hash: str,
+    only: Optional[List[str]],
+    leave: Optional[List[str]],
+    strict: bool,
+) -> int:
     if not isinstance(workspace, SnapshotWorkspaceMixin):
         raise ConfigurationError("Workspace %s does not support snapshots" % workspace.name)
     mixin = cast(SnapshotWorkspaceMixin, workspace)
@@ -134,6 +160,7 @@ def restore_command(
     mixin.restore(
         md.hashval, restore_hashes, cast(List[SnapshotResourceMixin], restore_resource_list)
     )
-    workspace.save("Restore to %s" % md.hashval)
+    with timing_utils.timed_phase("save"):
+        workspace.save("Restore to %s" % md.hashval)
 
     return len(restore_name_list)
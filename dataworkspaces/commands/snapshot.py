@@ -1,10 +1,13 @@
 # Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
 
+from os.path import join
 from typing import Optional, cast
 
 import click
 
 from dataworkspaces.utils.hash_utils import is_a_git_hash, is_a_shortened_git_hash
+from dataworkspaces.utils.param_utils import TIMINGS_LOG
+from dataworkspaces.utils import timing_utils
 from dataworkspaces.errors import ConfigurationError, UserAbort
 from dataworkspaces.workspace import Workspace, SnapshotMetadata, SnapshotWorkspaceMixin
 
@@ -50,10 +53,35 @@ def merge_snapshot_metadata(
         restore_hashes=new.restore_hashes,
         metrics=new.metrics,
         updated_timestamp=new.timestamp,
+        snapshot_number=new.snapshot_number,
     )
 
 
-def snapshot_command(workspace: Workspace, tag: Optional[str] = None, message: str = "") -> str:
+def snapshot_command(
+    workspace: Workspace,
+    tag: Optional[str] = None,
+    message: str = "",
+    rehash: bool = False,
+    timings: bool = False,
+) -> str:
+    """Take a snapshot and return its hash. If timings is True, print the time
+    and resources used by each phase of the snapshot.
+    """
+    log_timings = workspace.get_local_param(TIMINGS_LOG)
+    with timing_utils.recording("snapshot", enabled=timings or log_timings) as recorder:
+        hashval = _take_snapshot(workspace, tag, message, rehash)
+    if recorder is not None:
+        if timings:
+            click.echo(recorder.format_report(), err=True)
+        if log_timings:
+            recorder.append_to_log(
+                join(workspace.get_scratch_directory(), timing_utils.TIMINGS_LOG_FILE),
+                snapshot=hashval,
+            )
+    return hashval
+
+
+def _take_snapshot(workspace: Workspace, tag: Optional[str], message: str, rehash: bool) -> str:
     if (tag is not None) and (is_a_git_hash(tag) or is_a_shortened_git_hash(tag)):
         raise ConfigurationError(
             "Tag '%s' looks like a git hash. Please pick something else." % tag
@@ -81,17 +109,24 @@ def snapshot_command(workspace: Workspace, tag: Optional[str] = None, message: s
             else:
                 mixin.remove_tag_from_snapshot(existing_tag_md.hashval, tag)
 
-    (md, manifest) = mixin.snapshot(tag, message)
+    with mixin.snapshot_lock(shared=True):
+        try:
+            (md, manifest) = mixin.snapshot(tag, message, rehash=rehash)
 
-    try:
-        old_md = mixin.get_snapshot_metadata(md.hashval)  # type: Optional[SnapshotMetadata]
-    except:
-        old_md = None
-    if old_md is not None:
-        md = merge_snapshot_metadata(old_md, md, workspace.batch)
+            try:
+                old_md = mixin.get_snapshot_metadata(md.hashval)  # type: Optional[SnapshotMetadata]
+            except:
+                old_md = None
+            if old_md is not None:
+                md = merge_snapshot_metadata(old_md, md, workspace.batch)
 
-    mixin.save_snapshot_metadata_and_manifest(md, manifest)
-    workspace.save("Completed snapshot %s" % md.hashval)
+            with timing_utils.timed_phase("save"):
+                mixin.save_snapshot_metadata_and_manifest(md, manifest)
+                workspace.save("Completed snapshot %s" % md.hashval)
+        except BaseException:
+            # don't leave a partial snapshot to be saved by a later command
+            mixin.abort_snapshot()
+            raise
 
     if tag:
         click.echo(
@@ -0,0 +1,62 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Watch resources for changes, so that the next snapshot only needs to walk the
+directories that changed.
+"""
+
+from typing import List, Optional, cast
+
+import click
+
+from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.workspace import Workspace, ChangeJournalResourceMixin
+from dataworkspaces.utils.change_journal import Watcher, run_watchers
+
+
+def watch_command(
+    workspace: Workspace,
+    resource_names: Optional[List[str]] = None,
+    use_inotify: bool = True,
+    scan_interval: float = 60.0,
+) -> None:
+    """Record the changes to the named resources (or all the resources that support
+    change journals) in their journals, until interrupted."""
+    if resource_names is None or len(resource_names) == 0:
+        resources = [
+            r for r in workspace.get_resources() if isinstance(r, ChangeJournalResourceMixin)
+        ]
+        if len(resources) == 0:
+            raise ConfigurationError(
+                "Workspace %s has no resources that can be watched." % workspace.name
+            )
+    else:
+        resources = []
+        for name in resource_names:
+            r = workspace.get_resource(name)
+            if not isinstance(r, ChangeJournalResourceMixin):
+                raise ConfigurationError("Resource %s cannot be watched." % name)
+            resources.append(r)
+    watchers: List[Watcher] = []
+    try:
+        for r in resources:
+            watchers.append(
+                cast(ChangeJournalResourceMixin, r).start_watcher(
+                    use_inotify=use_inotify, scan_interval=scan_interval
+                )
+            )
+            click.echo(
+                "Watching resource %s (%s)" % (r.name, watchers[-1].__class__.__name__), err=True
+            )
+    except:
+        for w in watchers:
+            w.close()
+        raise
+    click.echo(
+        "The next snapshot will scan all the files, later ones only the directories "
+        + "that changed. Press control-C to stop.",
+        err=True,
+    )
+    try:
+        run_watchers(watchers)
+    except KeyboardInterrupt:
+        click.echo("Stopped watching.", err=True)
@@ -6,10 +6,11 @@ Command-line tool for data workspaces
 
 __all__ = ["cli"]
 import sys
+import json
 import click
 import re
 from os.path import isdir, join, abspath, expanduser, basename, curdir
-from typing import Optional, Union
+from typing import Optional, Union, Tuple, cast
 from argparse import Namespace
 from collections.abc import Sequence
 
@@ -18,6 +19,11 @@ from dataworkspaces.commands.init import init_command
 from dataworkspaces.commands.add import add_command
 from dataworkspaces.commands.snapshot import snapshot_command
 from dataworkspaces.commands.delete_snapshot import delete_snapshot_command
+from dataworkspaces.commands.prune import prune_command
+from dataworkspaces.commands.gc import gc_command
+from dataworkspaces.commands.fsck import fsck_command
+from dataworkspaces.commands.migrate_snapshot_layout import migrate_snapshot_layout_command
+from dataworkspaces.commands.watch import watch_command
 from dataworkspaces.commands.restore import restore_command
 from dataworkspaces.commands.status import status_command
 from dataworkspaces.commands.report import (
@@ -46,6 +52,7 @@ from dataworkspaces.errors import BatchModeError
 from dataworkspaces.utils.param_utils import DEFAULT_HOSTNAME
 from dataworkspaces.utils.regexp_utils import HOSTNAME_RE
 from dataworkspaces.utils.file_utils import LocalPathType
+from dataworkspaces.resources.hashtree import HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM
 
 CURR_DIR = abspath(expanduser(curdir))
 CURR_DIRNAME = basename(CURR_DIR)
@@ -360,6 +367,13 @@ cli.add_command(add)
     default=False,
     help="Compute hashes for all files. If this option is not set, we use a lightweight comparison of file sizes only.",
 )
+@click.option(
+    "--hash-algorithm",
+    type=click.Choice(HASH_ALGORITHMS),
+    default=DEFAULT_HASH_ALGORITHM,
+    help="Algorithm used to hash files if --compute-hash is specified. Defaults to %s."
+    % DEFAULT_HASH_ALGORITHM,
+)
 @click.option(
     "--export",
     "-e",
@@ -376,7 +390,16 @@ cli.add_command(add)
 )
 @click.argument("path", type=DIRECTORY_PARAM)
 @click.pass_context
-def local_files(ctx, role, name, compute_hash: bool, export: bool, imported: bool, path: str):
+def local_files(
+    ctx,
+    role,
+    name,
+    compute_hash: bool,
+    hash_algorithm: str,
+    export: bool,
+    imported: bool,
+    path: str,
+):
     """Add a local file directory (not managed by git) to the workspace. Subcommand of ``add``"""
     ns = ctx.obj
     if role is None:
@@ -403,7 +426,7 @@ def local_files(ctx, role, name, compute_hash: bool, export: bool, imported: boo
         raise click.BadOptionUsage(
             message="--imported only for source-data roles", option_name="imported"
         )
-    add_command("file", role, name, workspace, path, compute_hash, export, imported)
+    add_command("file", role, name, workspace, path, compute_hash, export, imported, hash_algorithm)
 
 
 add.add_command(local_files)
@@ -583,9 +606,22 @@ add.add_command(api_resource)
 @click.command()
 @click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
 @click.option("--message", "-m", type=str, default="", help="Message describing the snapshot")
+@click.option(
+    "--rehash",
+    is_flag=True,
+    default=False,
+    help="If specified, recompute all file hashes rather than reusing hashes cached "
+    + "for files that have not changed since the last snapshot.",
+)
+@click.option(
+    "--timings",
+    is_flag=True,
+    default=False,
+    help="If specified, print the time and resources used by each phase of the snapshot.",
+)
 @click.argument("tag", type=HOST_PARAM, default=None, required=False)
 @click.pass_context
-def snapshot(ctx, workspace_dir, message, tag):
+def snapshot(ctx, workspace_dir, message, rehash, timings, tag):
     """Take a snapshot of the current workspace's state"""
     ns = ctx.obj
     if workspace_dir is None:
@@ -596,7 +632,7 @@ def snapshot(ctx, workspace_dir, message, tag):
                 "Please enter the workspace root dir", type=WORKSPACE_PARAM
             )
     workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
-    snapshot_command(workspace, tag, message)
+    snapshot_command(workspace, tag, message, rehash=rehash, timings=timings)
 
 
 cli.add_command(snapshot)
@@ -632,6 +668,231 @@ def delete_snapshot(ctx, workspace_dir: str, no_include_resources: bool, tag_or_
 cli.add_command(delete_snapshot)
 
 
+@click.command()
+@click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
+@click.option(
+    "--keep-last",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Keep this many of the most recent snapshots.",
+)
+@click.option(
+    "--keep-tagged", is_flag=True, default=False, help="Keep all snapshots that have a tag."
+)
+@click.option(
+    "--keep-best",
+    type=(str, click.IntRange(min=1)),
+    default=(None, None),
+    metavar="METRIC COUNT",
+    help="Keep the COUNT snapshots with the largest values of METRIC.",
+)
+@click.option(
+    "--minimize",
+    is_flag=True,
+    default=False,
+    help="For --keep-best, keep the snapshots with the smallest values of the metric (e.g. loss).",
+)
+@click.option(
+    "--keep-daily", is_flag=True, default=False, help="Keep the most recent snapshot of each day."
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Just list the snapshots that would be deleted, without deleting them.",
+)
+@click.option(
+    "--no-include-resources",
+    is_flag=True,
+    default=False,
+    help="If specified, do NOT include deleting an snapshot-specific content from resources.",
+)
+@click.pass_context
+def prune(
+    ctx,
+    workspace_dir: str,
+    keep_last: Optional[int],
+    keep_tagged: bool,
+    keep_best: Tuple[Optional[str], Optional[int]],
+    minimize: bool,
+    keep_daily: bool,
+    dry_run: bool,
+    no_include_resources: bool,
+):
+    """Delete all snapshots except those kept by the retention policies. A
+    snapshot is kept if any of the specified policies keeps it, and at least one
+    policy must be specified. The deleted snapshots' metadata, lineage data, and
+    (unless --no-include-resources is specified) results data are removed
+    together, in a single commit."""
+    ns = ctx.obj
+    if workspace_dir is None:
+        if ns.batch:
+            raise BatchModeError("--workspace-dir")
+        else:
+            workspace_dir = click.prompt(
+                "Please enter the workspace root dir", type=WORKSPACE_PARAM
+            )
+    workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
+    prune_command(
+        workspace,
+        keep_last=keep_last,
+        keep_tagged=keep_tagged,
+        keep_best=cast(Tuple[str, int], keep_best) if keep_best[0] is not None else None,
+        minimize=minimize,
+        keep_daily=keep_daily,
+        dry_run=dry_run,
+        no_include_resources=no_include_resources,
+    )
+
+
+cli.add_command(prune)
+
+
+@click.command()
+@click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
+@click.pass_context
+def migrate_snapshot_layout(ctx, workspace_dir: str):
+    """Move the metadata and manifest files of the workspace's snapshots into
+    subdirectories named by the first two characters of the snapshot hash, and
+    save new snapshots this way. This keeps directory listings and git trees small
+    in workspaces with many snapshots. The moves are saved in a single commit.
+    Snapshots stored in the old, flat layout can still be read."""
+    ns = ctx.obj
+    if workspace_dir is None:
+        if ns.batch:
+            raise BatchModeError("--workspace-dir")
+        else:
+            workspace_dir = click.prompt(
+                "Please enter the workspace root dir", type=WORKSPACE_PARAM
+            )
+    workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
+    migrate_snapshot_layout_command(workspace)
+
+
+cli.add_command(migrate_snapshot_layout)
+
+
+@click.command()
+@click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Just report the number and size of the unreachable objects, without removing them.",
+)
+@click.pass_context
+def gc(ctx, workspace_dir: str, dry_run: bool):
+    """Remove data that resources store for snapshots (e.g. the hash trees
+    of local files resources) and that is no longer reachable from any remaining
+    snapshot, such as after delete-snapshot. The removals are saved in a single
+    commit. Run this after a pull, so that snapshots taken in other copies of the
+    workspace are taken into account."""
+    ns = ctx.obj
+    if workspace_dir is None:
+        if ns.batch:
+            raise BatchModeError("--workspace-dir")
+        else:
+            workspace_dir = click.prompt(
+                "Please enter the workspace root dir", type=WORKSPACE_PARAM
+            )
+    workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
+    gc_command(workspace, dry_run=dry_run)
+
+
+cli.add_command(gc)
+
+
+@click.command()
+@click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
+@click.option(
+    "--check-data",
+    is_flag=True,
+    default=False,
+    help="Also rehash the current contents of each resource and compare them to the "
+    + "most recent snapshot.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of workers used to hash files for --check-data. Defaults to the "
+    + "resource's hash_workers setting.",
+)
+@click.option(
+    "--restart",
+    is_flag=True,
+    default=False,
+    help="Start from the beginning, rather than resuming an interrupted run.",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the JSON report to this file rather than to standard output.",
+)
+@click.pass_context
+def fsck(ctx, workspace_dir: str, check_data: bool, workers, restart: bool, output):
+    """Check that the data stored for each snapshot (e.g. the hash trees of local
+    files resources) is present and intact. The results are printed as a JSON report
+    and the exit status is non-zero if any problems were found. Progress is
+    checkpointed, so an interrupted run resumes where it left off."""
+    ns = ctx.obj
+    if workspace_dir is None:
+        if ns.batch:
+            raise BatchModeError("--workspace-dir")
+        else:
+            workspace_dir = click.prompt(
+                "Please enter the workspace root dir", type=WORKSPACE_PARAM
+            )
+    workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
+    report = fsck_command(workspace, check_data=check_data, num_workers=workers, restart=restart)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        click.echo(json.dumps(report, indent=2))
+    if not report["ok"]:
+        sys.exit(1)
+
+
+cli.add_command(fsck)
+
+
+@click.command()
+@click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
+@click.option(
+    "--scan",
+    is_flag=True,
+    default=False,
+    help="Find changes by periodically scanning the files, rather than with inotify.",
+)
+@click.option(
+    "--scan-interval",
+    type=click.FloatRange(min=1),
+    default=60.0,
+    help="Seconds between scans, if inotify is not used. Defaults to 60.",
+)
+@click.argument("resources", type=str, nargs=-1)
+@click.pass_context
+def watch(ctx, workspace_dir: str, scan: bool, scan_interval: float, resources):
+    """Watch the specified resources (or all local files resources) for changes
+    until interrupted. While the watcher is running, snapshots only need to walk
+    the directories that changed since the previous snapshot."""
+    ns = ctx.obj
+    if workspace_dir is None:
+        if ns.batch:
+            raise BatchModeError("--workspace-dir")
+        else:
+            workspace_dir = click.prompt(
+                "Please enter the workspace root dir", type=WORKSPACE_PARAM
+            )
+    workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
+    watch_command(workspace, list(resources), use_inotify=not scan, scan_interval=scan_interval)
+
+
+cli.add_command(watch)
+
+
 @click.command()
 @click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
 @click.option(
@@ -655,6 +916,12 @@ cli.add_command(delete_snapshot)
     help="If specified, error out if unable to restore any of the requested resources "
     + "(due to lack of a restore hash or removing the resource from workspace).",
 )
+@click.option(
+    "--timings",
+    is_flag=True,
+    default=False,
+    help="If specified, print the time and resources used by each phase of the restore.",
+)
 @click.argument("tag_or_hash", type=str, default=None, required=True)
 @click.pass_context
 def restore(
@@ -663,6 +930,7 @@ def restore(
     only: Optional[str],
     leave: Optional[str],
     strict: bool,
+    timings: bool,
     tag_or_hash: str,
 ):
     """Restore the workspace to a prior state"""
@@ -683,6 +951,7 @@ def restore(
         only=only.split(",") if only else None,
         leave=leave.split(",") if leave else None,
         strict=strict,
+        timings=timings,
     )
 
 
@@ -1015,10 +1284,18 @@ cli.add_command(version)
 
 @click.command()
 @click.option("--workspace-dir", type=WORKSPACE_PARAM, default=DWS_PATHDIR)
+@click.option(
+    "--files",
+    "show_files",
+    is_flag=True,
+    default=False,
+    help="For resources that support it (e.g. local files), also list the files that "
+    + "were added (A), deleted (D), or modified (M).",
+)
 @click.argument("snapshot_or_tag1", metavar="SNAPSHOT_OR_TAG1", type=str)
 @click.argument("snapshot_or_tag2", metavar="SNAPSHOT_OR_TAG2", type=str)
 @click.pass_context
-def diff(ctx, workspace_dir, snapshot_or_tag1, snapshot_or_tag2):
+def diff(ctx, workspace_dir, show_files, snapshot_or_tag1, snapshot_or_tag2):
     """List differences between two snapshots"""
     ns = ctx.obj
     if workspace_dir is None:
@@ -1029,7 +1306,7 @@ def diff(ctx, workspace_dir, snapshot_or_tag1, snapshot_or_tag2):
                 "Please enter the workspace root dir", type=WORKSPACE_PARAM
             )
     workspace = find_and_load_workspace(ns.batch, ns.verbose, workspace_dir)
-    diff_command(workspace, snapshot_or_tag1, snapshot_or_tag2)
+    diff_command(workspace, snapshot_or_tag1, snapshot_or_tag2, show_files=show_files)
 
 
 cli.add_command(diff)
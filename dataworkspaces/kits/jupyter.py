@@ -29,7 +29,7 @@ from collections import namedtuple
 
 from dataworkspaces.lineage import LineageBuilder
 from dataworkspaces.workspace import _find_containing_workspace
-from dataworkspaces.api import take_snapshot, get_snapshot_history,\
+from dataworkspaces.api import take_snapshot, get_snapshot_history, get_metric_values,\
                                make_lineage_table, make_lineage_graph,\
                                get_results
 from dataworkspaces.errors import ConfigurationError
@@ -457,12 +457,16 @@ class DwsMagics(Magics):
         history = get_snapshot_history(self.dws_jupyter_info.workspace_dir,
                                        max_count=max_count,
                                        reverse=args.tail)
+        # numeric metrics are read a column at a time from the workspace's metrics table,
+        # just for the snapshots in the history
+        metric_values = get_metric_values(self.dws_jupyter_info.workspace_dir,
+                                          snapshot_hashes=[s.hashval for s in history])
         entries = []
         index = []
-        columns = ['timestamp', 'hash', 'tags', 'message']
+        hashes = [] # type: List[str]
         baseline_snapshot = None # type: Optional[int]
         # not every snapshot has the same metrics, so we build an inclusive list
-        metrics = [] # type: List[str]
+        other_metrics = [] # type: List[str]
         for s in history:
             d = {'timestamp':s.timestamp[0:19],
                  'hash':s.hashval[0:8],
@@ -470,12 +474,13 @@ class DwsMagics(Magics):
                  'message':s.message if s.message is not None else ''}
             if s.metrics is not None:
                 for (m, v) in s.metrics.items():
-                    d[m] = v
-                    if m not in columns:
-                        columns.append(m)
-                        metrics.append(m)
+                    if m not in metric_values:
+                        d[m] = v
+                        if m not in other_metrics:
+                            other_metrics.append(m)
             entries.append(d)
             index.append(s.snapshot_number)
+            hashes.append(s.hashval)
             if (args.baseline is not None):
                 if args.baseline in s.tags:
                     baseline_snapshot = s.snapshot_number
@@ -485,7 +490,13 @@ class DwsMagics(Magics):
             print("Did not find a tag or hash corresponding to baseline '%s'"
                   % args.baseline, file=sys.stderr)
             return
+        numeric_metrics = [m for (m, values) in metric_values.items()
+                           if any(h in values for h in hashes)]
+        metrics = numeric_metrics + other_metrics
+        columns = ['timestamp', 'hash', 'tags', 'message'] + metrics
         history_df = pd.DataFrame(entries, index=index, columns=columns)
+        for m in numeric_metrics:
+            history_df[m] = [metric_values[m].get(h, np.nan) for h in hashes]
         maximize_metrics = set(['accuracy', 'precision', 'recall'])
         if args.maximize_metrics:
             maximize_metrics = maximize_metrics.union(set(args.maximize_metrics.split(',')))
@@ -75,6 +75,18 @@ class ApiResource(Resource, LocalStateResourceMixin, SnapshotResourceMixin):
             click.echo("WARNING: no hash available for resource %s" % self.name)
             return (None, None)
 
+    def supports_concurrent_snapshot(self) -> bool:
+        return True
+
+    def has_changed_since(self, previous_compare_hash: str) -> bool:
+        hashfile = join(
+            self.workspace._get_local_scratch_space_for_resource(self.name), "hashval.txt"
+        )
+        if not exists(hashfile):
+            return True
+        with open(hashfile, "r") as f:
+            return f.read().rstrip() != previous_compare_hash
+
     def restore_precheck(self, restore_hashval: str) -> None:
         raise InternalError("Attempt to restore resource %s, which is not restoreable" % self.name)
 
@@ -20,12 +20,17 @@ import shutil
 import stat
 import click
 import json
-from typing import Set, Pattern, Union, Optional, Tuple, cast
+from typing import List, Set, Pattern, Union, Optional, Tuple, cast
 
 from dataworkspaces.errors import ConfigurationError, InternalError
-from dataworkspaces.utils.subprocess_utils import call_subprocess, call_subprocess_for_rc
+from dataworkspaces.utils.subprocess_utils import (
+    call_subprocess,
+    call_subprocess_for_rc,
+    run_subprocess,
+)
 from dataworkspaces.utils.git_utils import (
     is_git_dirty,
+    is_git_subdir_dirty,
     is_file_tracked_by_git,
     get_local_head_hash,
     commit_changes_in_repo,
@@ -37,10 +42,12 @@ from dataworkspaces.utils.git_utils import (
     get_subdirectory_hash,
     is_pull_needed_from_remote,
     git_remove_subtree,
+    git_remove_subtrees,
     git_remove_file,
     git_commit,
     git_add,
     is_git_staging_dirty,
+    get_git_repo_lock,
 )
 from dataworkspaces.utils.git_fat_utils import (
     is_a_git_fat_repo,
@@ -156,6 +163,10 @@ class GitResourceBase(Resource, LocalStateResourceMixin, FileResourceMixin, Snap
 
         self.repo_dir = repo_dir  # The root of the repo.
 
+    def supports_concurrent_snapshot(self) -> bool:
+        # git commands that modify the repo are run under get_git_repo_lock()
+        return True
+
     def get_local_path_if_any(self):
         return self.local_path
 
@@ -180,6 +191,36 @@ class GitResourceBase(Resource, LocalStateResourceMixin, FileResourceMixin, Snap
                 self.repo_dir, "Deleted %s" % snapshot_dir_path, verbose=self.workspace.verbose
             )
 
+    def delete_snapshots(self, snapshots: List[Tuple[str, str, str]]) -> None:
+        """Remove all of the snapshot directories with one git call. If the resource
+        is in the workspace's repo, the removals are committed when the workspace
+        is saved. Otherwise, they are committed to the resource's repo here.
+        """
+        subpaths = []  # type: List[str]
+        for _, _, relative_path in snapshots:
+            snapshot_dir_path = join(self.local_path, relative_path)
+            if isdir(snapshot_dir_path):
+                subpath_relative_to_repo = get_subpath_from_absolute(
+                    self.repo_dir, snapshot_dir_path
+                )
+                assert subpath_relative_to_repo is not None
+                subpaths.append(subpath_relative_to_repo)
+        if len(subpaths) == 0:
+            return
+        if self.workspace.verbose:
+            print("Deleting %d snapshot directories from resource %s" % (len(subpaths), self.name))
+        with get_git_repo_lock(self.repo_dir):
+            git_remove_subtrees(self.repo_dir, subpaths, verbose=self.workspace.verbose)
+            if not (
+                isinstance(self.workspace, git_backend.Workspace)
+                and realpath(self.repo_dir) == realpath(self.workspace.workspace_dir)
+            ):
+                git_commit(
+                    self.repo_dir,
+                    "Deleted %d snapshot directories" % len(subpaths),
+                    verbose=self.workspace.verbose,
+                )
+
     def does_subpath_exist(
         self, subpath: str, must_be_file: bool = False, must_be_directory: bool = False
     ) -> bool:
@@ -404,13 +445,26 @@ class GitRepoResource(GitResourceBase):
 
     def snapshot(self):
         # Todo: handle tags
-        commit_changes_in_repo(
-            self.local_path, "autocommit ahead of snapshot", verbose=self.workspace.verbose
-        )
-        switch_git_branch_if_needed(self.local_path, self.branch, self.workspace.verbose)
-        hashval = get_local_head_hash(self.local_path, self.workspace.verbose)
+        with get_git_repo_lock(self.local_path):
+            commit_changes_in_repo(
+                self.local_path, "autocommit ahead of snapshot", verbose=self.workspace.verbose
+            )
+            switch_git_branch_if_needed(self.local_path, self.branch, self.workspace.verbose)
+            hashval = get_local_head_hash(self.local_path, self.workspace.verbose)
         return (hashval, hashval)
 
+    def has_changed_since(self, previous_compare_hash: str) -> bool:
+        # Unchanged if the snapshotted commit is still checked out on our branch
+        # and there is nothing to commit. (git status may update the index, so we
+        # need the lock.)
+        with get_git_repo_lock(self.local_path):
+            return (
+                get_local_head_hash(self.local_path, self.workspace.verbose)
+                != previous_compare_hash
+                or get_branch_info(self.local_path, self.workspace.verbose)[0] != self.branch
+                or is_git_dirty(self.local_path)
+            )
+
     def restore_precheck(self, hashval):
         rc = call_subprocess_for_rc(
             [GIT_EXE_PATH, "cat-file", "-e", hashval + "^{commit}"],
@@ -518,8 +572,8 @@ def get_remote_origin(local_path, verbose=False):
     args = [GIT_EXE_PATH, "config", "--get", "remote.origin.url"]
     if verbose:
         click.echo(" ".join(args) + " [run in %s]" % local_path)
-    cp = subprocess.run(
-        args, cwd=local_path, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    cp = run_subprocess(
+        args, local_path, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
     if cp.returncode != 0:
         click.echo("Remote origin not found for git repo at %s" % local_path)
@@ -799,6 +853,28 @@ class GitRepoFactory(ResourceFactory):
         return basename(local_path)
 
 
+def _get_snapshot_transaction(workspace) -> Optional["git_backend.SnapshotTransaction"]:
+    """Return the transaction of the snapshot being taken, if any"""
+    if isinstance(workspace, git_backend.Workspace):
+        return workspace.snapshot_transaction
+    return None
+
+
+def _has_subdir_changed_since(
+    workspace_dir: str, relative_path: str, previous_compare_hash: str, verbose: bool
+) -> bool:
+    """The subdirectory of the workspace's repo is unchanged if its tree at HEAD is
+    the one that was snapshotted and it has no uncommitted changes."""
+    with get_git_repo_lock(workspace_dir):
+        try:
+            treehash = get_subdirectory_hash(workspace_dir, relative_path, verbose=verbose)
+        except InternalError:
+            return True  # nothing committed yet
+        return treehash != previous_compare_hash or is_git_subdir_dirty(
+            workspace_dir, relative_path
+        )
+
+
 def _get_workspace_dir_for_git_backend(workspace):
     """This is used by the git-subdirectory resources, which only work with the
     git backend for the workspace...
@@ -844,6 +920,17 @@ class GitRepoResultsSubdirResource(GitResourceBase):
         self, rel_dest_root: str, exclude_files: Set[str], exclude_dirs_re: Pattern
     ):
         validate_git_fat_in_path_if_needed(self.workspace_dir)
+        if _get_snapshot_transaction(self.workspace) is not None:
+            # the moves are staged by the snapshot, along with any other changes
+            move_current_files_local_fs(
+                self.name,
+                self.local_path,
+                rel_dest_root,
+                exclude_files,
+                exclude_dirs_re,
+                verbose=self.workspace.verbose,
+            )
+            return
         moved_files = move_current_files_local_fs(
             self.name,
             self.local_path,
@@ -875,6 +962,17 @@ class GitRepoResultsSubdirResource(GitResourceBase):
         self, rel_dest_root: str, exclude_files: Set[str], exclude_dirs_re: Pattern
     ):
         validate_git_fat_in_path_if_needed(self.workspace_dir)
+        if _get_snapshot_transaction(self.workspace) is not None:
+            # the copies are staged by the snapshot, along with any other changes
+            copy_current_files_local_fs(
+                self.name,
+                self.local_path,
+                rel_dest_root,
+                exclude_files,
+                exclude_dirs_re,
+                verbose=self.workspace.verbose,
+            )
+            return
         copied_files = copy_current_files_local_fs(
             self.name,
             self.local_path,
@@ -908,11 +1006,21 @@ class GitRepoResultsSubdirResource(GitResourceBase):
     def snapshot(self):
         # The subdirectory hash is used for comparison and the head
         # hash used for restoring
-        return (
-            get_subdirectory_hash(
-                self.workspace_dir, self.relative_path, verbose=self.workspace.verbose
-            ),
-            get_local_head_hash(self.workspace_dir, verbose=self.workspace.verbose),
+        transaction = _get_snapshot_transaction(self.workspace)
+        if transaction is not None:
+            treehash = transaction.stage_subdir(self.relative_path)
+            return (treehash, treehash)
+        with get_git_repo_lock(self.workspace_dir):
+            return (
+                get_subdirectory_hash(
+                    self.workspace_dir, self.relative_path, verbose=self.workspace.verbose
+                ),
+                get_local_head_hash(self.workspace_dir, verbose=self.workspace.verbose),
+            )
+
+    def has_changed_since(self, previous_compare_hash: str) -> bool:
+        return _has_subdir_changed_since(
+            self.workspace_dir, self.relative_path, previous_compare_hash, self.workspace.verbose
         )
 
     def restore_precheck(self, hashval):
@@ -1056,28 +1164,43 @@ class GitRepoSubdirResource(GitResourceBase):
         """Returns (cmopare_hash, restore_hash)
         """
         # Todo: handle tags
-        commit_changes_in_repo_subdir(
-            self.workspace_dir,
-            self.relative_path,
-            "autocommit ahead of snapshot",
-            verbose=self.workspace.verbose,
-        )
-        return (
-            get_subdirectory_hash(
-                self.workspace_dir, self.relative_path, verbose=self.workspace.verbose
-            ),
-            get_local_head_hash(self.workspace_dir, verbose=self.workspace.verbose),
+        transaction = _get_snapshot_transaction(self.workspace)
+        if transaction is not None:
+            # The changes are committed along with the rest of the snapshot. We
+            # restore from the subdirectory's tree, as the commit does not exist yet.
+            treehash = transaction.stage_subdir(self.relative_path)
+            return (treehash, treehash)
+        with get_git_repo_lock(self.workspace_dir):
+            commit_changes_in_repo_subdir(
+                self.workspace_dir,
+                self.relative_path,
+                "autocommit ahead of snapshot",
+                verbose=self.workspace.verbose,
+            )
+            return (
+                get_subdirectory_hash(
+                    self.workspace_dir, self.relative_path, verbose=self.workspace.verbose
+                ),
+                get_local_head_hash(self.workspace_dir, verbose=self.workspace.verbose),
+            )
+
+    def has_changed_since(self, previous_compare_hash: str) -> bool:
+        return _has_subdir_changed_since(
+            self.workspace_dir, self.relative_path, previous_compare_hash, self.workspace.verbose
         )
 
     def restore_precheck(self, hashval):
         validate_git_fat_in_path_if_needed(self.workspace_dir)
+        # snapshots taken in a transaction restore from a tree, older ones from a commit
         rc = call_subprocess_for_rc(
-            [GIT_EXE_PATH, "cat-file", "-e", hashval + "^{commit}"],
+            [GIT_EXE_PATH, "cat-file", "-e", hashval + "^{tree}"],
             cwd=self.workspace_dir,
             verbose=self.workspace.verbose,
         )
         if rc != 0:
-            raise ConfigurationError("No commit found with hash '%s' in %s" % (hashval, str(self)))
+            raise ConfigurationError(
+                "No commit or tree found with hash '%s' in %s" % (hashval, str(self))
+            )
 
     def restore(self, hashval):
         commit_changes_in_repo_subdir(
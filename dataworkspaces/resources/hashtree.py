@@ -2,48 +2,405 @@
 import os
 import tempfile
 import hashlib
+import functools
+import locale
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
-from typing import Dict, Optional, List, Tuple, Iterable, Callable
+from typing import (
+    Dict,
+    Optional,
+    List,
+    Tuple,
+    Iterable,
+    Generator,
+    Callable,
+    Any,
+    Deque,
+    Set,
+    cast,
+)
 
 assert Dict
 
-from dataworkspaces.utils.subprocess_utils import call_subprocess
-from dataworkspaces.utils.git_utils import GIT_EXE_PATH
-from dataworkspaces.utils.file_utils import safe_rename
+from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.utils.git_utils import git_add_many
+from dataworkspaces.utils.file_utils import safe_rename, walk_sorted
+from dataworkspaces.utils.hash_utils import update_hash_from_file
+from dataworkspaces.utils.chunk_utils import ChunkParams, DEFAULT_CHUNK_PARAMS, iter_chunks
+from dataworkspaces.utils.pack_utils import PackReader, PackWriter, is_pack_index
+from dataworkspaces.utils import timing_utils
 
-BUF_SIZE = 65536  # read stuff in 64kb chunks
+# Maximum number of files per worker that may be queued for hashing before
+# we wait for results. This bounds memory use on very large trees.
+MAX_QUEUED_FILES_PER_WORKER = 64
+# When using a process pool, files are sent to the workers in batches
+# of this size to amortize the cost of the inter-process communication.
+PROCESS_POOL_BATCH_SIZE = 32
 
 
-def compute_hash(tmpname: str) -> str:
-    sha1 = hashlib.sha1()
-    with open(tmpname, "rb") as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            sha1.update(data)
-    return sha1.hexdigest()
+# Algorithms that can be used to hash file contents. sha1 and blake2b are always
+# available, xxh3 and blake3 require the xxhash and blake3 packages, respectively.
+# Tree objects are always named by their sha1 hash.
+HASH_ALGORITHMS = ("sha1", "blake2b", "xxh3", "blake3")
+DEFAULT_HASH_ALGORITHM = "sha1"
+
+
+def get_hash_constructor(algorithm: str) -> Callable[[], Any]:
+    """Return a function that creates a new hash object (with update() and
+    hexdigest() methods) for the specified algorithm."""
+    if algorithm == "sha1":
+        return hashlib.sha1
+    elif algorithm == "blake2b":
+        return functools.partial(hashlib.blake2b, digest_size=32)
+    elif algorithm == "xxh3":
+        try:
+            import xxhash  # type: ignore
+        except ImportError as e:
+            raise ConfigurationError(
+                "Hash algorithm xxh3 requires the xxhash package. Install it via 'pip install xxhash'."
+            ) from e
+        return xxhash.xxh3_128
+    elif algorithm == "blake3":
+        try:
+            import blake3  # type: ignore
+        except ImportError as e:
+            raise ConfigurationError(
+                "Hash algorithm blake3 requires the blake3 package. Install it via 'pip install blake3'."
+            ) from e
+        return blake3.blake3
+    else:
+        raise ConfigurationError(
+            "Unknown hash algorithm '%s', valid algorithms are: %s"
+            % (algorithm, ", ".join(HASH_ALGORITHMS))
+        )
+
+
+def is_hash_algorithm_available(algorithm: str) -> bool:
+    try:
+        get_hash_constructor(algorithm)
+        return True
+    except ConfigurationError:
+        return False
+
+
+def get_hash_algorithm(hashval: str) -> Optional[str]:
+    """Return the algorithm used to compute a file hash stored in a tree object.
+    For backward compatibility, sha1 hashes are stored as just the hex digest.
+    Other algorithms are stored as ALGORITHM:DIGEST. Returns None if the value
+    is not a content hash (e.g. it is a file size)."""
+    if ":" in hashval:
+        return hashval.split(":", 1)[0]
+    elif len(hashval) == 40:
+        return "sha1"
+    else:
+        return None
+
+
+def compute_hash(tmpname: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    hasher = get_hash_constructor(algorithm)()
+    update_hash_from_file(hasher, tmpname)
+    if algorithm == "sha1":
+        return hasher.hexdigest()
+    else:
+        return algorithm + ":" + hasher.hexdigest()
+
+
+def make_hash_fun(algorithm: str) -> Callable[[str], str]:
+    """Return a (picklable) function that hashes a file using the specified algorithm."""
+    get_hash_constructor(algorithm)  # validate the algorithm up-front
+    if algorithm == DEFAULT_HASH_ALGORITHM:
+        return compute_hash
+    else:
+        return functools.partial(compute_hash, algorithm=algorithm)
 
 
 def compute_size(fname: str) -> str:
-    if not (os.path.exists(fname)):
+    try:
+        statinfo = os.stat(fname)
+    except FileNotFoundError:
         raise Exception("File %s does not exist" % fname)
-    statinfo = os.stat(fname)
     return str(statinfo.st_size)
 
 
+# With chunked hashing, files of at least CHUNKED_MIN_FILE_SIZE bytes are split
+# into content-defined chunks (see dataworkspaces.utils.chunk_utils). The file's
+# entry is then CHUNKED_PREFIX followed by the hash of a chunk list object, which
+# is stored alongside the tree objects. A chunk list has a header line of the form
+# "chunks ALGORITHM MIN_SIZE AVG_SIZE MAX_SIZE" followed by a line HASH<tab>SIZE for
+# each chunk, in file order.
+CHUNKED = "cdc"
+CHUNKED_PREFIX = CHUNKED + ":"
+CHUNKED_MIN_FILE_SIZE = 8 * 1024 * 1024
+
+
+def is_chunked_hash(hashval: str) -> bool:
+    return hashval.startswith(CHUNKED_PREFIX)
+
+
+def compute_chunks(
+    fname: str, algorithm: str = DEFAULT_HASH_ALGORITHM, params: ChunkParams = DEFAULT_CHUNK_PARAMS
+) -> List[Tuple[str, int]]:
+    """Split the file into content-defined chunks and return a (hash, size) pair
+    for each chunk. The file is read just once."""
+    new_hasher = get_hash_constructor(algorithm)
+    chunks = []  # type: List[Tuple[str, int]]
+    with open(fname, "rb", buffering=0) as f:
+        for chunk in iter_chunks(f, params):
+            hasher = new_hasher()
+            hasher.update(chunk)
+            chunks.append((hasher.hexdigest(), len(chunk)))
+    return chunks
+
+
+def _format_chunk_list(algorithm: str, params: ChunkParams, chunks: List[Tuple[str, int]]) -> bytes:
+    lines = [
+        "chunks %s %d %d %d\n" % (algorithm, params.min_size, params.avg_size, params.max_size)
+    ]
+    lines.extend(["%s\t%d\n" % (h, size) for (h, size) in chunks])
+    return "".join(lines).encode("ascii")
+
+
+def read_chunk_list(
+    basedir_where_hashes_are_stored: str, hashval: str
+) -> Tuple[str, ChunkParams, List[Tuple[str, int]]]:
+    """Read the chunk list referenced by a chunked file entry and return the
+    hash algorithm, the chunking parameters, and the (hash, size) pairs."""
+    assert is_chunked_hash(hashval), "%s is not a chunked file hash" % hashval
+    with open(
+        os.path.join(basedir_where_hashes_are_stored, hashval[len(CHUNKED_PREFIX) :]), "rb"
+    ) as f:
+        return _parse_chunk_list(hashval, f.read())
+
+
+def _parse_chunk_list(hashval: str, data: bytes) -> Tuple[str, ChunkParams, List[Tuple[str, int]]]:
+    try:
+        lines = data.decode("ascii").splitlines()
+        header = lines[0].split()
+        if len(header) != 5 or header[0] != "chunks":
+            raise ValueError("bad header")
+        params = ChunkParams(int(header[2]), int(header[3]), int(header[4]))
+        chunks = []  # type: List[Tuple[str, int]]
+        for line in lines[1:]:
+            h, size = line.split("\t")
+            chunks.append((h, int(size)))
+    except (ValueError, IndexError):
+        raise ConfigurationError("Chunk list for %s is corrupt" % hashval)
+    return (header[1], params, chunks)
+
+
+def compute_chunked_hash(
+    fname: str,
+    path_where_hashes_are_stored: Optional[str],
+    algorithm: str = DEFAULT_HASH_ALGORITHM,
+    params: ChunkParams = DEFAULT_CHUNK_PARAMS,
+) -> str:
+    """Chunk the file and return its entry value. The chunk list object is written
+    to :path_where_hashes_are_stored:, unless it is None (e.g. when just checking)."""
+    data = _format_chunk_list(algorithm, params, compute_chunks(fname, algorithm, params))
+    if path_where_hashes_are_stored is None:
+        hashval = hashlib.sha1(data).hexdigest()
+    else:
+        hashval, _ = _write_object(path_where_hashes_are_stored, data)
+    return CHUNKED_PREFIX + hashval
+
+
+class ChunkedHashFun:
+    """A hash function for generate_hashes() and check_hashes() which chunks
+    files of at least :min_file_size: bytes and hashes smaller files as a whole.
+    This is a class rather than a closure so that it can be sent to worker processes.
+    """
+
+    def __init__(
+        self,
+        path_where_hashes_are_stored: Optional[str],
+        algorithm: str = DEFAULT_HASH_ALGORITHM,
+        params: ChunkParams = DEFAULT_CHUNK_PARAMS,
+        min_file_size: int = CHUNKED_MIN_FILE_SIZE,
+    ):
+        get_hash_constructor(algorithm)  # validate the algorithm up-front
+        params.validate()
+        self.path_where_hashes_are_stored = path_where_hashes_are_stored
+        self.algorithm = algorithm
+        self.params = params
+        self.min_file_size = min_file_size
+
+    def __call__(self, fname: str) -> str:
+        if os.path.getsize(fname) < self.min_file_size:
+            return compute_hash(fname, algorithm=self.algorithm)
+        return compute_chunked_hash(
+            fname, self.path_where_hashes_are_stored, self.algorithm, self.params
+        )
+
+
+def changed_chunk_ranges(
+    basedir_where_hashes_are_stored: str, hashval1: str, hashval2: str
+) -> List[Tuple[int, int]]:
+    """Given the entries of two versions of a chunked file, return the (offset, length)
+    byte ranges of the second version whose chunks do not occur in the first version.
+    Adjacent ranges are merged."""
+    _, _, chunks1 = read_chunk_list(basedir_where_hashes_are_stored, hashval1)
+    _, _, chunks2 = read_chunk_list(basedir_where_hashes_are_stored, hashval2)
+    old_chunks = set(chunks1)
+    ranges = []  # type: List[Tuple[int, int]]
+    offset = 0
+    for chunk in chunks2:
+        if chunk not in old_chunks:
+            if len(ranges) > 0 and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + chunk[1])
+            else:
+                ranges.append((offset, chunk[1]))
+        offset += chunk[1]
+    return ranges
+
+
+# A tree object has one line per directory entry, sorted by name, of the form
+# HASH<tab>TYPE<tab>NAME, where TYPE is one of the following. For blobs, the
+# hash is the file hash (see get_hash_algorithm()), a reference to a chunk list,
+# or the size of the file.
 BLOB = "blob"
 TREE = "tree"
 TYPES = (BLOB, TREE)
 
 
+def _write_object(path_where_hashes_are_stored: str, data: bytes) -> Tuple[str, bool]:
+    """Write an object (tree or chunk list), named by its sha1 hash, unless it
+    is already present. Returns the hash and whether the object is new."""
+    hashval = hashlib.sha1(data).hexdigest()
+    objfile = os.path.join(path_where_hashes_are_stored, hashval)
+    if os.path.exists(objfile):
+        return (hashval, False)
+    # write to a temp file in the same directory and then rename
+    fd, tmpname = tempfile.mkstemp(dir=path_where_hashes_are_stored)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmpname, int("755", 8))
+    safe_rename(tmpname, objfile)
+    return (hashval, True)
+
+
+def _parse_tree_object(data: bytes) -> Dict[str, Tuple[str, str]]:
+    """Parse a tree object, raising a ValueError if it is malformed"""
+    entries = {}  # type: Dict[str, Tuple[str, str]]
+    # each entry ends with a newline; splitlines() would also split names
+    # containing other line boundaries (e.g. \x0b or \u2028)
+    lines = data.decode(locale.getpreferredencoding(False)).split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    for line in lines:
+        fields = line.split("\t")
+        if len(fields) != 3 or fields[1] not in TYPES or fields[2] in entries:
+            raise ValueError("Invalid tree entry %r" % line)
+        entries[fields[2]] = (fields[0], fields[1])
+    return entries
+
+
+class ObjectStore:
+    """Access to the objects stored in :basedir:. Objects are either loose
+    (a file named by the object's hash) or part of a pack (see
+    dataworkspaces.utils.pack_utils). Older snapshots only have loose objects.
+
+    Objects are written loose by default. Between start_pack() and finish_pack(),
+    new objects are instead appended to a single pack, so that a snapshot
+    adds two files rather than one file per directory.
+    """
+
+    def __init__(self, basedir: str):
+        self.basedir = basedir
+        self._packs = None  # type: Optional[List[PackReader]]
+        self._writer = None  # type: Optional[PackWriter]
+
+    def packs(self) -> List[PackReader]:
+        """Return the readers for the packs in the directory, opening them if needed"""
+        if self._packs is None:
+            names = sorted(os.listdir(self.basedir)) if os.path.isdir(self.basedir) else []
+            self._packs = [
+                PackReader(os.path.join(self.basedir, name))
+                for name in names
+                if is_pack_index(name)
+            ]
+        return self._packs
+
+    def __contains__(self, hashval: str) -> bool:
+        if self._writer is not None and hashval in self._writer:
+            return True
+        if os.path.exists(os.path.join(self.basedir, hashval)):
+            return True
+        return any(hashval in pack for pack in self.packs())
+
+    def read(self, hashval: str) -> bytes:
+        """Return the contents of the object. Raises FileNotFoundError if it is not present."""
+        try:
+            with open(os.path.join(self.basedir, hashval), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        for pack in self.packs():
+            data = pack.read(hashval)
+            if data is not None:
+                return data
+        raise FileNotFoundError("Object %s not found in %s" % (hashval, self.basedir))
+
+    def read_tree(self, treehash: str) -> Dict[str, Tuple[str, str]]:
+        """Read the tree object :treehash: and return a mapping from each entry's name
+        to a (hash, kind) pair."""
+        return _parse_tree_object(self.read(treehash))
+
+    def write(self, data: bytes) -> Tuple[str, bool]:
+        """Store the object, unless it is already present. Returns the hash and
+        whether the object is new."""
+        if self._writer is None and len(self.packs()) == 0:
+            return _write_object(self.basedir, data)
+        hashval = hashlib.sha1(data).hexdigest()
+        if hashval in self:
+            return (hashval, False)
+        elif self._writer is None:
+            return _write_object(self.basedir, data)
+        self._writer.add(hashval, data)
+        return (hashval, True)
+
+    def start_pack(self) -> None:
+        assert self._writer is None, "A pack is already being written"
+        self._writer = PackWriter(self.basedir)
+
+    def finish_pack(self) -> List[str]:
+        """Write out the pack started by start_pack() and return the paths of its
+        files (none, if there were no new objects)."""
+        assert self._writer is not None, "No pack is being written"
+        paths = self._writer.finish()
+        self._writer = None
+        self.close()  # the new pack is picked up the next time we look for packs
+        return paths
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+        if self._packs is not None:
+            for pack in self._packs:
+                pack.close()
+            self._packs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
 class HashEntry:
+    __slots__ = ("name", "sha")
+
     def __init__(self, name: str, sha: Optional[str]):
         self.name = name
         self.sha = sha
 
 
 class HashBlob(HashEntry):
+    __slots__ = ()
     type = BLOB
 
     def __init__(self, name: str, sha: str):
@@ -51,31 +408,34 @@ class HashBlob(HashEntry):
 
 
 class HashTree(HashEntry):
+    """The entries of a directory. Entries are kept in a dict keyed by name,
+    so that add, delete, and lookup are constant time. They are only sorted
+    when needed (for writing or indexing).
+    """
+
+    __slots__ = ("path", "entries", "_sorted_names", "hash", "is_new")
     type = TREE
 
-    def __init__(self, rootdir: str, name: str, add_to_git: bool = True):
+    def __init__(self, rootdir: str, name: str):
         super().__init__(name, None)
         self.path = rootdir
-        self.cache = []  # type: List[Tuple[str,str,str]]
-        self.add_to_git = add_to_git
-
-    def _index_by_name(self, name):
-        for i, t in enumerate(self.cache):
-            if t[2] == name:
-                return i
-        return -1
-
-    _map_id_to_type = {
-        BLOB: HashBlob
-        # HashTree is added at the end of the class
-    }  # type: Dict[str, Callable]
-
-    def _iter_convert_to_object(self, iterable: Iterable[Tuple[str, str, str]]):
-        for sha, mode, name in iterable:
-            try:
-                yield self._map_id_to_type[mode](sha, mode, name)
-            except KeyError:
-                raise TypeError("Unknown mode %s found in tree data for path '%s'" % (mode, name))
+        self.entries = {}  # type: Dict[str, Tuple[str,str]]
+        # cached result of sort(), reset whenever the entries change
+        self._sorted_names = None  # type: Optional[List[str]]
+        self.hash = None  # type: Optional[str]
+        # set by write() - True if the tree object did not already exist
+        self.is_new = False
+
+    def _make_entry(self, name: str) -> HashEntry:
+        (sha, mode) = self.entries[name]
+        if mode == BLOB:
+            return HashBlob(name, sha)
+        elif mode == TREE:
+            t = HashTree(os.path.join(self.path, name), name)
+            t.sha = sha
+            return t
+        else:
+            raise TypeError("Unknown mode %s found in tree data for path '%s'" % (mode, name))
 
     def trees(self):
         """return the list of direct subtrees"""
@@ -92,74 +452,389 @@ class HashTree(HashEntry):
            :sha:  hash
            :force: if true, overwrite previous entry
         """
-        item = (sha, mode, name)
-        index = self._index_by_name(name)
-        if index == -1:
-            # this name is not in the cache
-            self.cache.append(item)
-        else:
-            if force:
-                self.cache[index] = item
-            else:
-                prev_item = self.cache[index]
-                if prev_item[0] != sha or prev_item[1] != mode:
-                    raise ValueError("Item %r existed with different properties" % name)
+        prev_item = self.entries.get(name)
+        if prev_item is None:
+            self.entries[name] = (sha, mode)
+            self._sorted_names = None
+        elif force:
+            self.entries[name] = (sha, mode)
+        elif prev_item[0] != sha or prev_item[1] != mode:
+            raise ValueError("Item %r existed with different properties" % name)
 
     def __delitem__(self, name):
         """Deletes an item with the given name if it exists"""
-        index = self._index_by_name(name)
-        if index > -1:
-            del self.cache[index]
-
-    def sort(self):
-        """sort the cache in alphabetical order"""
-        self.cache.sort(key=(lambda t: t[2]))
-
-    def write(self):
-        self.sort()
-        # write to a temp file
-        fd, tmpname = tempfile.mkstemp()
-        with os.fdopen(fd, "w") as f:
-            for (mode, sha, name) in self.cache:
-                f.write("{}\t{}\t{}\n".format(mode, sha, name))
-        # hash the file
-        self.hash = compute_hash(tmpname)
-        # that is the name of the file
-        objfile = os.path.join(self.path, self.hash)
-        os.chmod(tmpname, int("755", 8))
-        safe_rename(tmpname, objfile)
-        if self.add_to_git:
-            call_subprocess([GIT_EXE_PATH, "add", self.hash], cwd=self.path, verbose=False)
+        if name in self.entries:
+            del self.entries[name]
+            self._sorted_names = None
+
+    def sort(self) -> List[str]:
+        """return the entry names in alphabetical order"""
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.entries.keys())
+        return self._sorted_names
+
+    def write(self, store: Optional[ObjectStore] = None) -> str:
+        """Write the tree object, named by its hash, to the tree's directory (or to
+        :store:, if provided), unless an object with that hash is already present.
+        Sets is_new accordingly. Adding the object to git is left to the caller, so
+        that all the new objects of a snapshot can be added at once.
+        """
+        entries = self.entries
+        data = "".join(
+            [
+                "{}\t{}\t{}\n".format(entries[name][0], entries[name][1], name)
+                for name in self.sort()
+            ]
+        ).encode(locale.getpreferredencoding(False))
+        if store is None:
+            self.hash, self.is_new = _write_object(self.path, data)
+        else:
+            self.hash, self.is_new = store.write(data)
         return self.hash
 
     # List protocol
-    def __getslice__(self, i, j):
-        return list(self._iter_convert_to_object(self.cache[i:j]))
-
     def __iter__(self):
-        return self._iter_convert_to_object(self.cache)
+        return (self._make_entry(name) for name in self.sort())
 
     def __len__(self):
-        return len(self.cache)
+        return len(self.entries)
 
     def __getitem__(self, item):
         if isinstance(item, int):
-            info = self.cache[item]
-            return self._map_id_to_type[info[1]](info[0], info[1], info[2])
+            return self._make_entry(self.sort()[item])
+        elif isinstance(item, slice):
+            return [self._make_entry(name) for name in self.sort()[item]]
         raise TypeError("Invalid index type: %r" % item)
 
     def __contains__(self, item):
         if isinstance(item, HashEntry):
-            for info in self.cache:
-                if item.sha == info[0]:
-                    return True
-        return False
+            entry = self.entries.get(item.name)
+            return entry is not None and entry[0] == item.sha
+        return item in self.entries
 
     def __reversed__(self):
-        return reversed(self._iter_convert_to_object(self.cache))
+        return (self._make_entry(name) for name in reversed(self.sort()))
+
+
+class FileHashCache:
+    """A persistent cache of file hashes, so that files which have not changed
+    since they were last hashed do not need to be read again. Entries are keyed
+    by the file's path relative to the root of the hashed directory and are
+    only used if the file's inode, size, mtime and ctime still match the values
+    recorded when the hash was computed. Any change to the stat data thus
+    automatically invalidates the entry.
+
+    The cache also records the hash, size and mtime of each file when a snapshot
+    is taken (see record_stats()). Only the most recent snapshot's values are
+    kept for each path. This lets a later check against that snapshot skip
+    files that still have the recorded size and mtime, even if they were copied
+    back with their timestamps preserved (which changes the inode and ctime).
+
+    The cache is stored in a sqlite database, usually in the resource's local
+    scratch space. If use_cached_hashes is False, the cache is not consulted,
+    but is still updated with the newly computed hashes.
+    """
+
+    # Files modified within this window before the cache was opened are not
+    # cached: a subsequent change might not be visible in their timestamps
+    # (same issue as git's "racy clean" index entries).
+    RACY_WINDOW_NS = 2 * 1000000000
+
+    def __init__(self, db_path: str, hash_type: str, use_cached_hashes: bool = True):
+        self.db_path = db_path
+        self.hash_type = hash_type
+        self.use_cached_hashes = use_cached_hashes
+        self.racy_cutoff_ns = int(time.time() * 1000000000) - self.RACY_WINDOW_NS
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "create table if not exists file_hashes (path text not null, "
+            + "hash_type text not null, inode integer not null, size integer not null, "
+            + "mtime_ns integer not null, ctime_ns integer not null, hash text not null, "
+            + "primary key (path, hash_type))"
+        )
+        self.conn.execute(
+            "create table if not exists snapshot_stats (path text not null, "
+            + "hash text not null, size integer not null, mtime_ns integer not null, "
+            + "primary key (path))"
+        )
+        self.updates = []  # type: List[Tuple[str, str, int, int, int, int, str]]
+        self.stat_updates = []  # type: List[Tuple[str, str, int, int]]
+
+    def get(self, relpath: str, st: os.stat_result) -> Optional[str]:
+        if not self.use_cached_hashes:
+            return None
+        row = self.conn.execute(
+            "select inode, size, mtime_ns, ctime_ns, hash from file_hashes "
+            + "where path=? and hash_type=?",
+            (relpath, self.hash_type),
+        ).fetchone()
+        if row is None:
+            return None
+        (inode, size, mtime_ns, ctime_ns, hashval) = row
+        if (
+            inode == st.st_ino
+            and size == st.st_size
+            and mtime_ns == st.st_mtime_ns
+            and ctime_ns == st.st_ctime_ns
+        ):
+            return hashval
+        return None
+
+    def put(self, relpath: str, st: os.stat_result, hashval: str) -> None:
+        if st.st_mtime_ns >= self.racy_cutoff_ns:
+            return
+        self.updates.append(
+            (
+                relpath,
+                self.hash_type,
+                st.st_ino,
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_ctime_ns,
+                hashval,
+            )
+        )
+        if len(self.updates) >= 10000:
+            self.flush()
+
+    def record_stats(self, relpath: str, st: os.stat_result, hashval: str) -> None:
+        """Record the size and mtime of a file that is part of a snapshot"""
+        if st.st_mtime_ns >= self.racy_cutoff_ns:
+            return
+        self.stat_updates.append((relpath, hashval, st.st_size, st.st_mtime_ns))
+        if len(self.stat_updates) >= 10000:
+            self.flush()
 
+    def matches_recorded_stats(self, relpath: str, st: os.stat_result, hashval: str) -> bool:
+        """Return True if the file's size and mtime are those recorded for it when
+        it had the hash :hashval:, so that it does not need to be rehashed."""
+        if not self.use_cached_hashes:
+            return False
+        row = self.conn.execute(
+            "select size, mtime_ns from snapshot_stats where path=? and hash=?",
+            (relpath, hashval),
+        ).fetchone()
+        return row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns
 
-HashTree._map_id_to_type[TREE] = HashTree
+    def flush(self) -> None:
+        if len(self.updates) > 0:
+            self.conn.executemany(
+                "insert or replace into file_hashes values (?, ?, ?, ?, ?, ?, ?)", self.updates
+            )
+            self.conn.commit()
+            self.updates = []
+        if len(self.stat_updates) > 0:
+            self.conn.executemany(
+                "insert or replace into snapshot_stats values (?, ?, ?, ?)", self.stat_updates
+            )
+            self.conn.commit()
+            self.stat_updates = []
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+
+class ChunkIndex:
+    """An index of the chunks of the chunked files of a resource, mapping each chunk's
+    hash to the file (and offset within it) where the chunk was first seen. This can be
+    used to tell which parts of a changed file are already stored elsewhere. Like the
+    FileHashCache, the index is a sqlite database kept in the resource's scratch space.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "create table if not exists chunks (hash text not null, "
+            + "hash_type text not null, size integer not null, path text not null, "
+            + "offset integer not null, primary key (hash, hash_type))"
+        )
+        self.conn.execute("create table if not exists chunk_lists (hash text primary key)")
+
+    def add_chunk_list(
+        self, relpath: str, basedir_where_hashes_are_stored: str, hashval: str
+    ) -> Optional[Tuple[int, int, int]]:
+        """Add the chunks of the chunked file entry :hashval: for the file at :relpath:.
+        Returns a tuple of the total number of chunks, the number of chunks not
+        previously in the index, and their size in bytes. If the chunk list was
+        already indexed, returns None."""
+        if (
+            self.conn.execute("select 1 from chunk_lists where hash=?", (hashval,)).fetchone()
+            is not None
+        ):
+            return None
+        algorithm, _, chunks = read_chunk_list(basedir_where_hashes_are_stored, hashval)
+        num_new = 0
+        new_bytes = 0
+        offset = 0
+        for h, size in chunks:
+            cursor = self.conn.execute(
+                "insert or ignore into chunks values (?, ?, ?, ?, ?)",
+                (h, algorithm, size, relpath, offset),
+            )
+            if cursor.rowcount > 0:
+                num_new += 1
+                new_bytes += size
+            offset += size
+        self.conn.execute("insert into chunk_lists values (?)", (hashval,))
+        return (len(chunks), num_new, new_bytes)
+
+    def lookup(self, chunk_hash: str, hash_type: str) -> Optional[Tuple[str, int, int]]:
+        """Return the (relative path, offset, size) where the chunk was first seen,
+        or None if the chunk is not in the index."""
+        row = self.conn.execute(
+            "select path, offset, size from chunks where hash=? and hash_type=?",
+            (chunk_hash, hash_type),
+        ).fetchone()
+        return cast(Tuple[str, int, int], tuple(row)) if row is not None else None
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+def _hash_batch(hash_fun: Callable[[str], str], paths: List[str]) -> List[str]:
+    return [hash_fun(path) for path in paths]
+
+
+class _PendingHashes:
+    """Hashes for the files of one directory, some of which may have been
+    found in the cache and some of which may still be in progress.
+    """
+
+    __slots__ = ("hashes", "missing", "stats", "work")
+
+    def __init__(self, hashes: List[Optional[str]], missing: List[int], stats: List[Any]):
+        self.hashes = hashes
+        self.missing = missing  # indexes of the files not found in the cache
+        self.stats = stats  # stat results for the missing files, if caching
+        self.work = []  # type: List[Any]
+
+
+class _FileHasher:
+    """Hash files either inline (num_workers=1) or by fanning the work out
+    to a bounded pool of workers. Threads are the default, as hashlib releases
+    the GIL while hashing. A process pool may be used instead, in which case
+    hash_fun must be picklable (e.g. a module-level function).
+
+    If a FileHashCache is provided, files whose stat data match the cache are
+    not read at all. Files are passed as os.DirEntry objects, so that the stat
+    data from the directory walk is reused. For size-based signatures
+    (compute_size), the size is taken directly from the stat data.
+
+    submit() returns the "pending" results for the files of a directory and
+    result() turns them into the list of hash values, in the same order as the
+    files. The results do not depend on the number of workers.
+    """
+
+    def __init__(
+        self,
+        hash_fun: Callable[[str], str],
+        num_workers: int = 1,
+        use_processes: bool = False,
+        cache: Optional[FileHashCache] = None,
+    ):
+        self.hash_fun = hash_fun
+        self.size_only = hash_fun is compute_size
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self.cache = cache
+        self.executor: Optional[Executor] = None
+        if num_workers > 1:
+            if use_processes:
+                self.executor = ProcessPoolExecutor(max_workers=num_workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def is_parallel(self) -> bool:
+        return self.executor is not None and not self.size_only
+
+    def max_queued_files(self) -> int:
+        return self.num_workers * MAX_QUEUED_FILES_PER_WORKER
+
+    def submit(self, dirpath: str, reldir: str, files: List[Any]) -> _PendingHashes:
+        """Start hashing the :files: (DirEntry objects) in the directory :dirpath:,
+        whose path relative to the root of the tree is :reldir:"""
+        if self.size_only:
+            sizes = [str(entry.stat().st_size) for entry in files]
+            return _PendingHashes(cast(List[Optional[str]], sizes), [], [])
+        if self.cache is None:
+            pending = _PendingHashes([None] * len(files), list(range(len(files))), [])
+        else:
+            pending = _PendingHashes([], [], [])
+            for i, entry in enumerate(files):
+                st = entry.stat()
+                h = self.cache.get(os.path.join(reldir, entry.name), st)
+                pending.hashes.append(h)
+                if h is None:
+                    pending.missing.append(i)
+                    pending.stats.append(st)
+        paths = [files[i].path for i in pending.missing]
+        timing_utils.count(
+            timing_utils.BYTES_READ, sum(files[i].stat().st_size for i in pending.missing)
+        )
+        if self.executor is None:
+            pending.work = [self.hash_fun(path) for path in paths]
+        elif self.use_processes:
+            pending.work = [
+                self.executor.submit(
+                    _hash_batch, self.hash_fun, paths[i : i + PROCESS_POOL_BATCH_SIZE]
+                )
+                for i in range(0, len(paths), PROCESS_POOL_BATCH_SIZE)
+            ]
+        else:
+            pending.work = [self.executor.submit(self.hash_fun, path) for path in paths]
+        return pending
+
+    def result(self, pending: _PendingHashes, reldir: str, files: List[Any]) -> List[str]:
+        if self.executor is None or self.size_only:
+            computed = pending.work  # type: List[str]
+        elif self.use_processes:
+            computed = []
+            for future in pending.work:
+                computed.extend(future.result())
+        else:
+            computed = [future.result() for future in pending.work]
+        hashes = pending.hashes
+        for (j, i) in enumerate(pending.missing):
+            hashes[i] = computed[j]
+            if self.cache is not None:
+                self.cache.put(os.path.join(reldir, files[i].name), pending.stats[j], computed[j])
+        return cast(List[str], hashes)
+
+    def hash_files(self, dirpath: str, reldir: str, files: List[Any]) -> List[str]:
+        return self.result(self.submit(dirpath, reldir, files), reldir, files)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _make_skip_dir(ignore: List[str], verbose: bool) -> Callable[[Any], bool]:
+    """The directories in :ignore: are skipped, wherever they occur in the tree."""
+
+    def skip_dir(entry: Any) -> bool:
+        if entry.name in ignore:
+            if verbose:
+                print("skipping %s" % entry.path)
+            return True
+        return False
+
+    return skip_dir
+
+
+def _relative_dir(root: str, local_dir: str) -> str:
+    reldir = os.path.relpath(root, local_dir)
+    return "" if reldir == "." else reldir
 
 
 def generate_hashes(
@@ -169,50 +844,315 @@ def generate_hashes(
     hash_fun: Callable[[str], str] = compute_hash,
     add_to_git: bool = True,
     verbose: bool = False,
+    num_workers: int = 1,
+    use_processes: bool = False,
+    cache: Optional[FileHashCache] = None,
+    chunk_index: Optional[ChunkIndex] = None,
+    packed: bool = False,
+    base_roothash: Optional[str] = None,
+    dirty_dirs: Optional[Dict[str, bool]] = None,
+    dir_mtimes: Optional[Dict[str, int]] = None,
 ) -> str:
     """traverse a directory tree rooted at :local_dir: and construct the tree hashes
-       in the directory :path_where_hashes_are_stored:
-       skip directories in :ignore:"""
+    in the directory :path_where_hashes_are_stored:
+    skip directories in :ignore:
+    If :packed: is True, the new tree objects are written to a single pack
+    rather than to one file each.
+    If :base_roothash: and :dirty_dirs: are provided, only the directories that
+    changed since the tree :base_roothash: was computed are walked: :dirty_dirs:
+    maps each changed directory (relative to :local_dir:) to whether its whole
+    subtree must be rescanned. The hashes of the other subtrees are taken from
+    the base tree (see utils/change_journal.py).
+    If :dir_mtimes: is provided, the mtime of each directory walked is added to it.
+    If :num_workers: is greater than one, the files are hashed by a pool of
+    that many threads (or processes, if :use_processes: is True). The resulting
+    tree objects are identical to those of the serial case.
+    If :cache: is provided, it is used to avoid rehashing unchanged files,
+    and the size and mtime of each file are recorded in it.
+    If :hash_fun: chunks files (see ChunkedHashFun), the chunk lists are
+    added to git along with the trees and to :chunk_index:, if provided."""
     hashtbl = {}  # type: Dict[str, str]
-    for root, dirs, files in os.walk(local_dir, topdown=False):
-        if os.path.basename(root) in ignore:
-            if verbose:
-                print("skipping %s" % root)
-            continue
-        if verbose:
-            print("generate_hashes: walk at %s" % root)
-            print("  files: %s" % ", ".join(files))
-            print("  dirs: %s" % ", ".join(dirs))
-        t = HashTree(path_where_hashes_are_stored, root, add_to_git=add_to_git)
-        for f in files:
-            # print(f)
+    new_objects = []  # type: List[str]
+    chunk_lists = set()  # type: Set[str]
+
+    def add_chunked_file(root, f, sha):
+        listhash = sha[len(CHUNKED_PREFIX) :]
+        if not os.path.exists(os.path.join(path_where_hashes_are_stored, listhash)):
+            # a cached entry whose chunk list was never committed (e.g. an
+            # earlier snapshot failed), so we need to write it again.
             sha = hash_fun(os.path.join(root, f))
-            t.add(f, BLOB, sha)
-        for dir in dirs:
-            # print(dir)
-            if dir in ignore:
-                if verbose:
-                    print("skipping dir %s under %s" % (dir, root))
-                continue
-            dirsha = hashtbl[os.path.join(root, dir)]
-            t.add(dir, TREE, dirsha)
-        h = t.write()
+            listhash = sha[len(CHUNKED_PREFIX) :]
+        chunk_lists.add(listhash)
+        if chunk_index is not None:
+            relpath = os.path.join(_relative_dir(root, local_dir), f)
+            counts = chunk_index.add_chunk_list(relpath, path_where_hashes_are_stored, sha)
+            if verbose and counts is not None:
+                print(
+                    "  %s: %d of %d chunks are new (%d bytes)"
+                    % (relpath, counts[1], counts[0], counts[2])
+                )
+        return sha
+
+    def write_tree(root, dirs, files, hashes):
+        t = HashTree(path_where_hashes_are_stored, root)
+        reldir = _relative_dir(root, local_dir)
+        for entry, sha in zip(files, hashes):
+            if is_chunked_hash(sha):
+                sha = add_chunked_file(root, entry.name, sha)
+            t.add(entry.name, BLOB, sha)
+            if cache is not None:
+                cache.record_stats(os.path.join(reldir, entry.name), entry.stat(), sha)
+        for entry in dirs:
+            t.add(entry.name, TREE, hashtbl.pop(entry.path))
+        for name, sha in reused.pop(reldir, []):
+            t.add(name, TREE, sha)
+        h = t.write(store)
+        if t.is_new:
+            new_objects.append(h)
         hashtbl[root] = h
+
+    # For an incremental walk: the ancestors of the dirty directories must be
+    # walked as well, since the hashes of their subtrees change. Clean subtrees
+    # are skipped and their hashes from the base tree are added to reused.
+    ignore_dir = _make_skip_dir(ignore, verbose)
+    reused = {}  # type: Dict[str, List[Tuple[str, str]]]
+    base_trees = {}  # type: Dict[str, Optional[Dict[str, Tuple[str, str]]]]
+    num_reused = [0]
+    incremental = base_roothash is not None and dirty_dirs is not None
+    walk_dirs = set([""])  # type: Set[str]
+    rescan_dirs = set()  # type: Set[str]
+    if incremental:
+        for reldir, recursive in cast(Dict[str, bool], dirty_dirs).items():
+            if recursive:
+                rescan_dirs.add(reldir)
+            while reldir not in walk_dirs:
+                walk_dirs.add(reldir)
+                reldir = os.path.dirname(reldir)
+
+    def get_base_tree(reldir):
+        # returns None if the directory is not in the base tree, so that it is walked
+        if reldir not in base_trees:
+            treehash = base_roothash  # type: Optional[str]
+            if reldir != "":
+                parent = get_base_tree(os.path.dirname(reldir))
+                entry = parent.get(os.path.basename(reldir)) if parent is not None else None
+                treehash = entry[0] if (entry is not None and entry[1] == TREE) else None
+            try:
+                base_trees[reldir] = store.read_tree(treehash) if treehash is not None else None
+            except FileNotFoundError:
+                base_trees[reldir] = None
+        return base_trees[reldir]
+
+    def needs_walk(reldir):
+        if reldir in walk_dirs:
+            return True
+        while True:
+            if reldir in rescan_dirs:
+                return True
+            if reldir == "":
+                return False
+            reldir = os.path.dirname(reldir)
+
+    def skip_dir(entry):
+        if ignore_dir(entry):
+            return True
+        reldir = _relative_dir(entry.path, local_dir)
+        if incremental and not needs_walk(reldir):
+            parent = os.path.dirname(reldir)
+            base_tree = get_base_tree(parent)
+            base_entry = base_tree.get(entry.name) if base_tree is not None else None
+            if base_entry is not None and base_entry[1] == TREE:
+                reused.setdefault(parent, []).append((entry.name, base_entry[0]))
+                num_reused[0] += 1
+                return True
+        if dir_mtimes is not None:
+            # taken before the directory is listed, so that a later change is noticed
+            dir_mtimes[reldir] = entry.stat(follow_symlinks=False).st_mtime_ns
+        return False
+
+    # Directories whose files are still being hashed, in the order they were
+    # visited. Since the walk is bottom-up, finishing them in FIFO order
+    # guarantees that subdirectories are written before their parents.
+    queued: Deque[Tuple[str, List[Any], List[Any], _PendingHashes]] = deque()
+    num_queued_files = 0
+    store = ObjectStore(path_where_hashes_are_stored)
+    if packed:
+        store.start_pack()
+    if dir_mtimes is not None:
+        dir_mtimes[""] = os.stat(local_dir).st_mtime_ns
+    with store, _FileHasher(hash_fun, num_workers, use_processes, cache) as hasher:
+        for root, dirs, files in walk_sorted(local_dir, topdown=False, skip_dir=skip_dir):
+            if verbose:
+                print("generate_hashes: walk at %s" % root)
+                print("  files: %s" % ", ".join([entry.name for entry in files]))
+                print("  dirs: %s" % ", ".join([entry.name for entry in dirs]))
+            pending = hasher.submit(root, _relative_dir(root, local_dir), files)
+            queued.append((root, dirs, files, pending))
+            num_queued_files += len(files)
+            while len(queued) > 0 and (
+                (not hasher.is_parallel()) or num_queued_files > hasher.max_queued_files()
+            ):
+                (q_root, q_dirs, q_files, q_pending) = queued.popleft()
+                num_queued_files -= len(q_files)
+                q_hashes = hasher.result(q_pending, _relative_dir(q_root, local_dir), q_files)
+                write_tree(q_root, q_dirs, q_files, q_hashes)
+        while len(queued) > 0:
+            (q_root, q_dirs, q_files, q_pending) = queued.popleft()
+            q_hashes = hasher.result(q_pending, _relative_dir(q_root, local_dir), q_files)
+            write_tree(q_root, q_dirs, q_files, q_hashes)
+        if packed:
+            new_objects = [os.path.basename(path) for path in store.finish_pack()]
+    if verbose and incremental:
+        print("generate_hashes: reused the hashes of %d unchanged subtrees" % num_reused[0])
+    if add_to_git:
+        # Register all the new objects with a single git call. We do not know
+        # which chunk lists are new, but adding an unchanged file is a no-op.
+        git_add_many(
+            path_where_hashes_are_stored, new_objects + sorted(chunk_lists), verbose=verbose
+        )
     return hashtbl[local_dir].strip()
 
 
-def _get_next_element(
-    dl: List[str], startindex: int, ignore: List[str], verbose: bool = False
-) -> Tuple[Optional[str], int]:
-    index = startindex
-    for d in dl[startindex:]:
-        index = index + 1
-        if d in ignore:
+def _name_mismatches(
+    root: str, reldir: str, kind: str, entries: List[Any], stored: List[Tuple[str, str]]
+) -> List[Tuple[str, str]]:
+    """Compare the names of the DirEntry objects to the stored (name, hash) pairs and
+    return a (path, message) pair for each name that is only in one of them."""
+    names = [entry.name for entry in entries]
+    stored_names = [name for (name, h) in stored]
+    if names == stored_names:
+        return []
+    extra = sorted(set(names).difference(stored_names))
+    missing = sorted(set(stored_names).difference(names))
+    return [
+        (
+            os.path.join(reldir, name),
+            "Hash mismatch for %s %s in directory %s: extra %s in directory, not in previous hash"
+            % (kind, name, root, kind),
+        )
+        for name in extra
+    ] + [
+        (
+            os.path.join(reldir, name),
+            "Hash mismatch for %s %s in directory %s: %s in previous hash, but not in directory"
+            % (kind, name, root, kind),
+        )
+        for name in missing
+    ]
+
+
+def iter_mismatches(
+    roothash: str,
+    basedir_where_hashes_are_stored: str,
+    local_dir: str,
+    ignore: List[str] = [],
+    hash_fun: Callable[[str], str] = compute_hash,
+    verbose: bool = False,
+    num_workers: int = 1,
+    use_processes: bool = False,
+    cache: Optional[FileHashCache] = None,
+) -> Generator[Tuple[str, str], None, None]:
+    """Traverse a directory tree rooted at :local_dir: and compare it to the tree
+    :roothash: kept in :basedir_where_hashes_are_stored:. Yields a (path, message)
+    pair for each difference, where path is relative to :local_dir:. Files and
+    directories that are missing on either side are reported, but not descended into.
+    Files are hashed lazily (unless hashing in parallel), so a caller that stops
+    at the first difference does not hash the rest of the tree.
+    See check_hashes() for the other parameters."""
+    if verbose:
+        print(
+            "Checking hashes. Root hash ",
+            roothash,
+            " hash directory ",
+            basedir_where_hashes_are_stored,
+        )
+
+    hashtbl = {local_dir: roothash}
+    store = ObjectStore(basedir_where_hashes_are_stored)
+    with store, _FileHasher(hash_fun, num_workers, use_processes, cache) as hasher:
+        for root, dirs, files in walk_sorted(
+            local_dir, topdown=True, skip_dir=_make_skip_dir(ignore, verbose)
+        ):
             if verbose:
-                print("_get_next_element: skipping %s" % d)
-            continue
-        return d, index
-    return None, -1
+                print("check_hashes: walk at root=%s" % root)
+                print("  files: %s" % ", ".join([entry.name for entry in files]))
+                print("  dirs: %s" % ", ".join([entry.name for entry in dirs]))
+            reldir = _relative_dir(root, local_dir)
+            treehash = hashtbl.pop(root)
+            try:
+                entries = store.read_tree(treehash)
+            except (OSError, ValueError, UnicodeDecodeError):
+                yield (reldir, "Hash tree %s not found or not readable" % treehash)
+                dirs[:] = []
+                continue
+            stored_files = []  # type: List[Tuple[str, str]]
+            stored_dirs = []  # type: List[Tuple[str, str]]
+            for name in sorted(entries.keys()):
+                h, kind = entries[name]
+                if kind == BLOB:
+                    stored_files.append((name, h))
+                else:
+                    stored_dirs.append((name, h))
+            # both lists are sorted by name, so we can compare them directly
+            mismatches = _name_mismatches(root, reldir, "file", files, stored_files)
+            mismatches.extend(_name_mismatches(root, reldir, "subdirectory", dirs, stored_dirs))
+            if len(mismatches) > 0:
+                yield from mismatches
+                # continue with the entries on both sides
+                file_names = set([entry.name for entry in files])
+                dir_names = set([entry.name for entry in dirs])
+                stored_file_names = set([name for (name, h) in stored_files])
+                stored_dir_names = set([name for (name, h) in stored_dirs])
+                files = [entry for entry in files if entry.name in stored_file_names]
+                stored_files = [(name, h) for (name, h) in stored_files if name in file_names]
+                dirs[:] = [entry for entry in dirs if entry.name in stored_dir_names]
+                stored_dirs = [(name, h) for (name, h) in stored_dirs if name in dir_names]
+            for entry, (name, h) in zip(dirs, stored_dirs):
+                hashtbl[entry.path] = h
+
+            # files that still have the size and mtime recorded for their stored hash
+            # are taken to be unchanged
+            to_hash = [
+                i
+                for (i, (f, h)) in enumerate(stored_files)
+                if cache is None
+                or not cache.matches_recorded_stats(os.path.join(reldir, f), files[i].stat(), h)
+            ]
+            if verbose and len(to_hash) < len(files):
+                print("  %d files match their recorded stats" % (len(files) - len(to_hash)))
+            if hasher.is_parallel():
+                hashes = dict(
+                    zip(to_hash, hasher.hash_files(root, reldir, [files[i] for i in to_hash]))
+                )  # type: Optional[Dict[int, str]]
+            else:
+                hashes = None  # hash lazily, so that we stop at the first mismatch
+            for i in to_hash:
+                f, h = stored_files[i]
+                sha = (
+                    hashes[i]
+                    if hashes is not None
+                    else hasher.hash_files(root, reldir, [files[i]])[0]
+                )
+                stored_algorithm = get_hash_algorithm(h)
+                if sha != h and stored_algorithm == CHUNKED:
+                    # The file may have been chunked with different parameters or
+                    # hash algorithm (or without chunking), so rechunk it the same way.
+                    sha = _recompute_chunked_hash(
+                        os.path.join(root, f), basedir_where_hashes_are_stored, h
+                    )
+                elif (
+                    sha != h
+                    and stored_algorithm is not None
+                    and get_hash_algorithm(sha) not in (None, stored_algorithm)
+                ):
+                    # The tree was written using a different hash algorithm (e.g. the
+                    # resource's hash_algorithm was changed after the snapshot was taken).
+                    sha = compute_hash(os.path.join(root, f), algorithm=stored_algorithm)
+                if sha != h:
+                    yield (
+                        os.path.join(reldir, f),
+                        "Hash mismatch for file: %s : %s and (hash says) %s" % (f, sha, h),
+                    )
 
 
 def check_hashes(
@@ -222,111 +1162,324 @@ def check_hashes(
     ignore: List[str] = [],
     hash_fun: Callable[[str], str] = compute_hash,
     verbose: bool = False,
+    num_workers: int = 1,
+    use_processes: bool = False,
+    cache: Optional[FileHashCache] = None,
 ) -> bool:
     """Traverse a directory tree rooted at :local_dir: and check that the files
-       match the hashes kept in :basedir_where_hashes_are_stored: and that no new
-       files have been added.
-       Ignore directories in :ignore:"""
-    hashfile = os.path.abspath(os.path.join(basedir_where_hashes_are_stored, roothash))
+    match the hashes kept in :basedir_where_hashes_are_stored: and that no new
+    files have been added. The first difference found is printed.
+    Ignore directories in :ignore:
+    If :num_workers: is greater than one, the files of each directory are
+    hashed by a pool of workers, as in generate_hashes(). If :cache: is
+    provided, unchanged files are not rehashed. This includes files whose
+    size and mtime match those recorded when the tree was generated."""
+    mismatches = iter_mismatches(
+        roothash,
+        basedir_where_hashes_are_stored,
+        local_dir,
+        ignore=ignore,
+        hash_fun=hash_fun,
+        verbose=verbose,
+        num_workers=num_workers,
+        use_processes=use_processes,
+        cache=cache,
+    )
+    try:
+        for path, message in mismatches:
+            print(message)
+            return False
+    finally:
+        mismatches.close()
+    return True
+
+
+def _recompute_chunked_hash(fname: str, basedir_where_hashes_are_stored: str, hashval: str) -> str:
+    try:
+        algorithm, params, _ = read_chunk_list(basedir_where_hashes_are_stored, hashval)
+    except (OSError, ConfigurationError) as e:
+        print("Unable to read chunk list for %s: %s" % (fname, e))
+        return ""
+    return compute_chunked_hash(fname, None, algorithm, params)
+
+
+def read_tree_object(
+    basedir_where_hashes_are_stored: str, treehash: str
+) -> Dict[str, Tuple[str, str]]:
+    """Read the tree object :treehash: and return a mapping from each entry's name
+    to a (hash, kind) pair."""
+    with ObjectStore(basedir_where_hashes_are_stored) as store:
+        return store.read_tree(treehash)
+
+
+def find_reachable_objects(
+    basedir_where_hashes_are_stored: str, roothashes: Iterable[str], verbose: bool = False
+) -> Set[str]:
+    """Return the names of all the objects (trees and chunk lists) that are
+    reachable from the trees :roothashes:. Missing trees are skipped with a
+    warning, as they cannot refer to anything."""
+    reachable = set()  # type: Set[str]
+    to_visit = [h for h in roothashes]
+    with ObjectStore(basedir_where_hashes_are_stored) as store:
+        while len(to_visit) > 0:
+            treehash = to_visit.pop()
+            if treehash in reachable:
+                continue
+            try:
+                entries = store.read_tree(treehash)
+            except FileNotFoundError:
+                print(
+                    "Warning: hash tree %s not found in %s"
+                    % (treehash, basedir_where_hashes_are_stored)
+                )
+                continue
+            reachable.add(treehash)
+            for h, kind in entries.values():
+                if kind == TREE:
+                    to_visit.append(h)
+                elif is_chunked_hash(h):
+                    reachable.add(h[len(CHUNKED_PREFIX) :])
     if verbose:
-        print("Checking hashes. Root hash ", roothash, " root hashfile ", hashfile)
-
-    hashtbl = {os.path.abspath(local_dir): hashfile}
-    for root, dirs, files in os.walk(local_dir, topdown=True):
-        if verbose:
-            print("check_hashes: walk at root=%s" % root)
-            print("  files: %s" % ", ".join(files))
-            print("  dirs: %s" % ", ".join(dirs))
-        if os.path.basename(root) in ignore:
-            if verbose:
-                print("ignoring %s" % root)
-            continue
+        print(
+            "Found %d reachable objects in %s" % (len(reachable), basedir_where_hashes_are_stored)
+        )
+    return reachable
+
+
+def verify_objects(
+    basedir_where_hashes_are_stored: str,
+    roothash: str,
+    verified: Set[str],
+    bad: Optional[Dict[str, str]] = None,
+) -> List[Tuple[str, str]]:
+    """Check that the tree :roothash: and all the objects reachable from it are
+    present, well formed, and not corrupted (i.e. their contents still hash to their
+    names). Returns a (path, message) pair for each problem, where path is relative
+    to the root of the tree.
+
+    The state in :verified: and :bad: is shared between calls, so that the objects
+    of several trees are only checked once. Objects in :verified: are intact, along
+    with everything reachable from them, and are skipped. :bad: maps the objects
+    found to be missing or damaged to their problem, which is reported again for
+    each tree that refers to them."""
+    problems = []  # type: List[Tuple[str, str]]
+    bad_objects = bad if bad is not None else {}  # type: Dict[str, str]
+
+    def report(hashval: str, path: str, message: str) -> None:
+        bad_objects[hashval] = message
+        problems.append((path, message))
+
+    def read_object(hashval: str, path: str, kind: str) -> Optional[bytes]:
         try:
+            data = store.read(hashval)
+        except OSError as e:
+            report(hashval, path, "Unable to read %s %s: %s" % (kind, hashval, e))
+            return None
+        actual = hashlib.sha1(data).hexdigest()
+        if actual != hashval:
+            report(hashval, path, "%s %s is corrupt, contents hash to %s" % (kind, hashval, actual))
+            return None
+        return data
+
+    def check_chunk_list(listhash: str, path: str) -> bool:
+        if listhash in verified:
+            return True
+        elif listhash in bad_objects:
+            problems.append((path, bad_objects[listhash]))
+            return False
+        data = read_object(listhash, path, "Chunk list")
+        if data is None:
+            return False
+        try:
+            _parse_chunk_list(CHUNKED_PREFIX + listhash, data)
+        except ConfigurationError as e:
+            report(listhash, path, str(e))
+            return False
+        verified.add(listhash)
+        return True
+
+    def check_tree(treehash: str, path: str) -> bool:
+        """Return True if the tree and all the objects reachable from it are intact"""
+        if treehash in verified:
+            return True
+        elif treehash in bad_objects:
+            problems.append((path, bad_objects[treehash]))
+            return False
+        data = read_object(treehash, path, "Tree object")
+        if data is None:
+            return False
+        try:
+            entries = _parse_tree_object(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            report(treehash, path, "Tree object %s is malformed: %s" % (treehash, e))
+            return False
+        ok = True
+        for name in sorted(entries.keys()):
+            h, kind = entries[name]
+            child = os.path.join(path, name)
+            if kind == TREE:
+                ok = check_tree(h, child) and ok
+            elif is_chunked_hash(h):
+                ok = check_chunk_list(h[len(CHUNKED_PREFIX) :], child) and ok
+        # a tree with damaged descendants is checked again for each tree referring
+        # to it, so that their problems are reported with the right paths
+        if ok:
+            verified.add(treehash)
+        return ok
+
+    with ObjectStore(basedir_where_hashes_are_stored) as store:
+        check_tree(roothash, "")
+    return problems
+
+
+def repack_objects(
+    basedir_where_hashes_are_stored: str, index_paths: List[str], keep: Set[str]
+) -> List[str]:
+    """Copy the objects in :keep: from the packs with the given index files to a
+    single new pack and return the paths of its files (none, if nothing was kept).
+    The old packs are left in place for the caller to remove."""
+    writer = PackWriter(basedir_where_hashes_are_stored)
+    try:
+        for index_path in index_paths:
+            pack = PackReader(index_path)
             try:
-                hashfile = hashtbl[os.path.abspath(root)]
-            except KeyError as k:
-                print("Key Error:", k)
-                print("Hashtbl is\n", hashtbl)
-                assert 0, "key error in hash table at %s" % root
-            try:
-                fd = open(hashfile, "r")
-            except:
-                print("File %s not found or not readable" % hashfile)
-                return False
+                for hashval in pack:
+                    if hashval in keep:
+                        writer.add(hashval, cast(bytes, pack.read(hashval)))
+            finally:
+                pack.close()
+        return writer.finish()
+    except:
+        writer.abort()
+        raise
 
-            dirs.sort()
-            files.sort()
 
-            f_index = 0
-            d_index = 0
-            for line in fd.readlines():
-                line = line.rstrip("\n")
-                h, kind, name = line.split("\t")
-                # print("Line from hash file ", h, kind, name)
-                if kind == BLOB:
-                    f, f_index = _get_next_element(files, f_index, ignore, verbose=verbose)
-                    if verbose:
-                        print("f = ", f, " name =", name)
-                    if f != name or (f is None):
-                        print("File mismatch:", f, " and (hash says)", name)
-                        return False
-                    sha = hash_fun(os.path.join(root, f))
-                    if sha != h:
-                        print("Hash mismatch for file: ", f, ":", sha, " and (hash says)", h)
-                        return False
-                elif kind == TREE:
-                    d, d_index = _get_next_element(dirs, d_index, ignore, verbose=verbose)
-                    if verbose:
-                        print("d = ", d, " name = ", name)
-                    if (d != name) or (d is None):
-                        print("Dir mismatch: ", d, " and (hash says)", name)
-                        return False
-                    hashtbl[os.path.abspath(os.path.join(root, d))] = os.path.join(
-                        basedir_where_hashes_are_stored, h
-                    )
-                else:
-                    assert kind == TREE or kind == BLOB
-            # Make sure that there are no extra files at end of list
-            f, f_index = _get_next_element(files, f_index, ignore, verbose=verbose)
-            if f is not None:
-                print(
-                    "Hash mismatch for file %s in directory %s: extra file in directory, not in previous hash"
-                    % (f, root)
-                )
-                return False
-            d, d_index = _get_next_element(dirs, d_index, ignore, verbose=verbose)
-            if d is not None:
-                print(
-                    "Hash mismatch for subdirectory %s in directory %s: extra subdirectory, not in previous hash"
-                    % (d, root)
-                )
-                return False
-        finally:
-            fd.close()
-    return True
+def _list_files_in_tree(store: ObjectStore, treehash: str, prefix: str, paths: List[str]) -> None:
+    for name, (h, kind) in sorted(store.read_tree(treehash).items()):
+        if kind == TREE:
+            _list_files_in_tree(store, h, prefix + name + "/", paths)
+        else:
+            paths.append(prefix + name)
+
+
+def diff_hashes(
+    roothash1: str, roothash2: str, basedir_where_hashes_are_stored: str
+) -> Tuple[List[str], List[str], List[str]]:
+    """Compare the trees rooted at :roothash1: and :roothash2: and return a tuple
+    of the (added, removed, modified) file paths, relative to the root and sorted.
+    Only the stored tree objects are read, not the files themselves. We only
+    descend into subtrees whose hashes differ, so the time taken is proportional
+    to the size of the change rather than the size of the tree."""
+    added = []  # type: List[str]
+    removed = []  # type: List[str]
+    modified = []  # type: List[str]
+
+    def diff_trees(treehash1: str, treehash2: str, prefix: str) -> None:
+        entries1 = store.read_tree(treehash1)
+        entries2 = store.read_tree(treehash2)
+        for name in sorted(set(entries1.keys()).union(entries2.keys())):
+            path = prefix + name
+            e1 = entries1.get(name)
+            e2 = entries2.get(name)
+            if e1 == e2:
+                continue
+            elif e1 is not None and e2 is not None and e1[1] == TREE and e2[1] == TREE:
+                diff_trees(e1[0], e2[0], path + "/")
+            elif e1 is not None and e2 is not None and e1[1] == BLOB and e2[1] == BLOB:
+                modified.append(path)
+            else:
+                # added, removed, or changed from a file to a directory (or vice versa)
+                if e1 is not None:
+                    if e1[1] == TREE:
+                        _list_files_in_tree(store, e1[0], path + "/", removed)
+                    else:
+                        removed.append(path)
+                if e2 is not None:
+                    if e2[1] == TREE:
+                        _list_files_in_tree(store, e2[0], path + "/", added)
+                    else:
+                        added.append(path)
+
+    if roothash1 != roothash2:
+        with ObjectStore(basedir_where_hashes_are_stored) as store:
+            diff_trees(roothash1, roothash2, "")
+    return (sorted(added), sorted(removed), sorted(modified))
 
 
 def generate_sha_signature(
-    rsrcdir: str, localpath: str, ignore: List[str] = [], verbose: bool = False
+    rsrcdir: str,
+    localpath: str,
+    ignore: List[str] = [],
+    verbose: bool = False,
+    num_workers: int = 1,
+    cache: Optional[FileHashCache] = None,
+    algorithm: str = DEFAULT_HASH_ALGORITHM,
+    chunked: bool = False,
+    chunk_index: Optional[ChunkIndex] = None,
+    packed: bool = False,
+    base_roothash: Optional[str] = None,
+    dirty_dirs: Optional[Dict[str, bool]] = None,
+    dir_mtimes: Optional[Dict[str, int]] = None,
 ) -> str:
     return generate_hashes(
-        rsrcdir, localpath, ignore=ignore, hash_fun=compute_hash, verbose=verbose
+        rsrcdir,
+        localpath,
+        ignore=ignore,
+        hash_fun=ChunkedHashFun(rsrcdir, algorithm) if chunked else make_hash_fun(algorithm),
+        verbose=verbose,
+        num_workers=num_workers,
+        cache=cache,
+        chunk_index=chunk_index,
+        packed=packed,
+        base_roothash=base_roothash,
+        dirty_dirs=dirty_dirs,
+        dir_mtimes=dir_mtimes,
     )
 
 
 def check_sha_signature(
-    hashval: str, rsrdir: str, localpath: str, ignore: List[str] = [], verbose: bool = False
+    hashval: str,
+    rsrdir: str,
+    localpath: str,
+    ignore: List[str] = [],
+    verbose: bool = False,
+    num_workers: int = 1,
+    cache: Optional[FileHashCache] = None,
+    algorithm: str = DEFAULT_HASH_ALGORITHM,
+    chunked: bool = False,
 ) -> bool:
     return check_hashes(
-        hashval, rsrdir, localpath, ignore=ignore, hash_fun=compute_hash, verbose=verbose
+        hashval,
+        rsrdir,
+        localpath,
+        ignore=ignore,
+        hash_fun=ChunkedHashFun(None, algorithm) if chunked else make_hash_fun(algorithm),
+        verbose=verbose,
+        num_workers=num_workers,
+        cache=cache,
     )
 
 
 def generate_size_signature(
-    rsrcdir: str, localpath: str, ignore: List[str] = [], verbose: bool = False
+    rsrcdir: str,
+    localpath: str,
+    ignore: List[str] = [],
+    verbose: bool = False,
+    packed: bool = False,
+    base_roothash: Optional[str] = None,
+    dirty_dirs: Optional[Dict[str, bool]] = None,
+    dir_mtimes: Optional[Dict[str, int]] = None,
 ) -> str:
     return generate_hashes(
-        rsrcdir, localpath, ignore=ignore, hash_fun=compute_size, verbose=verbose
+        rsrcdir,
+        localpath,
+        ignore=ignore,
+        hash_fun=compute_size,
+        verbose=verbose,
+        packed=packed,
+        base_roothash=base_roothash,
+        dirty_dirs=dirty_dirs,
+        dir_mtimes=dir_mtimes,
     )
 
 
@@ -4,8 +4,8 @@ Resource for files living in a local directory
 """
 from errno import EEXIST
 import os
-from os.path import join, exists, isdir
-from typing import List, Pattern, Tuple, Optional, Set, Union, cast
+from os.path import join, exists, isdir, basename
+from typing import Callable, Dict, List, Pattern, Tuple, Optional, Set, Union, cast
 import json
 import shutil
 
@@ -14,7 +14,23 @@ import click
 from dataworkspaces.errors import ConfigurationError
 from dataworkspaces.utils.subprocess_utils import call_subprocess
 from dataworkspaces.utils.file_utils import does_subpath_exist, LocalPathType
-from dataworkspaces.utils.git_utils import GIT_EXE_PATH, is_git_staging_dirty
+from dataworkspaces.utils.git_utils import (
+    GIT_EXE_PATH,
+    is_git_staging_dirty,
+    git_add_many,
+    git_remove_many,
+    get_git_repo_lock,
+)
+from dataworkspaces.utils.hash_utils import is_a_git_hash
+from dataworkspaces.utils.pack_utils import is_pack_index, pack_files, INDEX_RECORD_SIZE
+from dataworkspaces.utils.change_journal import (
+    ChangeJournal,
+    Watcher,
+    InotifyWatcher,
+    InotifyWatchesExhausted,
+    ScanWatcher,
+    is_inotify_available,
+)
 from dataworkspaces.workspace import (
     Workspace,
     Resource,
@@ -22,6 +38,12 @@ from dataworkspaces.workspace import (
     FileResourceMixin,
     SnapshotResourceMixin,
     SnapshotWorkspaceMixin,
+    FileDiffResourceMixin,
+    FileDiff,
+    GarbageCollectionResourceMixin,
+    UnreachableObjects,
+    IntegrityCheckResourceMixin,
+    ChangeJournalResourceMixin,
     JSONDict,
     JSONList,
     ResourceFactory,
@@ -32,10 +54,19 @@ from dataworkspaces.utils.snapshot_utils import (
     copy_current_files_local_fs,
 )
 import dataworkspaces.backends.git as git_backend
-from dataworkspaces.utils.param_utils import StringType, BoolType
+from dataworkspaces.utils.param_utils import (
+    StringType,
+    BoolType,
+    IntType,
+    EnumType,
+    LOCAL_FILES_HASH_WORKERS,
+)
 
 
 LOCAL_FILE = "file"
+HASH_CACHE_FILENAME = "hash_cache.sqlite"
+CHUNK_INDEX_FILENAME = "chunk_index.sqlite"
+CHANGE_JOURNAL_FILENAME = "change_journal.sqlite"
 
 
 def _relative_rsrc_dir_for_git_workspace(role, name):
@@ -43,7 +74,14 @@ def _relative_rsrc_dir_for_git_workspace(role, name):
 
 
 class LocalFileResource(
-    Resource, LocalStateResourceMixin, FileResourceMixin, SnapshotResourceMixin
+    Resource,
+    LocalStateResourceMixin,
+    FileResourceMixin,
+    SnapshotResourceMixin,
+    FileDiffResourceMixin,
+    GarbageCollectionResourceMixin,
+    IntegrityCheckResourceMixin,
+    ChangeJournalResourceMixin,
 ):
     def __init__(
         self,
@@ -56,6 +94,9 @@ class LocalFileResource(
         export: bool,
         imported: bool,
         ignore: List[str] = [],
+        hash_workers: Optional[int] = None,
+        hash_algorithm: str = hashtree.DEFAULT_HASH_ALGORITHM,
+        chunked_hashing: bool = False,
     ):
         super().__init__(LOCAL_FILE, name, role, workspace)
         self.param_defs.define(
@@ -94,6 +135,28 @@ class LocalFileResource(
             ptype=BoolType(),
         )
         self.compute_hash = self.param_defs.get("compute_hash", compute_hash)  # type: bool
+        self.param_defs.define(
+            "hash_algorithm",
+            default_value=hashtree.DEFAULT_HASH_ALGORITHM,
+            optional=False,
+            is_global=True,
+            help="Algorithm used to hash files when compute_hash is True. The xxh3 and blake3 "
+            + "algorithms require the xxhash and blake3 packages, respectively. "
+            + "Changing this does not invalidate existing snapshots.",
+            ptype=EnumType(*hashtree.HASH_ALGORITHMS),
+        )
+        self.hash_algorithm = self.param_defs.get("hash_algorithm", hash_algorithm)  # type: str
+        self.param_defs.define(
+            "chunked_hashing",
+            default_value=False,
+            optional=True,
+            is_global=True,
+            help="If True (and compute_hash is True), large files are split into content-defined "
+            + "chunks that are hashed individually, so that the changed parts of a file can be "
+            + "identified. Installing numpy makes chunking much faster.",
+            ptype=BoolType(),
+        )
+        self.chunked_hashing = self.param_defs.get("chunked_hashing", chunked_hashing)  # type: bool
         self.param_defs.define(
             "export",
             default_value=False,
@@ -112,7 +175,20 @@ class LocalFileResource(
             ptype=BoolType(),
         )
         self.imported = self.param_defs.get("imported", imported)  # type: bool
+        self.param_defs.define(
+            "hash_workers",
+            default_value=None,
+            optional=True,
+            is_global=False,
+            help="Number of worker threads used to hash files for this instance of the workspace. "
+            + "If not specified, uses the workspace's %s parameter." % LOCAL_FILES_HASH_WORKERS,
+            ptype=IntType(min_value=1),
+        )
+        self.hash_workers = self.param_defs.get(
+            "hash_workers", hash_workers
+        )  # type: Optional[int]
         self.ignore = ignore  # TODO: should this be a parameter?
+        self.use_hash_cache = True
         if isinstance(workspace, git_backend.Workspace):
             # if the workspace is a git repo, then we can store our
             # hash files there.
@@ -207,7 +283,73 @@ class LocalFileResource(
                 ) from e
 
     def get_local_params(self) -> JSONDict:
-        return {"local_path": self.my_local_path}
+        return {"local_path": self.my_local_path, "hash_workers": self.hash_workers}
+
+    def _get_num_hash_workers(self) -> int:
+        if self.hash_workers is not None:
+            return self.hash_workers
+        return self.workspace.get_global_param(LOCAL_FILES_HASH_WORKERS)
+
+    def _open_hash_cache(self) -> Optional[hashtree.FileHashCache]:
+        """The hash cache is kept in the resource's local scratch space, as the
+        stat data it is keyed on is only meaningful for this copy of the files.
+        Size-based signatures do not need a cache, so we return None in that case.
+        """
+        if not self.compute_hash:
+            return None
+        # resources added by earlier versions do not have a scratch space yet
+        scratch_dir = self.workspace._get_local_scratch_space_for_resource(
+            self.name, create_if_not_present=True
+        )
+        return hashtree.FileHashCache(
+            join(scratch_dir, HASH_CACHE_FILENAME),
+            hash_type=(
+                hashtree.CHUNKED + "-" + self.hash_algorithm
+                if self.chunked_hashing
+                else self.hash_algorithm
+            ),
+            use_cached_hashes=self.use_hash_cache,
+        )
+
+    def _open_chunk_index(self) -> Optional[hashtree.ChunkIndex]:
+        if not (self.compute_hash and self.chunked_hashing):
+            return None
+        scratch_dir = self.workspace._get_local_scratch_space_for_resource(
+            self.name, create_if_not_present=True
+        )
+        return hashtree.ChunkIndex(join(scratch_dir, CHUNK_INDEX_FILENAME))
+
+    def _open_change_journal(self, create: bool = False) -> Optional[ChangeJournal]:
+        """The change journal is maintained by the watch command. Returns None if
+        there is no journal and :create: is False."""
+        scratch_dir = self.workspace._get_local_scratch_space_for_resource(
+            self.name, create_if_not_present=True
+        )
+        journal_path = join(scratch_dir, CHANGE_JOURNAL_FILENAME)
+        if not (create or exists(journal_path)):
+            return None
+        return ChangeJournal(journal_path)
+
+    def start_watcher(self, use_inotify: bool = True, scan_interval: float = 60.0) -> Watcher:
+        """Start watching the resource's files for changes, to be recorded in the change
+        journal. Falls back to periodic scans if inotify is not available."""
+        journal = cast(ChangeJournal, self._open_change_journal(create=True))
+        verbose = self.workspace.verbose
+
+        def skip_dir(entry):
+            return entry.name in self.ignore
+
+        if use_inotify and is_inotify_available():
+            try:
+                return InotifyWatcher(self.local_path, journal, skip_dir, verbose)
+            except InotifyWatchesExhausted as e:
+                click.echo(
+                    "%s, falling back to scanning for resource %s" % (e, self.name), err=True
+                )
+        return ScanWatcher(self.local_path, journal, skip_dir, verbose, interval=scan_interval)
+
+    def bypass_caches(self) -> None:
+        self.use_hash_cache = False
 
     def pull_precheck(self) -> None:
         """Nothing to do, since we donot support sync.
@@ -230,47 +372,166 @@ class LocalFileResource(
         pass
 
     def snapshot_precheck(self) -> None:
-        pass
+        if self.compute_hash:
+            # raises a ConfigurationError if the algorithm's package is not installed
+            hashtree.get_hash_constructor(self.hash_algorithm)
 
     def snapshot(self) -> Tuple[Optional[str], Optional[str]]:
-        if self.compute_hash:
-            h = hashtree.generate_sha_signature(
-                self.rsrcdir, self.local_path, ignore=self.ignore, verbose=self.workspace.verbose
-            )
-        else:
-            h = hashtree.generate_size_signature(
-                self.rsrcdir, self.local_path, ignore=self.ignore, verbose=self.workspace.verbose
+        # If a watcher has been running since the last snapshot, only the directories
+        # in its journal need to be walked.
+        journal = self._open_change_journal()
+        session = journal.get_active_session() if journal is not None else None
+        base_roothash = None  # type: Optional[str]
+        dirty_dirs = None  # type: Optional[Dict[str, bool]]
+        dir_mtimes = None  # type: Optional[Dict[str, int]]
+        if journal is not None and session is not None:
+            dir_mtimes = {}
+            base_roothash = journal.get_base(session)
+            if base_roothash is not None and not journal.sync():
+                click.echo(
+                    "Watcher for resource %s did not respond, rescanning all files" % self.name,
+                    err=True,
+                )
+                base_roothash = None
+            if base_roothash is not None:
+                num_missed = journal.verify_dir_mtimes(self.local_path)
+                if num_missed > 0:
+                    click.echo(
+                        "Rescanning %d directories of resource %s with changes the watcher missed"
+                        % (num_missed, self.name),
+                        err=True,
+                    )
+                max_seq, dirty_dirs = journal.get_dirty()
+            else:
+                max_seq = journal.get_last_seq()
+        if (
+            isinstance(self.workspace, git_backend.Workspace)
+            and self.workspace.snapshot_transaction is not None
+        ):
+            # the new hash files are staged, so they must be unstaged if the snapshot fails
+            self.workspace.snapshot_transaction.record_staged(
+                _relative_rsrc_dir_for_git_workspace(self.role, self.name)
             )
-        assert os.path.exists(os.path.join(self.rsrcdir, h))
-        if isinstance(self.workspace, git_backend.Workspace):
+        try:
+            h = self._generate_signature(base_roothash, dirty_dirs, dir_mtimes)
+            if journal is not None and session is not None:
+                journal.snapshot_taken(h, session, max_seq, cast(Dict[str, int], dir_mtimes))
+        finally:
+            if journal is not None:
+                journal.close()
+        with hashtree.ObjectStore(self.rsrcdir) as store:
+            assert h in store
+        # Within a snapshot transaction, the staged hash files are committed along
+        # with the snapshot metadata.
+        if (
+            isinstance(self.workspace, git_backend.Workspace)
+            and self.workspace.snapshot_transaction is None
+        ):
             workspace_path = self.workspace.get_workspace_local_path_if_any()
             assert workspace_path is not None
-            if is_git_staging_dirty(
-                workspace_path, subdir=_relative_rsrc_dir_for_git_workspace(self.role, self.name)
-            ):
-                call_subprocess(
-                    [
-                        GIT_EXE_PATH,
-                        "commit",
-                        "-m",
-                        "Add snapshot hash files for resource %s" % self.name,
-                    ],
-                    cwd=workspace_path,
-                    verbose=self.workspace.verbose,
-                )
+            rsrc_subdir = _relative_rsrc_dir_for_git_workspace(self.role, self.name)
+            with get_git_repo_lock(workspace_path):
+                if is_git_staging_dirty(workspace_path, subdir=rsrc_subdir):
+                    # only commit this resource's files, as other resources being
+                    # snapshotted concurrently may have staged theirs
+                    call_subprocess(
+                        [
+                            GIT_EXE_PATH,
+                            "commit",
+                            "-m",
+                            "Add snapshot hash files for resource %s" % self.name,
+                            "--",
+                            rsrc_subdir,
+                        ],
+                        cwd=workspace_path,
+                        verbose=self.workspace.verbose,
+                    )
         return (h, None)
 
-    def restore_precheck(self, hashval):
-        # TODO: look at handling of restore - we probably want to do a compare and error out if
-        # different. This would mean passing in both the compare and restore hashes.
+    def supports_concurrent_snapshot(self) -> bool:
+        return True
+
+    def has_changed_since(self, previous_compare_hash: str) -> bool:
+        # Without walking the files, only a watcher's journal can tell us that
+        # nothing has changed since it took the previous snapshot.
+        journal = self._open_change_journal()
+        if journal is None:
+            return True
+        try:
+            session = journal.get_active_session()
+            if (
+                session is None
+                or journal.get_base(session) != previous_compare_hash
+                or not journal.sync()
+            ):
+                return True
+            journal.verify_dir_mtimes(self.local_path)
+            return len(journal.get_dirty()[1]) > 0
+        finally:
+            journal.close()
+
+    def _generate_signature(
+        self,
+        base_roothash: Optional[str],
+        dirty_dirs: Optional[Dict[str, bool]],
+        dir_mtimes: Optional[Dict[str, int]],
+    ) -> str:
         if self.compute_hash:
-            rc = hashtree.check_sha_signature(
-                hashval,
+            cache = self._open_hash_cache()
+            chunk_index = self._open_chunk_index()
+            try:
+                return hashtree.generate_sha_signature(
+                    self.rsrcdir,
+                    self.local_path,
+                    ignore=self.ignore,
+                    verbose=self.workspace.verbose,
+                    num_workers=self._get_num_hash_workers(),
+                    cache=cache,
+                    algorithm=self.hash_algorithm,
+                    chunked=self.chunked_hashing,
+                    chunk_index=chunk_index,
+                    packed=True,
+                    base_roothash=base_roothash,
+                    dirty_dirs=dirty_dirs,
+                    dir_mtimes=dir_mtimes,
+                )
+            finally:
+                if cache is not None:
+                    cache.close()
+                if chunk_index is not None:
+                    chunk_index.close()
+        else:
+            return hashtree.generate_size_signature(
                 self.rsrcdir,
                 self.local_path,
                 ignore=self.ignore,
                 verbose=self.workspace.verbose,
+                packed=True,
+                base_roothash=base_roothash,
+                dirty_dirs=dirty_dirs,
+                dir_mtimes=dir_mtimes,
             )
+
+    def restore_precheck(self, hashval):
+        # TODO: look at handling of restore - we probably want to do a compare and error out if
+        # different. This would mean passing in both the compare and restore hashes.
+        if self.compute_hash:
+            cache = self._open_hash_cache()
+            try:
+                rc = hashtree.check_sha_signature(
+                    hashval,
+                    self.rsrcdir,
+                    self.local_path,
+                    ignore=self.ignore,
+                    verbose=self.workspace.verbose,
+                    num_workers=self._get_num_hash_workers(),
+                    cache=cache,
+                    algorithm=self.hash_algorithm,
+                    chunked=self.chunked_hashing,
+                )
+            finally:
+                if cache is not None:
+                    cache.close()
         else:
             rc = hashtree.check_size_signature(
                 hashval,
@@ -297,6 +558,102 @@ class LocalFileResource(
                 )
             shutil.rmtree(snapshot_dir_path)
 
+    def diff_snapshots(self, compare_hash1: str, compare_hash2: str) -> FileDiff:
+        with hashtree.ObjectStore(self.rsrcdir) as store:
+            for h in (compare_hash1, compare_hash2):
+                if h not in store:
+                    raise ConfigurationError(
+                        "Hash tree %s for resource %s not found in %s"
+                        % (h, self.name, self.rsrcdir)
+                    )
+        added, removed, modified = hashtree.diff_hashes(compare_hash1, compare_hash2, self.rsrcdir)
+        return FileDiff(added, removed, modified)
+
+    def find_unreachable_objects(self, live_hashes: Set[str]) -> UnreachableObjects:
+        if not isdir(self.rsrcdir):
+            return UnreachableObjects([], 0, 0)
+        reachable = hashtree.find_reachable_objects(
+            self.rsrcdir, live_hashes, verbose=self.workspace.verbose
+        )
+        paths = []  # type: List[str]
+        num_objects = 0
+        num_bytes = 0
+        with hashtree.ObjectStore(self.rsrcdir) as store:
+            # a pack is removed if any of its objects are unreachable, the rest are repacked
+            for pack in store.packs():
+                sizes = [size for (hashval, size) in pack.iter_sizes() if hashval not in reachable]
+                if len(sizes) == 0:
+                    continue
+                paths.extend(pack_files(pack.index_path))
+                num_objects += len(sizes)
+                if len(sizes) == pack.num_objects:
+                    num_bytes += sum(
+                        [os.stat(path).st_size for path in pack_files(pack.index_path)]
+                    )
+                else:
+                    num_bytes += sum(sizes) + len(sizes) * INDEX_RECORD_SIZE
+        # loose objects are named by their hash, anything else (e.g. a temporary
+        # file) is left alone
+        for name in sorted(os.listdir(self.rsrcdir)):
+            if is_a_git_hash(name) and name not in reachable:
+                path = join(self.rsrcdir, name)
+                paths.append(path)
+                num_objects += 1
+                num_bytes += os.stat(path).st_size
+        return UnreachableObjects(paths, num_objects, num_bytes)
+
+    def remove_objects(self, paths: List[str], live_hashes: Set[str]) -> None:
+        old_packs = [path for path in paths if is_pack_index(basename(path))]
+        new_files = []  # type: List[str]
+        if len(old_packs) > 0:
+            reachable = hashtree.find_reachable_objects(self.rsrcdir, live_hashes)
+            new_files = hashtree.repack_objects(self.rsrcdir, old_packs, reachable)
+            # in case the new pack is identical to one of the old ones
+            paths = [path for path in paths if path not in new_files]
+        if isinstance(self.workspace, git_backend.Workspace):
+            workspace_path = self.workspace.get_workspace_local_path_if_any()
+            assert workspace_path is not None
+            git_remove_many(
+                workspace_path,
+                [os.path.relpath(path, workspace_path) for path in paths],
+                verbose=self.workspace.verbose,
+            )
+            git_add_many(
+                workspace_path,
+                [os.path.relpath(path, workspace_path) for path in new_files],
+                verbose=self.workspace.verbose,
+            )
+        for path in paths:
+            os.remove(path)
+
+    def check_snapshot_objects(
+        self, hashval: str, verified: Set[str], bad: Dict[str, str]
+    ) -> List[Tuple[str, str]]:
+        return hashtree.verify_objects(self.rsrcdir, hashval, verified, bad)
+
+    def check_current_data(
+        self, hashval: str, num_workers: Optional[int] = None
+    ) -> List[Tuple[str, str]]:
+        if not self.compute_hash:
+            hash_fun: Callable[[str], str] = hashtree.compute_size
+        elif self.chunked_hashing:
+            hash_fun = hashtree.ChunkedHashFun(None, self.hash_algorithm)
+        else:
+            hash_fun = hashtree.make_hash_fun(self.hash_algorithm)
+        return list(
+            hashtree.iter_mismatches(
+                hashval,
+                self.rsrcdir,
+                self.local_path,
+                ignore=self.ignore,
+                hash_fun=hash_fun,
+                verbose=self.workspace.verbose,
+                num_workers=(
+                    num_workers if num_workers is not None else self._get_num_hash_workers()
+                ),
+            )
+        )
+
     def validate_subpath_exists(self, subpath: str) -> None:
         super().validate_subpath_exists(subpath)
 
@@ -305,7 +662,17 @@ class LocalFileResource(
 
 
 class LocalFileFactory(ResourceFactory):
-    def from_command_line(self, role, name, workspace, local_path, compute_hash, export, imported):
+    def from_command_line(
+        self,
+        role,
+        name,
+        workspace,
+        local_path,
+        compute_hash,
+        export,
+        imported,
+        hash_algorithm=hashtree.DEFAULT_HASH_ALGORITHM,
+    ):
         """Instantiate a resource object from the add command's arguments"""
         workspace_path = workspace.get_workspace_local_path_if_any()
         if not os.path.isdir(local_path):
@@ -339,6 +706,9 @@ class LocalFileFactory(ResourceFactory):
             non_git_hashes = join(local_path, ".hashes")
             if not exists(non_git_hashes):
                 os.mkdir(non_git_hashes)
+        if compute_hash:
+            # scratch space for the hash cache
+            workspace._get_local_scratch_space_for_resource(name, create_if_not_present=True)
         if imported:
             lineage_path = join(local_path, "lineage.json")
             if not exists(lineage_path):
@@ -372,6 +742,7 @@ class LocalFileFactory(ResourceFactory):
             compute_hash=compute_hash,
             export=export,
             imported=imported,
+            hash_algorithm=hash_algorithm,
         )
 
     def from_json(
@@ -392,6 +763,9 @@ class LocalFileFactory(ResourceFactory):
             compute_hash=params["compute_hash"],
             export=params.get("export", False),
             imported=params.get("imported", False),
+            hash_workers=local_params.get("hash_workers", None),
+            hash_algorithm=params.get("hash_algorithm", hashtree.DEFAULT_HASH_ALGORITHM),
+            chunked_hashing=params.get("chunked_hashing", False),
         )
 
     def has_local_state(self) -> bool:
@@ -429,7 +803,18 @@ class LocalFileFactory(ResourceFactory):
             non_git_hashes = join(local_path, ".hashes")
             if not exists(non_git_hashes):
                 os.mkdir(non_git_hashes)
+        if params.get("compute_hash", False):
+            workspace._get_local_scratch_space_for_resource(name, create_if_not_present=True)
         return self.from_json(params, local_params, workspace)
 
-    def suggest_name(self, workspace, role, local_path, compute_hash, export, imported):
+    def suggest_name(
+        self,
+        workspace,
+        role,
+        local_path,
+        compute_hash,
+        export,
+        imported,
+        hash_algorithm=hashtree.DEFAULT_HASH_ALGORITHM,
+    ):
         return os.path.basename(local_path)
@@ -287,6 +287,9 @@ class RcloneResource(Resource, LocalStateResourceMixin, FileResourceMixin, Snaps
         print("Snapshot returns ", ret, out)
         return (ret, None)  # None for the restore hash since we cannot restore
 
+    def supports_concurrent_snapshot(self) -> bool:
+        return True
+
     def restore_precheck(self, hashval):
         pass
         # rc = hashtree.check_hashes(hashval, self.rsrcdir, self.local_path, ignore=self.ignore)
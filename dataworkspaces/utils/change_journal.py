@@ -0,0 +1,485 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+A journal of the directories of a local files resource that changed since the
+resource's last snapshot, kept up to date by a watcher process (see the watch
+command). With the journal, a snapshot only needs to walk the changed subtrees.
+
+A directory is dirty if its entries may have changed (files added, removed,
+renamed or modified). A recursive entry means that nothing is known about the
+directory's subtree, which must then be rescanned. Paths are relative to the root
+of the resource, with "" for the root.
+
+The journal can only be trusted if the watcher has been running since the previous
+snapshot was taken. Each run of the watcher is a session, and the journal records
+the session that was active when that snapshot was taken (the base). The watcher
+also updates a heartbeat, so that a watcher that died is noticed.
+
+Two watchers are provided: one based on Linux's inotify (called through ctypes)
+and one that periodically scans the tree and compares the size and mtime of every
+entry. The latter is used on other systems, or when inotify runs out of watches.
+"""
+
+import os
+import sys
+import time
+import uuid
+import errno
+import select
+import sqlite3
+import struct
+import ctypes
+import ctypes.util
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from dataworkspaces.utils.file_utils import walk_sorted
+
+# The watcher updates its heartbeat at this interval (in seconds)
+HEARTBEAT_INTERVAL = 5.0
+# A session whose heartbeat is older than this is taken to be dead
+STALE_SESSION_AFTER = 6 * HEARTBEAT_INTERVAL
+# How long a snapshot waits for the watcher to process any pending events
+SYNC_TIMEOUT = 30.0
+
+
+class ChangeJournal:
+    """The journal, stored in a sqlite database (usually in the resource's scratch
+    space), which is shared by the watcher and the snapshot command.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute(
+            "create table if not exists dirty (seq integer primary key autoincrement, "
+            + "path text not null, recursive integer not null)"
+        )
+        self.conn.execute(
+            "create table if not exists dir_mtimes (path text primary key, "
+            + "mtime_ns integer not null)"
+        )
+        self.conn.execute("create table if not exists state (key text primary key, value text)")
+        self.conn.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self.conn.execute("select value from state where key=?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set(self, key: str, value: Optional[str]) -> None:
+        self.conn.execute("insert or replace into state values (?, ?)", (key, value))
+        self.conn.commit()
+
+    # Methods used by the watcher
+
+    def start_session(self) -> str:
+        """Start a new watcher session. Changes made before the session started
+        are unknown, so the journal cannot be used until the next snapshot."""
+        session = uuid.uuid4().hex
+        self.conn.execute("insert or replace into state values ('session', ?)", (session,))
+        self.conn.execute(
+            "insert or replace into state values ('heartbeat', ?)", (repr(time.time()),)
+        )
+        self.conn.commit()
+        return session
+
+    def heartbeat(self, session: str) -> None:
+        if self._get("session") != session:
+            raise Exception("Watcher session %s was replaced by another watcher" % session)
+        self._set("heartbeat", repr(time.time()))
+
+    def end_session(self, session: str) -> None:
+        if self._get("session") == session:
+            self._set("session", None)
+
+    def mark_dirty(self, paths: Iterable[Tuple[str, bool]]) -> None:
+        """Add (path, recursive) pairs to the journal"""
+        self.conn.executemany(
+            "insert into dirty (path, recursive) values (?, ?)",
+            [(path, 1 if recursive else 0) for (path, recursive) in paths],
+        )
+        self.conn.commit()
+
+    def get_sync_request(self) -> Optional[int]:
+        """Return the token of a sync request that has not been acknowledged, if any"""
+        requested = int(self._get("sync_requested") or "0")
+        acked = int(self._get("sync_acked") or "0")
+        return requested if requested > acked else None
+
+    def ack_sync(self, token: int) -> None:
+        self._set("sync_acked", str(token))
+
+    # Methods used when taking a snapshot
+
+    def get_active_session(self) -> Optional[str]:
+        """Return the current watcher session, unless there is none or it has died"""
+        session = self._get("session")
+        heartbeat = self._get("heartbeat")
+        if session is None or heartbeat is None:
+            return None
+        if time.time() - float(heartbeat) > STALE_SESSION_AFTER:
+            return None
+        return session
+
+    def get_base(self, session: Optional[str]) -> Optional[str]:
+        """Return the root hash of the last snapshot, if the active watcher session
+        :session: has been running since it was taken."""
+        if session is None or self._get("base_session") != session:
+            return None
+        return self._get("base_hash")
+
+    def sync(self, timeout: float = SYNC_TIMEOUT) -> bool:
+        """Ask the watcher to process any pending events and wait for it to do so.
+        Returns False if the watcher did not respond in time."""
+        token = int(time.time() * 1000)
+        self._set("sync_requested", str(token))
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if int(self._get("sync_acked") or "0") >= token:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def verify_dir_mtimes(self, local_dir: str) -> int:
+        """Compare the mtime of each directory to the mtime recorded when it was last
+        walked. If the mtime changed but the directory is not in the journal, an entry
+        was added, removed or renamed without the watcher noticing, so the subtree is
+        marked for a rescan. Returns the number of such directories."""
+        dirty = set([row[0] for row in self.conn.execute("select distinct path from dirty")])
+        missed = []  # type: List[Tuple[str, bool]]
+        for path, mtime_ns in self.conn.execute("select path, mtime_ns from dir_mtimes"):
+            if path in dirty:
+                continue
+            try:
+                if os.stat(os.path.join(local_dir, path)).st_mtime_ns == mtime_ns:
+                    continue
+            except OSError:
+                pass
+            missed.append((path, True))
+        if len(missed) > 0:
+            # the rows are recreated when the subtrees are walked again
+            self.conn.executemany(
+                "delete from dir_mtimes where path=?", [(path,) for (path, _) in missed]
+            )
+            self.mark_dirty(missed)
+        return len(missed)
+
+    def get_dirty(self) -> Tuple[int, Dict[str, bool]]:
+        """Return the sequence number of the last entry and a mapping from each dirty
+        path to whether the whole subtree should be rescanned."""
+        dirty = {}  # type: Dict[str, bool]
+        max_seq = 0
+        for seq, path, recursive in self.conn.execute(
+            "select seq, path, recursive from dirty order by seq"
+        ):
+            dirty[path] = dirty.get(path, False) or bool(recursive)
+            max_seq = seq
+        return (max_seq, dirty)
+
+    def get_last_seq(self) -> int:
+        row = self.conn.execute("select max(seq) from dirty").fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def snapshot_taken(
+        self, roothash: str, session: str, max_seq: int, dir_mtimes: Dict[str, int]
+    ) -> None:
+        """Record that the tree :roothash: reflects all the changes up to :max_seq:
+        and the mtimes of the directories that were walked to compute it."""
+        self.conn.execute("delete from dirty where seq <= ?", (max_seq,))
+        self.conn.executemany(
+            "insert or replace into dir_mtimes values (?, ?)", list(dir_mtimes.items())
+        )
+        self.conn.execute("insert or replace into state values ('base_hash', ?)", (roothash,))
+        self.conn.execute("insert or replace into state values ('base_session', ?)", (session,))
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+##########################################################################
+#                             Watchers                                   #
+##########################################################################
+
+
+class Watcher:
+    """Base class for watchers. Subclasses implement fileno() and process()."""
+
+    def __init__(
+        self, local_dir: str, journal: ChangeJournal, skip_dir: Callable[[Any], bool], verbose: bool
+    ):
+        self.local_dir = local_dir
+        self.journal = journal
+        self.skip_dir = skip_dir
+        self.verbose = verbose
+        self.session = journal.start_session()
+        self.last_heartbeat = time.time()
+
+    def fileno(self) -> Optional[int]:
+        """A file descriptor that is readable when there are events, or None if the
+        watcher should just be polled"""
+        return None
+
+    def process(self, sync: bool) -> None:
+        """Process pending events. If :sync: is True, all the changes made before
+        this call must have been added to the journal when it returns."""
+        pass
+
+    def tick(self) -> None:
+        """Called regularly by run_watchers()"""
+        token = self.journal.get_sync_request()
+        self.process(token is not None)
+        if token is not None:
+            self.journal.ack_sync(token)
+        if time.time() - self.last_heartbeat >= HEARTBEAT_INTERVAL:
+            self.journal.heartbeat(self.session)
+            self.last_heartbeat = time.time()
+
+    def close(self) -> None:
+        self.journal.end_session(self.session)
+
+    def _relpath(self, path: str) -> str:
+        rel = os.path.relpath(path, self.local_dir)
+        return "" if rel == "." else rel
+
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+_READ_SIZE = 256 * 1024
+
+_libc = None  # type: Any
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+def is_inotify_available() -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        return hasattr(_get_libc(), "inotify_init1")
+    except OSError:
+        return False
+
+
+class InotifyWatchesExhausted(Exception):
+    pass
+
+
+class InotifyWatcher(Watcher):
+    """Watch the tree with inotify. Each directory needs its own watch, so the
+    number of directories is limited by /proc/sys/fs/inotify/max_user_watches.
+    """
+
+    def __init__(
+        self, local_dir: str, journal: ChangeJournal, skip_dir: Callable[[Any], bool], verbose: bool
+    ):
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_init1: %s" % os.strerror(e))
+        self.paths = {}  # type: Dict[int, str]
+        self.skip_dir = skip_dir
+        # start the session only once all the watches are in place
+        try:
+            self._add_tree(local_dir)
+        except:
+            os.close(self.fd)
+            raise
+        super().__init__(local_dir, journal, skip_dir, verbose)
+
+    def fileno(self) -> Optional[int]:
+        return self.fd
+
+    def _add_watch(self, path: str) -> None:
+        wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                raise InotifyWatchesExhausted(
+                    "Out of inotify watches, see /proc/sys/fs/inotify/max_user_watches"
+                )
+            elif e in (errno.ENOENT, errno.ENOTDIR):
+                return  # removed in the meantime, the parent will be marked dirty
+            raise OSError(e, "inotify_add_watch(%s): %s" % (path, os.strerror(e)))
+        self.paths[wd] = path
+
+    def _add_tree(self, path: str) -> None:
+        self._add_watch(path)
+        for root, dirs, files in walk_sorted(path, skip_dir=self.skip_dir):
+            for entry in dirs:
+                if not entry.is_symlink():
+                    self._add_watch(entry.path)
+
+    def _remove_tree(self, path: str) -> None:
+        """Stop watching a directory that was moved away, and its subdirectories"""
+        prefix = path + os.sep
+        for wd, p in list(self.paths.items()):
+            if p == path or p.startswith(prefix):
+                _get_libc().inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def _read_events(self) -> List[Tuple[int, int, str]]:
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []  # type: List[Tuple[int, int, str]]
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def process(self, sync: bool) -> None:
+        dirty = {}  # type: Dict[str, bool]
+        while True:
+            events = self._read_events()
+            if len(events) == 0:
+                break
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    dirty[""] = True  # events were lost, rescan everything
+                    continue
+                dirpath = self.paths.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.paths[wd]
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    continue  # reported as a change to the parent
+                reldir = self._relpath(dirpath)
+                dirty[reldir] = dirty.get(reldir, False)
+                if mask & IN_ISDIR:
+                    path = os.path.join(dirpath, name)
+                    if mask & IN_MOVED_FROM:
+                        self._remove_tree(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO) and os.path.isdir(path):
+                        # files may have been created before the watch was added,
+                        # so the new subtree is rescanned
+                        self._add_tree(path)
+                        dirty[self._relpath(path)] = True
+        if len(dirty) > 0:
+            if self.verbose:
+                print("Dirty directories: %s" % ", ".join(sorted(dirty.keys())))
+            self.journal.mark_dirty(sorted(dirty.items()))
+
+    def close(self) -> None:
+        super().close()
+        os.close(self.fd)
+
+
+class ScanWatcher(Watcher):
+    """Find changes by periodically walking the tree and comparing a signature of
+    the (name, size, mtime) of the entries of each directory to the previous scan.
+    This must stat every entry, so it is much more expensive than inotify, but it
+    runs in the background rather than when a snapshot is taken.
+    """
+
+    def __init__(
+        self,
+        local_dir: str,
+        journal: ChangeJournal,
+        skip_dir: Callable[[Any], bool],
+        verbose: bool,
+        interval: float = 60.0,
+    ):
+        self.interval = interval
+        self.signatures = {}  # type: Dict[str, int]
+        self.local_dir = local_dir
+        self.skip_dir = skip_dir
+        self._scan()  # the baseline
+        self.last_scan = time.time()
+        super().__init__(local_dir, journal, skip_dir, verbose)
+
+    def _scan(self) -> Dict[str, bool]:
+        signatures = {}  # type: Dict[str, int]
+        dirty = {}  # type: Dict[str, bool]
+        for root, dirs, files in walk_sorted(self.local_dir, skip_dir=self.skip_dir):
+            reldir = self._relpath(root)
+            # changes within a subdirectory are found when it is scanned, so only
+            # the subdirectory names are included
+            entries = [(entry.name, -1, -1) for entry in dirs]  # type: List[Tuple[str, int, int]]
+            for entry in files:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append((entry.name, st.st_size, st.st_mtime_ns))
+                except OSError:
+                    entries.append((entry.name, -1, -1))
+            signature = hash(tuple(entries))
+            signatures[reldir] = signature
+            previous = self.signatures.get(reldir)
+            if previous is None:
+                dirty[reldir] = True
+            elif previous != signature:
+                dirty[reldir] = False
+        for reldir in self.signatures.keys():
+            if reldir not in signatures and reldir != "":
+                parent = os.path.dirname(reldir)
+                dirty[parent] = dirty.get(parent, False)
+        self.signatures = signatures
+        return dirty
+
+    def process(self, sync: bool) -> None:
+        if not sync and time.time() - self.last_scan < self.interval:
+            return
+        dirty = self._scan()
+        self.last_scan = time.time()
+        if len(dirty) > 0:
+            if self.verbose:
+                print("Dirty directories: %s" % ", ".join(sorted(dirty.keys())))
+            self.journal.mark_dirty(sorted(dirty.items()))
+
+
+def run_watchers(watchers: List[Watcher], poll_interval: float = 0.5) -> None:
+    """Run the watchers until interrupted (e.g. by control-C)"""
+    try:
+        while True:
+            fds = []  # type: List[int]
+            for w in watchers:
+                fd = w.fileno()
+                if fd is not None:
+                    fds.append(fd)
+            if len(fds) > 0:
+                select.select(fds, [], [], poll_interval)
+            else:
+                time.sleep(poll_interval)
+            for w in watchers:
+                w.tick()
+    finally:
+        for w in watchers:
+            w.close()
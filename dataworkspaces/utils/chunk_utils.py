@@ -0,0 +1,158 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Content-defined chunking of files.
+
+Files are split at positions determined by their content rather than by
+fixed offsets, so that an insertion or append only changes the chunks around
+the edit. We use a "gear" rolling hash: for each byte b, h = (h << 1) + GEAR[b]
+(mod 2**32). Since bits are shifted out, h depends on just the last 32 bytes.
+A chunk ends after a byte where the high bits of h selected by the mask are all
+zero, subject to minimum and maximum chunk sizes.
+
+If numpy is available, the rolling hash is computed a block at a time. Otherwise,
+we fall back to a (much slower) pure python implementation. Both produce the same
+chunk boundaries.
+"""
+
+import hashlib
+from typing import Iterator, List, NamedTuple, Any
+
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None
+
+HASH_BITS = 32
+WINDOW_SIZE = HASH_BITS  # number of bytes that influence the rolling hash
+_HASH_MASK = (1 << HASH_BITS) - 1
+
+# Derive the gear table from a fixed seed, so that chunk boundaries
+# are the same across machines and python versions.
+GEAR = tuple(
+    int.from_bytes(hashlib.sha1(b"dws-gear-%d" % i).digest()[0:4], "big") for i in range(256)
+)
+_GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+
+class ChunkParams(NamedTuple):
+    """Parameters for content-defined chunking. avg_size must be a power of two.
+    The expected size of a chunk is roughly min_size+avg_size."""
+
+    min_size: int
+    avg_size: int
+    max_size: int
+
+    def validate(self) -> None:
+        if self.min_size < 2 * WINDOW_SIZE:
+            raise ValueError("Minimum chunk size must be at least %d bytes" % (2 * WINDOW_SIZE))
+        if self.avg_size & (self.avg_size - 1) != 0:
+            raise ValueError("Average chunk size must be a power of two")
+        if self.max_size < self.min_size + self.avg_size:
+            raise ValueError("Maximum chunk size must be at least min_size+avg_size")
+
+    def mask(self) -> int:
+        bits = self.avg_size.bit_length() - 1
+        return ((1 << bits) - 1) << (HASH_BITS - bits)
+
+
+DEFAULT_CHUNK_PARAMS = ChunkParams(
+    min_size=256 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024
+)
+
+
+def _cut_points_numpy(data: Any, params: ChunkParams, eof: bool) -> List[int]:
+    arr = numpy.frombuffer(data, dtype=numpy.uint8)
+    # h[i] = sum over k<32 of (GEAR[data[i-k]] << k), computed by doubling the window
+    h = numpy.take(_GEAR_ARRAY, arr)
+    tmp = numpy.empty_like(h)
+    shift = 1
+    while shift < HASH_BITS and shift < len(h):
+        m = len(h) - shift
+        numpy.left_shift(h[:m], shift, out=tmp[:m])
+        numpy.add(h[shift:], tmp[:m], out=h[shift:])
+        shift *= 2
+    candidates = numpy.flatnonzero((h & numpy.uint32(params.mask())) == 0) + 1
+    n = len(data)
+    cuts = []  # type: List[int]
+    start = 0
+    while True:
+        lo = start + params.min_size
+        hi = start + params.max_size
+        if lo > n:
+            break
+        idx = numpy.searchsorted(candidates, lo)
+        if idx < len(candidates) and candidates[idx] <= min(hi, n):
+            end = int(candidates[idx])
+        elif hi <= n:
+            end = hi
+        else:
+            break
+        cuts.append(end)
+        start = end
+    if eof and start < n:
+        cuts.append(n)
+    return cuts
+
+
+def _cut_points_python(data: Any, params: ChunkParams, eof: bool) -> List[int]:
+    mask = params.mask()
+    n = len(data)
+    cuts = []  # type: List[int]
+    start = 0
+    while True:
+        lo = start + params.min_size
+        hi = start + params.max_size
+        if lo > n:
+            break
+        end = None
+        h = 0
+        # only the last WINDOW_SIZE bytes matter, so start rolling just before lo
+        for i in range(lo - WINDOW_SIZE, min(hi, n)):
+            h = ((h << 1) + GEAR[data[i]]) & _HASH_MASK
+            if i >= lo - 1 and (h & mask) == 0:
+                end = i + 1
+                break
+        if end is None:
+            if hi <= n:
+                end = hi
+            else:
+                break
+        cuts.append(end)
+        start = end
+    if eof and start < n:
+        cuts.append(n)
+    return cuts
+
+
+def find_cut_points(data: Any, params: ChunkParams, eof: bool, use_numpy: bool = True) -> List[int]:
+    """Return the end offsets of the chunks in data, which must start at a chunk
+    boundary. Unless eof is True, the bytes after the last returned offset do not
+    yet form a complete chunk and should be passed again along with the following
+    data."""
+    if use_numpy and numpy is not None:
+        return _cut_points_numpy(data, params, eof)
+    else:
+        return _cut_points_python(data, params, eof)
+
+
+def iter_chunks(
+    f, params: ChunkParams = DEFAULT_CHUNK_PARAMS, read_size: int = 0, use_numpy: bool = True
+) -> Iterator[memoryview]:
+    """Read the binary file object f and yield its content-defined chunks. Each chunk
+    is a memoryview that is only valid until the next chunk is requested."""
+    params.validate()
+    if read_size <= 0:
+        read_size = 4 * params.max_size
+    buf = b""
+    while True:
+        data = f.read(read_size)
+        eof = len(data) == 0
+        buf = buf + data if len(buf) > 0 else data
+        view = memoryview(buf)
+        start = 0
+        for end in find_cut_points(buf, params, eof, use_numpy=use_numpy):
+            yield view[start:end]
+            start = end
+        if eof:
+            return
+        buf = buf[start:]
@@ -7,9 +7,10 @@ import os
 from os.path import dirname, isdir, abspath, expanduser, exists, isabs, commonpath, isfile, join
 import shutil
 import click
-from typing import Optional
+from typing import Optional, Callable, Iterator, List, Tuple, Any
 
 from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.utils import timing_utils
 
 
 def remove_dir_if_empty(path: str, base_dir: str, verbose: bool = False) -> None:
@@ -78,6 +79,50 @@ def does_subpath_exist(
         return False  # does not exist, but a special file
 
 
+def _entry_name(entry: Any) -> str:
+    return entry.name
+
+
+def walk_sorted(
+    top: str, topdown: bool = True, skip_dir: Optional[Callable[[Any], bool]] = None
+) -> Iterator[Tuple[str, List[Any], List[Any]]]:
+    """A replacement for os.walk() based on os.scandir(). For each directory, it yields
+    (dirpath, dirs, files), where dirs and files are lists of os.DirEntry objects,
+    sorted by name. DirEntry objects cache their stat results, so use entry.stat()
+    rather than calling os.stat() on the path.
+
+    If skip_dir is provided, it is called with the DirEntry of each subdirectory and
+    the directories for which it returns True are neither returned nor walked, even
+    when walking bottom-up. When walking top-down, the caller may also remove entries
+    from dirs. As with os.walk(), symbolic links to directories are included in dirs
+    but not followed and errors from listing a directory are ignored.
+    """
+    try:
+        with os.scandir(top) as it:
+            entries = sorted(it, key=_entry_name)
+    except OSError:
+        return
+    dirs = []  # type: List[Any]
+    files = []  # type: List[Any]
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            files.append(entry)
+        elif skip_dir is None or not skip_dir(entry):
+            dirs.append(entry)
+    timing_utils.count(timing_utils.FILES_VISITED, len(files))
+    if topdown:
+        yield (top, dirs, files)
+    for entry in dirs:
+        if not entry.is_symlink():
+            yield from walk_sorted(entry.path, topdown, skip_dir)
+    if not topdown:
+        yield (top, dirs, files)
+
+
 def parent_path(path):
     """Return the path to the parent directory of path"""
     return abspath(join(path, os.pardir))
@@ -2,17 +2,19 @@
 """
 Utility functions related to interacting with git
 """
-from os.path import isdir, join, dirname, exists
-from subprocess import run, PIPE
+import os
+from os.path import isdir, join, dirname, exists, realpath
+from subprocess import PIPE
 import shutil
 import re
 import tempfile
 import json
-from typing import Any, List
+import threading
+from typing import Any, Dict, List
 
 import click
 
-from .subprocess_utils import find_exe, call_subprocess, call_subprocess_for_rc
+from .subprocess_utils import find_exe, call_subprocess, call_subprocess_for_rc, run_subprocess
 from .file_utils import remove_dir_if_empty
 from dataworkspaces.errors import ConfigurationError, InternalError, UserAbort
 
@@ -27,6 +29,27 @@ def is_git_repo(dirpath):
 GIT_EXE_PATH = find_exe("git", "Please make sure that you have git installed on your machine.")
 
 
+_repo_locks: Dict[str, Any] = {}
+_repo_locks_guard = threading.Lock()
+
+
+def get_git_repo_lock(path: str) -> Any:
+    """Return a lock, shared by all the threads of this process, for the git repo
+    containing :path:. Git commands that change the index or HEAD of a repo fail if
+    another is running, so threads that run them concurrently (e.g. when resources
+    are snapshotted in parallel) must hold this lock. The lock is reentrant.
+    """
+    path = realpath(path)
+    root = path
+    while not exists(join(root, ".git")):
+        if dirname(root) == root:
+            root = path  # not in a repo
+            break
+        root = dirname(root)
+    with _repo_locks_guard:
+        return _repo_locks.setdefault(root, threading.RLock())
+
+
 def is_git_dirty(cwd):
     """See if the git repo is dirty. We are looking for untracked
     files, changes in staging, and changes in the working directory.
@@ -34,7 +57,7 @@ def is_git_dirty(cwd):
     if GIT_EXE_PATH is None:
         raise ConfigurationError("git executable not found")
     cmd = [GIT_EXE_PATH, "status", "--porcelain"]
-    p = run(cmd, cwd=cwd, stdout=PIPE, encoding="utf-8")
+    p = run_subprocess(cmd, cwd, stdout=PIPE, encoding="utf-8")
     for line in p.stdout.split("\n"):
         if len(line) < 2:
             continue
@@ -51,7 +74,7 @@ def is_git_subdir_dirty(cwd, subdir):
     files, changes in staging, and changes in the working directory.
     """
     cmd = [GIT_EXE_PATH, "status", "--porcelain", subdir]
-    p = run(cmd, cwd=cwd, stdout=PIPE, encoding="utf-8")
+    p = run_subprocess(cmd, cwd, stdout=PIPE, encoding="utf-8")
     for line in p.stdout.split("\n"):
         if len(line) < 2:
             continue
@@ -72,7 +95,7 @@ def is_git_staging_dirty(cwd, subdir=None):
     cmd = [GIT_EXE_PATH, "status", "--porcelain"]
     if subdir is not None:
         cmd.append(subdir)
-    p = run(cmd, cwd=cwd, stdout=PIPE, encoding="utf-8")
+    p = run_subprocess(cmd, cwd, stdout=PIPE, encoding="utf-8")
     for line in p.stdout.split("\n"):
         if len(line) < 2:
             continue
@@ -91,7 +114,7 @@ def echo_git_status_for_user(cwd):
         raise ConfigurationError("git executable not found")
     cmd = [GIT_EXE_PATH, "status"]
     # p = run(cmd, cwd=cwd, stdout=PIPE, encoding="utf-8")
-    p = run(cmd, cwd=cwd, encoding="utf-8")
+    p = run_subprocess(cmd, cwd, encoding="utf-8")
     # for line in p.stdout.split("\n"):
     #     click.echo(line)
     if p.returncode != 0:
@@ -119,6 +142,57 @@ def git_add(repo_dir: str, relative_paths: List[str], verbose: bool = False) ->
     call_subprocess([GIT_EXE_PATH, "add"] + relative_paths, cwd=repo_dir, verbose=verbose)
 
 
+def git_add_many(repo_dir: str, relative_paths: List[str], verbose: bool = False) -> None:
+    """Add a (potentially very large) list of files to the index with a single
+    git call. The paths are passed via standard input rather than the command
+    line, so there is no limit on their number. Unlike git_add(), the paths
+    must be files and are not checked against .gitignore.
+    """
+    if len(relative_paths) == 0:
+        return
+    with get_git_repo_lock(repo_dir):
+        call_subprocess(
+            [GIT_EXE_PATH, "update-index", "--add", "--stdin"],
+            cwd=repo_dir,
+            verbose=verbose,
+            input="\n".join(relative_paths) + "\n",
+        )
+
+
+def git_remove_many(repo_dir: str, relative_paths: List[str], verbose: bool = False) -> None:
+    """Remove a (potentially very large) list of files from the index with a single
+    git call, as with git_add_many(). The removal is staged, but not committed.
+    Paths which are not tracked are ignored. The files themselves are left in
+    the working tree, so the caller should delete them.
+    """
+    if len(relative_paths) == 0:
+        return
+    with get_git_repo_lock(repo_dir):
+        call_subprocess(
+            [GIT_EXE_PATH, "update-index", "--force-remove", "--stdin"],
+            cwd=repo_dir,
+            verbose=verbose,
+            input="\n".join(relative_paths) + "\n",
+        )
+
+
+def git_remove_subtrees(repo_dir: str, relative_paths: List[str], verbose: bool = False) -> None:
+    """Remove the directories at relative_paths (relative to repo_dir) from both the
+    index and the working tree. Unlike calling git_remove_subtree() for each directory,
+    this runs a single git command, so it is suitable for removing many directories.
+    The removal is staged, but not committed. Paths which do not exist are ignored.
+    """
+    files = []  # type: List[str]
+    dirs = [join(repo_dir, relative_path) for relative_path in relative_paths]
+    for d in dirs:
+        for dirpath, _, filenames in os.walk(d):
+            files.extend([os.path.relpath(join(dirpath, f), repo_dir) for f in filenames])
+    git_remove_many(repo_dir, files, verbose=verbose)
+    for d in dirs:
+        if isdir(d):
+            shutil.rmtree(d)
+
+
 def git_commit(repo_dir: str, message: str, verbose: bool = False) -> None:
     """Unconditional git commit
     """
@@ -229,7 +303,7 @@ def commit_changes_in_repo(local_path, message, remove_empty_dirs=False, verbose
         elif line[1] == "M":
             call_subprocess([GIT_EXE_PATH, "add", relpath], cwd=local_path, verbose=verbose)
             need_to_commit = True
-        elif line[0] in ("?", "A", "D", "M"):
+        elif line[0] in ("?", "A", "D", "M", "R"):
             need_to_commit = True
             if line[0] == "D":
                 maybe_delete_dirs.append(dirname(join(local_path, relpath)))
@@ -265,7 +339,7 @@ def checkout_and_apply_commit(local_path, commit_hash, verbose=False):
     cmdstr = "%s diff HEAD %s | %s apply" % (GIT_EXE_PATH, commit_hash, GIT_EXE_PATH)
     if verbose:
         click.echo(cmdstr + "[run in %s]" % local_path)
-    cp = run(cmdstr, cwd=local_path, shell=True)
+    cp = run_subprocess(cmdstr, local_path, num_processes=2, shell=True)
     cp.check_returncode()
     commit_changes_in_repo(
         local_path, "Revert to commit %s" % commit_hash, remove_empty_dirs=True, verbose=verbose
@@ -323,7 +397,8 @@ def commit_changes_in_repo_subdir(
 
 def checkout_subdir_and_apply_commit(local_path, subdir, commit_hash, verbose=False):
     """Checkout the commit and apply the changes to HEAD, just for a specific
-    subdirectory in the repo.
+    subdirectory in the repo. Instead of a commit, commit_hash may be the hash
+    of the subdirectory's tree.
     """
     commit_changes_in_repo_subdir(
         local_path,
@@ -331,10 +406,15 @@ def checkout_subdir_and_apply_commit(local_path, subdir, commit_hash, verbose=Fa
         "Commit state of repo prior to restore of %s" % commit_hash,
         verbose=verbose,
     )
+    object_type = call_subprocess(
+        [GIT_EXE_PATH, "cat-file", "-t", commit_hash], cwd=local_path, verbose=verbose
+    ).strip()
+    source = commit_hash if object_type == "tree" else "%s:%s" % (commit_hash, subdir)
+    target = "HEAD:%s" % subdir
     # make sure there are actually differences between the commits
     if (
         call_subprocess_for_rc(
-            [GIT_EXE_PATH, "diff", "--exit-code", "--quiet", "HEAD", commit_hash, subdir],
+            [GIT_EXE_PATH, "diff", "--exit-code", "--quiet", target, source],
             cwd=local_path,
             verbose=verbose,
         )
@@ -345,11 +425,17 @@ def checkout_subdir_and_apply_commit(local_path, subdir, commit_hash, verbose=Fa
                 "No changes for %s in %s between HEAD and %s" % (local_path, subdir, commit_hash)
             )
         return
-    # ok, there are, apply the changes
-    cmdstr = "%s diff HEAD %s %s | %s apply" % (GIT_EXE_PATH, commit_hash, subdir, GIT_EXE_PATH)
+    # ok, there are, apply the changes. The diff is relative to the subdirectory.
+    cmdstr = "%s diff %s %s | %s apply --directory=%s" % (
+        GIT_EXE_PATH,
+        target,
+        source,
+        GIT_EXE_PATH,
+        subdir,
+    )
     if verbose:
         click.echo(cmdstr + "[run in %s]" % local_path)
-    cp = run(cmdstr, cwd=local_path, shell=True)
+    cp = run_subprocess(cmdstr, local_path, num_processes=2, shell=True)
     cp.check_returncode()
     commit_changes_in_repo_subdir(
         local_path,
@@ -398,7 +484,7 @@ def get_subdirectory_hash(repo_dir, relpath, verbose=False):
     cmd = [GIT_EXE_PATH, "ls-tree", "-t", "HEAD", relpath]
     if verbose:
         click.echo("%s [run in %s]" % (" ".join(cmd), repo_dir))
-    cp = run(cmd, cwd=repo_dir, encoding="utf-8", stdout=PIPE, stderr=PIPE)
+    cp = run_subprocess(cmd, repo_dir, encoding="utf-8", stdout=PIPE, stderr=PIPE)
     cp.check_returncode()
     for line in cp.stdout.split("\n"):
         m = LS_TREE_RE.match(line)
@@ -4,7 +4,11 @@ without necessarily requiring git to be installed.
 """
 
 import hashlib
+import mmap
+import os
 import re
+import threading
+from typing import Any
 
 HASH_RE = re.compile(r"^[0-9a-fA-F]+$")
 
@@ -25,19 +29,79 @@ def is_a_shortened_git_hash(s):
     return len(s) >= MIN_SHORT_HASH_LEN and (SHORT_HASH_RE.match(s) is not None)
 
 
-def hash_file(fpath):
+# Size of the buffer used when streaming a file into a hash object
+HASH_BUF_SIZE = 1024 * 1024
+# Files at least this large are hashed directly from a memory map rather
+# than being read into a buffer. Set to None to never use mmap.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Read buffers are reused across calls, one per thread
+_buffers = threading.local()
+
+
+def _get_buffer(buf_size: int) -> memoryview:
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != buf_size:
+        buf = memoryview(bytearray(buf_size))
+        _buffers.buf = buf
+    return buf
+
+
+def _update_hash_from_fileobj(hasher: Any, f, size: int, buf_size: int, mmap_threshold) -> int:
+    """Feed the contents of the unbuffered file object f to hasher.
+    Returns the number of bytes hashed.
+    """
+    if mmap_threshold is not None and size >= mmap_threshold and size > 0:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass  # e.g. not a regular file, fall back to reading
+        else:
+            with mm:
+                hasher.update(mm)
+                return len(mm)
+    buf = _get_buffer(buf_size)
+    total = 0
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        hasher.update(buf[:n])
+        total += n
+    return total
+
+
+def update_hash_from_file(
+    hasher: Any, fpath: str, buf_size: int = HASH_BUF_SIZE, mmap_threshold=MMAP_THRESHOLD
+) -> int:
+    """Feed the contents of the file at fpath to hasher (any object with
+    an update() method accepting a buffer, such as those from hashlib).
+    The file is never fully read into memory: large files are hashed
+    from a memory map and others are streamed through a reused buffer of
+    buf_size bytes. Returns the number of bytes hashed.
+    """
+    with open(fpath, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        return _update_hash_from_fileobj(hasher, f, size, buf_size, mmap_threshold)
+
+
+def _git_blob_header(size: int) -> bytes:
+    return ("blob %d" % size).encode("ascii") + b"\0"
+
+
+def hash_file(fpath, buf_size: int = HASH_BUF_SIZE, mmap_threshold=MMAP_THRESHOLD):
     """Compute the same hash on the file as git would (e.g. via git hash-object).
     The hash is the sha1 digest, but with a header added to the file first:
     the word "blob", followed by a space, followed by the content length,
-    followed by a zero byte.
+    followed by a zero byte. The file is streamed as in update_hash_from_file().
     """
-    with open(fpath, "rb") as f:
-        data = f.read()
-    size = len(data)
-    header = ("blob %d" % size).encode("ascii") + b"\0"
-    blob = header + data
     m = hashlib.sha1()
-    m.update(blob)
+    with open(fpath, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        m.update(_git_blob_header(size))
+        hashed = _update_hash_from_fileobj(m, f, size, buf_size, mmap_threshold)
+    if hashed != size:
+        raise IOError("File %s changed size while it was being hashed" % fpath)
     return m.hexdigest()
 
 
@@ -48,11 +112,9 @@ def hash_bytes(data: bytes):
     followed by a zero byte.
     """
     assert isinstance(data, bytes)
-    size = len(data)
-    header = ("blob %d" % size).encode("ascii") + b"\0"
-    blob = header + data
     m = hashlib.sha1()
-    m.update(blob)
+    m.update(_git_blob_header(len(data)))
+    m.update(data)
     return m.hexdigest()
 
 
@@ -38,7 +38,7 @@ from string import Template
 from dataworkspaces.errors import InternalError, LineageError
 from .regexp_utils import isots_to_dt
 from .hash_utils import is_a_git_hash
-
+from .lock_utils import optional_file_lock, atomic_write, write_json_atomically
 
 class LineageConsistencyError(LineageError):
     """Special case of LineageError where the inputs for a step
@@ -1149,6 +1149,14 @@ class LineageStore(metaclass=ABCMeta):
         """
         pass
 
+    def delete_snapshots_lineage(self, instance: str, snapshot_hashes: List[str]) -> None:
+        """Delete any lineage data associated with each of the specified snapshots.
+        Subclasses should override this if they can do better than deleting
+        one snapshot at a time.
+        """
+        for snapshot_hash in snapshot_hashes:
+            self.delete_snapshot_lineage(instance, snapshot_hash)
+
     @abstractmethod
     def iterate_all(self, instance: str) -> Iterable[Tuple[ResourceRef, ResourceLineage]]:
         """Iterate through the contents of the store
@@ -1342,7 +1350,13 @@ class FileLineageStore(LineageStore):
     """Store lineage data on the local filesystem.
     """
 
-    def __init__(self, instance: str, current_lineage_path: str, snapshot_lineage_path: str):
+    def __init__(
+        self,
+        instance: str,
+        current_lineage_path: str,
+        snapshot_lineage_path: str,
+        lock_path: Optional[str] = None,
+    ):
         """:current_lineage_path: is private to the instance.
 
         :snapshot_lineage_path: should be replicated/visible to all instances
@@ -1351,25 +1365,55 @@ class FileLineageStore(LineageStore):
         We pass in :instance: to the constructor as this implementation works against
         local state only and the instance parameters of the methods must all match
         this instance.
+
+        :lock_path: if specified, is a lock file that is held by readers (shared) and
+        writers (exclusive) of the lineage files, so that several processes can record
+        lineage concurrently. While holding the lock, readers and writers reload any files
+        that another process has changed since they were cached, so that they neither
+        return stale lineage nor lose those changes.
         """
         self.instance = instance
         self.current_lineage_path = current_lineage_path
         self.snapshot_lineage_path = snapshot_lineage_path
+        self.lock_path = lock_path
         # Write-through cache of the resources. We use this
         # to make following backlinks faster.
         # This is a dict from resource names to resource ref to lineage mappings.
         # Note that a a given lineage object may be independently repeated in multiple
         # places. This is OK, as long as any changes are made identically to all copies.
         self.resource_cache = {}  # type: Dict[str, Dict[ResourceRef, ResourceLineage]]
+        # The (inode, mtime, size) of each resource file when it was cached
+        self.rfile_stats = {}  # type: Dict[str, Optional[Tuple[int, int, int]]]
+
+    def _lock(self, shared: bool = False):
+        return optional_file_lock(self.lock_path, shared=shared)
 
     def _rfile_exists(self, resource_name: str) -> bool:
         return exists(join(self.current_lineage_path, resource_name + ".json"))
 
+    def _rfile_stat(self, resource_name: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(join(self.current_lineage_path, resource_name + ".json"))
+        except FileNotFoundError:
+            return None
+        # files are replaced rather than overwritten, so the inode changes with each write
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _drop_stale_cache_entries(self, resource_names: Iterable[str]) -> None:
+        """Remove the cached mappings for any resource files changed by another process.
+        The caller should hold the lock, which is not reentrant, so this does not take it."""
+        for resource_name in resource_names:
+            if resource_name in self.resource_cache and self._rfile_stat(
+                resource_name
+            ) != self.rfile_stats.get(resource_name):
+                del self.resource_cache[resource_name]
+
     def _parse_rfile(self, resource_name: str) -> Dict[ResourceRef, ResourceLineage]:
         if resource_name in self.resource_cache:
             return self.resource_cache[resource_name]
 
         rfile_path = join(self.current_lineage_path, resource_name + ".json")
+        self.rfile_stats[resource_name] = self._rfile_stat(resource_name)
         with open(rfile_path, "r") as f:
             data = json.load(f)
         assert isinstance(data, dict), (
@@ -1406,15 +1450,14 @@ class FileLineageStore(LineageStore):
         """
         rfile_path = join(self.current_lineage_path, resource_name + ".json")
         # for backward compability, we just save the lineage values
-        with open(rfile_path, "w") as f:
-            json.dump(
-                {
-                    "resource_name": resource_name,
-                    "lineages": [r.to_json() for r in lineage_map.values()],
-                },
-                f,
-                indent=2,
-            )
+        write_json_atomically(
+            rfile_path,
+            {
+                "resource_name": resource_name,
+                "lineages": [r.to_json() for r in lineage_map.values()],
+            },
+        )
+        self.rfile_stats[resource_name] = self._rfile_stat(resource_name)
         return rfile_path
 
     def _get_snapshot_path(self, resource_name: str, snapshot_hash: str) -> str:
@@ -1467,21 +1510,19 @@ class FileLineageStore(LineageStore):
         """
         snapshot_path = self._get_snapshot_path(resource_name, snapshot_hash)
         # for backward compability, we just save the lineage values
-        with open(snapshot_path, "w") as f:
-            json.dump(
-                {
-                    "resource_name": resource_name,
-                    "lineages": [r.to_json() for r in lineage_map.values()],
-                },
-                f,
-                indent=2,
-            )
+        write_json_atomically(
+            snapshot_path,
+            {
+                "resource_name": resource_name,
+                "lineages": [r.to_json() for r in lineage_map.values()],
+            },
+        )
         return snapshot_path
 
     def _copy_rfile_to_snapshot(self, resource_name: str, snapshot_hash: str) -> Tuple[str, str]:
         src_rpath = join(self.current_lineage_path, resource_name + ".json")
         dest_rpath = self._get_snapshot_path(resource_name, snapshot_hash)
-        shutil.copyfile(src_rpath, dest_rpath)
+        _copy_file_atomically(src_rpath, dest_rpath)
         return (src_rpath, dest_rpath)
 
     def _copy_snapshot_rfile_to_current(
@@ -1489,14 +1530,14 @@ class FileLineageStore(LineageStore):
     ) -> Tuple[str, str]:
         src_rpath = self._get_snapshot_path(resource_name, snapshot_hash)
         dest_rpath = join(self.current_lineage_path, resource_name + ".json")
-        shutil.copyfile(src_rpath, dest_rpath)
+        _copy_file_atomically(src_rpath, dest_rpath)
         return (src_rpath, dest_rpath)
 
     def _write_placeholder_to_snapshot(
         self, snapshot_hash: str, filename: str, content: str
     ) -> str:
         path = join(join(self.snapshot_lineage_path, snapshot_hash), filename)
-        with open(path, "w") as f:
+        with atomic_write(path) as f:
             f.write(content)
         return path
 
@@ -1507,6 +1548,11 @@ class FileLineageStore(LineageStore):
 
     def store_entry(self, instance: str, lineage: ResourceLineage) -> None:
         assert instance == self.instance
+        with self._lock():
+            self._drop_stale_cache_entries([cert.ref.name for cert in lineage.get_certs()])
+            self._store_entry(lineage)
+
+    def _store_entry(self, lineage: ResourceLineage) -> None:
         for cert in lineage.get_certs():
             if self._rfile_exists(cert.ref.name):
                 # case where we need to merge into data
@@ -1534,9 +1580,11 @@ class FileLineageStore(LineageStore):
 
     def retrieve_entry(self, instance: str, ref: ResourceRef) -> ResourceLineage:
         assert instance == self.instance
-        if not self._rfile_exists(ref.name):
-            raise LineageNotFoundError("No lineage exists for %s" % str(ref))
-        mapping = self._parse_rfile(ref.name)
+        with self._lock(shared=True):
+            self._drop_stale_cache_entries([ref.name])
+            if not self._rfile_exists(ref.name):
+                raise LineageNotFoundError("No lineage exists for %s" % str(ref))
+            mapping = self._parse_rfile(ref.name)
         for (other_ref, lineage) in mapping.items():
             if ref == other_ref or other_ref.covers(ref):
                 return lineage
@@ -1544,9 +1592,11 @@ class FileLineageStore(LineageStore):
 
     def has_entry(self, instance: str, ref: ResourceRef, include_covers: bool = True) -> bool:
         assert instance == self.instance
-        if not self._rfile_exists(ref.name):
-            return False
-        mapping = self._parse_rfile(ref.name)
+        with self._lock(shared=True):
+            self._drop_stale_cache_entries([ref.name])
+            if not self._rfile_exists(ref.name):
+                return False
+            mapping = self._parse_rfile(ref.name)
         for (other_ref, lineage) in mapping.items():
             if ref == other_ref or (include_covers and other_ref.covers(ref)):
                 return True
@@ -1554,6 +1604,11 @@ class FileLineageStore(LineageStore):
 
     def clear_entry(self, instance: str, ref: ResourceRef) -> None:
         assert instance == self.instance
+        with self._lock():
+            self._drop_stale_cache_entries([ref.name])
+            self._clear_entry(ref)
+
+    def _clear_entry(self, ref: ResourceRef) -> None:
         if ref.subpath is None:
             # special case when its the entire file
             if self._rfile_exists(ref.name):
@@ -1578,17 +1633,25 @@ class FileLineageStore(LineageStore):
         a multi-element list of multiple subpaths for the resource are in the store
         """
         assert instance == self.instance
-        if not self._rfile_exists(resource_name):
-            return []
-        mapping = self._parse_rfile(resource_name)
+        with self._lock(shared=True):
+            self._drop_stale_cache_entries([resource_name])
+            if not self._rfile_exists(resource_name):
+                return []
+            mapping = self._parse_rfile(resource_name)
         return mapping.keys()
 
     def replace_placeholders(
         self, instance: str, hash_mapping: Dict[str, str], verbose=False
     ) -> None:
         assert instance == self.instance
-        # we load the entire current store, as following the backlinks can go to any resource
-        self._load_resource_cache()
+        with self._lock():
+            # we load the entire current store, as following the backlinks can go to any
+            # resource
+            self._drop_stale_cache_entries(list(self.resource_cache.keys()))
+            self._load_resource_cache()
+            self._replace_placeholders(hash_mapping, verbose)
+
+    def _replace_placeholders(self, hash_mapping: Dict[str, str], verbose=False) -> None:
         dirty_resources = set()  # need to save these at the end
         for (rname, mapping) in self.resource_cache.items():
             for (ref, lineage) in mapping.items():
@@ -1609,6 +1672,10 @@ class FileLineageStore(LineageStore):
         self, instance: str, snapshot_hash: str, resource_names: List[str]
     ) -> None:
         assert instance == self.instance
+        with self._lock():
+            self._snapshot_lineage(snapshot_hash, resource_names)
+
+    def _snapshot_lineage(self, snapshot_hash: str, resource_names: List[str]) -> None:
         self._ensure_snapshot_dir_exists(snapshot_hash)
         if len(resource_names) == 0:
             self._write_placeholder_to_snapshot(
@@ -1627,6 +1694,12 @@ class FileLineageStore(LineageStore):
         self, instance: str, snapshot_hash: str, resources_to_restore: List[str], verbose=False
     ) -> None:
         assert instance == self.instance
+        with self._lock():
+            self._restore_lineage(snapshot_hash, resources_to_restore, verbose)
+
+    def _restore_lineage(
+        self, snapshot_hash: str, resources_to_restore: List[str], verbose=False
+    ) -> None:
         snapshot_dir = join(self.snapshot_lineage_path, snapshot_hash)
         if not exists(snapshot_dir):
             raise LineageNotFoundError("Did not find lineage data for snapshot %s" % snapshot_hash)
@@ -1655,13 +1728,23 @@ class FileLineageStore(LineageStore):
         """Delete any lineage data associated with the specified snapshot.
         """
         snapshot_dir = join(self.snapshot_lineage_path, snapshot_hash)
-        if exists(snapshot_dir):
-            shutil.rmtree(snapshot_dir)
+        with self._lock():
+            if exists(snapshot_dir):
+                shutil.rmtree(snapshot_dir)
+
+    def delete_snapshots_lineage(self, instance: str, snapshot_hashes: List[str]) -> None:
+        with self._lock():
+            for snapshot_hash in snapshot_hashes:
+                snapshot_dir = join(self.snapshot_lineage_path, snapshot_hash)
+                if exists(snapshot_dir):
+                    shutil.rmtree(snapshot_dir)
 
     def iterate_all(self, instance: str) -> Iterable[Tuple[ResourceRef, ResourceLineage]]:
         """Iterate through the contents of the store
         """
-        self._load_resource_cache()
+        with self._lock(shared=True):
+            self._drop_stale_cache_entries(list(self.resource_cache.keys()))
+            self._load_resource_cache()
         for (rname, mapping) in self.resource_cache.items():
             for (ref, lineage) in mapping.items():
                 if isinstance(lineage, ImportedLineage):
@@ -1690,7 +1773,9 @@ class FileLineageStore(LineageStore):
                     yield (ref, self.retrieve_entry_as_of_snapshot(instance, ref, snapshot_hash))
 
     def dump(self, instance: str) -> None:
-        self._load_resource_cache()
+        with self._lock(shared=True):
+            self._drop_stale_cache_entries(list(self.resource_cache.keys()))
+            self._load_resource_cache()
 
         def _indent(s, level, underline=None):
             for line in s.split("\n"):
@@ -1755,10 +1840,18 @@ class FileLineageStore(LineageStore):
         r = ImportedLineage(resource_name, nested_lineage)
         rfile_path = join(self.current_lineage_path, resource_name + ".json")
         # for backward compability, we just save the lineage values
-        with open(rfile_path, "w") as f:
-            json.dump(
-                {"resource_name": resource_name, "lineages": [r.to_json()],}, f, indent=2,
+        with self._lock():
+            write_json_atomically(
+                rfile_path, {"resource_name": resource_name, "lineages": [r.to_json()]}
             )
+            self.resource_cache.pop(resource_name, None)
+
+
+def _copy_file_atomically(src_path: str, dest_path: str) -> None:
+    with open(src_path, "rb") as src:
+        data = src.read()
+    with atomic_write(dest_path, "wb") as dest:
+        dest.write(data)
 
 
 def make_lineage_table(
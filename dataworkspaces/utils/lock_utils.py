@@ -0,0 +1,80 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Locking and atomic writes for files shared by processes using the same workspace
+(e.g. several jobs on one machine, or on different machines sharing a filesystem).
+
+Locks are advisory locks on lock files. Each lock file protects a group of
+files: writers of any file in the group hold the lock exclusively and readers
+hold it shared. The locks are not reentrant, so do not take the same lock again
+while holding it.
+
+Files are written atomically by writing to a temporary file in the same
+directory, flushing it to disk, and renaming it over the original. Readers
+thus see either the old or the new contents, never a partially written file.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from os.path import basename, dirname, join
+from typing import Any, IO, Iterator, Optional
+
+try:
+    import fcntl  # not available on Windows
+except ImportError:
+    fcntl = None  # type: ignore
+
+
+@contextmanager
+def file_lock(lock_path: str, shared: bool = False) -> Iterator[None]:
+    """Hold a lock on the file at lock_path (created if needed) for the duration
+    of the block. The lock is exclusive, unless shared is True. Blocks until the
+    lock is available. On platforms without flock(), no locking is done.
+    """
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+@contextmanager
+def optional_file_lock(lock_path: Optional[str], shared: bool = False) -> Iterator[None]:
+    """Like file_lock(), but does nothing if lock_path is None"""
+    if lock_path is None:
+        yield
+    else:
+        with file_lock(lock_path, shared=shared):
+            yield
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w") -> Iterator[IO[Any]]:
+    """Open a temporary file for writing (mode should be "w" or "wb"), and, if the
+    block completes without an exception, atomically replace the file at path
+    with it.
+    """
+    tmp_path = join(
+        dirname(path), ".%s.%d.%d.tmp" % (basename(path), os.getpid(), threading.get_ident())
+    )
+    # os.open() respects the umask, unlike tempfile.mkstemp()
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json_atomically(path: str, obj: Any, indent: int = 2) -> None:
+    with atomic_write(path) as f:
+        json.dump(obj, f, indent=indent)
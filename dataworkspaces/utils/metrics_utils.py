@@ -0,0 +1,75 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Utilities for querying the metrics recorded with snapshots.
+
+Only the top-level metrics with numeric values can be queried. A query selects
+the values of one metric, optionally restricted by conditions on other metrics
+of the same snapshot. A condition is a (metric, op, value) triple, where op is
+one of the comparison operators in COMPARISON_OPS (e.g. ``('loss', '<', 0.5)``).
+"""
+
+import math
+import operator
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from dataworkspaces.errors import ApiParamError
+
+JSONDict = Dict[str, Any]
+
+Condition = Tuple[str, str, float]
+
+COMPARISON_OPS: Dict[str, Callable[[float, float], bool]] = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "=": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def is_numeric(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def numeric_metrics(metrics: Optional[JSONDict]) -> Dict[str, float]:
+    """Return the top-level metrics that have finite numeric values. NaN is
+    left out, as it cannot be compared (and sqlite stores it as NULL).
+    """
+    if metrics is None:
+        return {}
+    return {
+        metric: value
+        for (metric, value) in metrics.items()
+        if is_numeric(value) and math.isfinite(value)
+    }
+
+
+def check_conditions(where: Iterable[Condition]) -> None:
+    """Raise an ApiParamError if any of the conditions are malformed"""
+    for condition in where:
+        if len(condition) != 3:
+            raise ApiParamError(
+                "Metric condition %s should be a (metric, op, value) triple" % repr(condition)
+            )
+        metric, op, value = condition
+        if op not in COMPARISON_OPS:
+            raise ApiParamError(
+                "Invalid comparison '%s' for metric %s, valid comparisons are: %s"
+                % (op, metric, ", ".join(sorted(COMPARISON_OPS.keys())))
+            )
+        if not is_numeric(value):
+            raise ApiParamError(
+                "Value for comparison of metric %s should be a number, not %s"
+                % (metric, repr(value))
+            )
+
+
+def conditions_match(metrics: Dict[str, float], where: Iterable[Condition]) -> bool:
+    """Return True if the numeric metrics satisfy all of the conditions. A condition
+    on a metric which is not present is not satisfied.
+    """
+    return all(
+        metric in metrics and COMPARISON_OPS[op](metrics[metric], value)
+        for (metric, op, value) in where
+    )
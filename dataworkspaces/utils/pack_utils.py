@@ -0,0 +1,180 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Pack files: many small objects, named by their sha1 hashes, stored in a
+single file.
+
+A pack consists of two files:
+
+* NAME.pack - a header followed by the contents of the objects, concatenated.
+  Files are only ever appended to while being written and are immutable afterward.
+* NAME.idx - a header, the number of objects, and then a fixed-size record
+  (binary hash, offset, length) for each object, sorted by hash. Objects
+  are looked up by a binary search over the records, reading only
+  O(log n) of them.
+
+NAME is "pack-" followed by the sha1 hash of the .pack file, so
+identical packs have the same name.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dataworkspaces.utils.file_utils import safe_rename
+
+PACK_PREFIX = "pack-"
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+
+PACK_HEADER = b"DWSPACK1"
+INDEX_HEADER = b"DWSIDX01"
+_COUNT = struct.Struct(">I")
+_RECORD = struct.Struct(">20sQI")  # hash, offset, length
+_RECORDS_START = len(INDEX_HEADER) + _COUNT.size
+INDEX_RECORD_SIZE = _RECORD.size
+
+
+def is_pack_index(filename: str) -> bool:
+    return filename.startswith(PACK_PREFIX) and filename.endswith(INDEX_SUFFIX)
+
+
+def pack_files(index_path: str) -> Tuple[str, str]:
+    """Given the path to a pack's index, return the paths of the (pack, index) files"""
+    return (index_path[: -len(INDEX_SUFFIX)] + PACK_SUFFIX, index_path)
+
+
+class PackReader:
+    """Random access to the objects of a pack, given the path to its index.
+    The index is memory mapped and the pack file is only opened when
+    an object is read.
+    """
+
+    def __init__(self, index_path: str):
+        self.pack_path, self.index_path = pack_files(index_path)
+        with open(index_path, "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._index[0 : len(INDEX_HEADER)] != INDEX_HEADER:
+            self._index.close()
+            raise ValueError("%s is not a pack index" % index_path)
+        self.num_objects = _COUNT.unpack_from(self._index, len(INDEX_HEADER))[0]
+        self._pack = None  # type: Optional[object]
+
+    def _record(self, i: int) -> Tuple[bytes, int, int]:
+        return _RECORD.unpack_from(self._index, _RECORDS_START + i * _RECORD.size)
+
+    def _find(self, hashval: str) -> Optional[Tuple[int, int]]:
+        try:
+            key = bytes.fromhex(hashval)
+        except ValueError:
+            return None
+        lo = 0
+        hi = self.num_objects
+        while lo < hi:
+            mid = (lo + hi) // 2
+            h, offset, length = self._record(mid)
+            if h == key:
+                return (offset, length)
+            elif h < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def __contains__(self, hashval: str) -> bool:
+        return self._find(hashval) is not None
+
+    def read(self, hashval: str) -> Optional[bytes]:
+        """Return the contents of the object, or None if it is not in this pack"""
+        location = self._find(hashval)
+        if location is None:
+            return None
+        if self._pack is None:
+            self._pack = open(self.pack_path, "rb")
+        self._pack.seek(location[0])  # type: ignore
+        data = self._pack.read(location[1])  # type: ignore
+        if len(data) != location[1]:
+            raise IOError("Pack file %s is truncated" % self.pack_path)
+        return data
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the hashes of the objects in the pack, in sorted order"""
+        for i in range(self.num_objects):
+            yield self._record(i)[0].hex()
+
+    def iter_sizes(self) -> Iterator[Tuple[str, int]]:
+        """Iterate over the (hash, length) of the objects in the pack, in sorted order"""
+        for i in range(self.num_objects):
+            h, _, length = self._record(i)
+            yield (h.hex(), length)
+
+    def close(self) -> None:
+        self._index.close()
+        if self._pack is not None:
+            self._pack.close()  # type: ignore
+            self._pack = None
+
+
+class PackWriter:
+    """Create a new pack in :dirpath:. Objects are appended to a temporary file
+    by add(), and finish() writes the index and gives the files their final names.
+    """
+
+    def __init__(self, dirpath: str):
+        self.dirpath = dirpath
+        fd, self._tmp_path = tempfile.mkstemp(dir=dirpath, suffix=PACK_SUFFIX)
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(PACK_HEADER)
+        self._offset = len(PACK_HEADER)
+        self._pack_hash = hashlib.sha1(PACK_HEADER)
+        self._objects: Dict[bytes, Tuple[int, int]] = {}
+
+    def __contains__(self, hashval: str) -> bool:
+        return bytes.fromhex(hashval) in self._objects
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def add(self, hashval: str, data: bytes) -> bool:
+        """Append the object to the pack, unless it is already present.
+        Returns True if the object was added."""
+        key = bytes.fromhex(hashval)
+        if key in self._objects:
+            return False
+        self._file.write(data)
+        self._pack_hash.update(data)
+        self._objects[key] = (self._offset, len(data))
+        self._offset += len(data)
+        return True
+
+    def finish(self) -> List[str]:
+        """Write the index and rename the files. Returns the paths of the
+        pack and index files, or an empty list if no objects were added."""
+        self._file.close()
+        if len(self._objects) == 0:
+            os.remove(self._tmp_path)
+            return []
+        name = PACK_PREFIX + self._pack_hash.hexdigest()
+        pack_path = os.path.join(self.dirpath, name + PACK_SUFFIX)
+        index_path = os.path.join(self.dirpath, name + INDEX_SUFFIX)
+        records = [INDEX_HEADER, _COUNT.pack(len(self._objects))]
+        for key in sorted(self._objects.keys()):
+            offset, length = self._objects[key]
+            records.append(_RECORD.pack(key, offset, length))
+        fd, tmp_index_path = tempfile.mkstemp(dir=self.dirpath, suffix=INDEX_SUFFIX)
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"".join(records))
+        for path in (self._tmp_path, tmp_index_path):
+            os.chmod(path, int("644", 8))
+        # The pack is renamed first, so that an index never refers to a missing pack
+        safe_rename(self._tmp_path, pack_path)
+        safe_rename(tmp_index_path, index_path)
+        return [pack_path, index_path]
+
+    def abort(self) -> None:
+        """Discard the pack, if it has not been finished"""
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self._tmp_path)
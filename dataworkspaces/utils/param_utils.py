@@ -88,6 +88,52 @@ class BoolType(ParamType):
         return "bool"
 
 
+class IntType(ParamType):
+    def __init__(self, min_value: Optional[int] = None):
+        self.min_value = min_value
+
+    def parse(self, str_value: str) -> int:
+        try:
+            return int(str_value)
+        except ValueError:
+            raise ParamParseError(
+                "Unable to parse integer parameter value was '%s'" % repr(str_value)
+            )
+
+    def validate(self, value: Any) -> None:
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ParamValidationError("Parameter must be an int, value was '%s'" % repr(value))
+        if self.min_value is not None and value < self.min_value:
+            raise ParamValidationError(
+                "Parameter must be at least %d, value was %d" % (self.min_value, value)
+            )
+
+    def __repr__(self):
+        return "IntType(min_value=%r)" % self.min_value
+
+    def __str__(self):
+        return "int"
+
+
+class EnumType(ParamType):
+    """A string parameter that must be one of a fixed set of values"""
+
+    def __init__(self, *values: str):
+        self.values = values
+
+    def validate(self, value: Any) -> None:
+        if value not in self.values:
+            raise ParamValidationError(
+                "Value '%s' is not one of %s" % (repr(value), ", ".join(self.values))
+            )
+
+    def __repr__(self):
+        return "EnumType(%s)" % ", ".join([repr(v) for v in self.values])
+
+    def __str__(self):
+        return "|".join(self.values)
+
+
 class StringType(ParamType):
     def validate(self, value: Any) -> None:
         if not isinstance(value, str):
@@ -264,6 +310,42 @@ SCRATCH_DIRECTORY = define_param(
 )
 
 
+LOCAL_FILES_HASH_WORKERS = define_param(
+    "local_files.hash_workers",
+    default_value=1,
+    optional=False,
+    help="Default number of worker threads used to hash files of local files resources. "
+    + "Can be overridden for an individual resource via its hash_workers parameter.",
+    ptype=IntType(min_value=1),
+)
+
+
+SNAPSHOT_WORKERS = define_param(
+    "snapshot.workers",
+    default_value=4,
+    optional=False,
+    help="Maximum number of resources whose snapshots (and prechecks) are taken "
+    + "concurrently. Set to 1 to snapshot the resources one at a time.",
+    ptype=IntType(min_value=1),
+)
+
+
+# Layouts for the snapshot metadata and manifest files
+FLAT_LAYOUT = "flat"
+SHARDED_LAYOUT = "sharded"
+
+SNAPSHOT_METADATA_LAYOUT = define_param(
+    "snapshot.metadata_layout",
+    default_value=FLAT_LAYOUT,
+    optional=False,
+    help="How the metadata and manifest files of snapshots are stored: 'flat' puts them all "
+    + "in one directory, 'sharded' in subdirectories named by the first two characters "
+    + "of the snapshot hash. New workspaces use the sharded layout. Use "
+    + "'dws migrate-snapshot-layout' to move the files of an existing workspace.",
+    ptype=EnumType(FLAT_LAYOUT, SHARDED_LAYOUT),
+)
+
+
 def get_global_param_defaults():
     """Return a mapping of all default values of global params for use
     in generating the initial config file
@@ -321,6 +403,15 @@ LOCAL_SCRATCH_DIRECTORY = define_local_param(
     ptype=AbspathType(),
 )
 
+TIMINGS_LOG = define_local_param(
+    "timings_log",
+    default_value=False,
+    optional=False,
+    help="If true, the time and resources used by each phase of a snapshot or restore are "
+    + "appended as a line of JSON to dws_timings.jsonl in the scratch directory.",
+    ptype=BoolType(),
+)
+
 
 def init_scratch_directory(
     scratch_dir: str,
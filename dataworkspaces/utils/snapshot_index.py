@@ -0,0 +1,379 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+An index of the snapshot metadata files of a workspace, stored in a sqlite
+database, so that snapshots can be looked up by tag or partial hash and listed
+by timestamp without reading every metadata file. The numeric metrics of the
+snapshots are also kept in a table of (snapshot, metric, value) rows, indexed
+by metric and value, so that the best values of a metric can be found, or all
+of its values read, without parsing the metadata of each snapshot.
+
+The metadata files remain the authoritative copy: the index can always be
+rebuilt from them. Before each lookup, the index is synchronized with the
+metadata directory. Only directories whose mtime has changed (e.g. because a
+pull added files) are rescanned, and only the files in them whose size or mtime
+has changed are parsed. Writers should call update() or remove() after changing
+a metadata file, as rewriting a file in place does not change the mtime of
+its directory. As with git's index, an mtime too close to the time of the scan
+is not trusted, as the file or directory could change again within the same
+timestamp tick.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from os.path import join
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from dataworkspaces.utils.metrics_utils import Condition, numeric_metrics
+
+SCHEMA_VERSION = "4"
+
+# mtimes less than this many nanoseconds before a scan are not recorded
+RACY_INTERVAL_NS = 2 * 10**9
+
+# hashes per query when selecting by hash, below sqlite's limit on query parameters
+MAX_QUERY_PARAMS = 500
+
+JSONDict = Dict[str, Any]
+
+
+def _trusted_mtime(mtime_ns: int) -> int:
+    """Return mtime_ns, or -1 (never matches) if it is too recent to be trusted"""
+    return mtime_ns if int(time.time() * 10 ** 9) - mtime_ns >= RACY_INTERVAL_NS else -1
+
+
+class SnapshotIndex:
+    """Index of the metadata files ending in :suffix: in the directory :md_dir:
+    (and its subdirectories). If :db_path: is None, the index is kept in memory.
+    """
+
+    def __init__(self, db_path: Optional[str], md_dir: str, suffix: str = "_md.json"):
+        self.md_dir = md_dir
+        self.suffix = suffix
+        self.conn = sqlite3.connect(db_path if db_path is not None else ":memory:", timeout=60)
+        self.conn.execute("create table if not exists state (key text primary key, value text)")
+        row = self.conn.execute("select value from state where key='schema_version'").fetchone()
+        if row is None or row[0] != SCHEMA_VERSION:
+            self._create_tables()
+
+    def _create_tables(self) -> None:
+        for table in ["snapshots", "tags", "metric_values", "dirs"]:
+            self.conn.execute("drop table if exists %s" % table)
+        self.conn.execute(
+            "create table snapshots (hashval text primary key, dir text not null, "
+            + "relpath text not null, mtime_ns integer not null, size integer not null, "
+            + "timestamp text not null, hostname text, snapshot_number integer, "
+            + "metrics text, data text not null)"
+        )
+        self.conn.execute("create index snapshots_by_dir on snapshots (dir)")
+        self.conn.execute(
+            "create index snapshots_by_number on snapshots (hostname, snapshot_number)"
+        )
+        self.conn.execute("create index snapshots_by_timestamp on snapshots (timestamp, hashval)")
+        self.conn.execute("create table tags (tag text not null, hashval text not null)")
+        self.conn.execute("create index tags_by_tag on tags (tag)")
+        self.conn.execute("create index tags_by_hashval on tags (hashval)")
+        self.conn.execute(
+            "create table metric_values (hashval text not null, metric text not null, "
+            + "value real not null)"
+        )
+        self.conn.execute("create index metric_values_by_value on metric_values (metric, value)")
+        self.conn.execute("create index metric_values_by_hashval on metric_values (hashval)")
+        self.conn.execute("create table dirs (dir text primary key, mtime_ns integer not null)")
+        self.conn.execute(
+            "insert or replace into state values ('schema_version', ?)", (SCHEMA_VERSION,)
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _put(self, reldir: str, relpath: str, st: os.stat_result, data: JSONDict) -> None:
+        hashval = data["hash"]
+        self._delete(hashval)
+        self.conn.execute(
+            "insert into snapshots values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                hashval,
+                reldir,
+                relpath,
+                _trusted_mtime(st.st_mtime_ns),
+                st.st_size,
+                data["timestamp"],
+                data.get("hostname"),
+                data.get("snapshot_number"),
+                json.dumps(data.get("metrics")),
+                json.dumps(data),
+            ),
+        )
+        self.conn.executemany(
+            "insert into tags values (?, ?)", [(tag, hashval) for tag in data["tags"]]
+        )
+        self.conn.executemany(
+            "insert into metric_values values (?, ?, ?)",
+            [
+                (hashval, metric, value)
+                for (metric, value) in numeric_metrics(data.get("metrics")).items()
+            ],
+        )
+
+    def _delete(self, hashval: str) -> None:
+        self.conn.execute("delete from snapshots where hashval=?", (hashval,))
+        self.conn.execute("delete from tags where hashval=?", (hashval,))
+        self.conn.execute("delete from metric_values where hashval=?", (hashval,))
+
+    def _scan_dir(self, reldir: str, mtime_ns: int) -> None:
+        """Bring the entries for the files directly in reldir up to date"""
+        indexed = {
+            relpath: (hashval, mtime, size)
+            for (hashval, relpath, mtime, size) in self.conn.execute(
+                "select hashval, relpath, mtime_ns, size from snapshots where dir=?", (reldir,)
+            )
+        }
+        with os.scandir(join(self.md_dir, reldir)) as it:
+            entries = list(it)
+        for entry in entries:
+            relpath = join(reldir, entry.name) if reldir != "" else entry.name
+            if entry.is_dir():
+                if (
+                    self.conn.execute("select 1 from dirs where dir=?", (relpath,)).fetchone()
+                    is None
+                ):
+                    self._scan_dir(relpath, entry.stat().st_mtime_ns)
+            elif entry.name.endswith(self.suffix):
+                st = entry.stat()
+                old = indexed.pop(relpath, None)
+                if old is not None and old[1] == st.st_mtime_ns and old[2] == st.st_size:
+                    continue
+                with open(entry.path, "r") as f:
+                    self._put(reldir, relpath, st, json.load(f))
+        for relpath, (hashval, _, _) in indexed.items():
+            # the file may have moved to a subdirectory (e.g. when sharding), in
+            # which case its entry has already been replaced
+            if (
+                self.conn.execute(
+                    "select 1 from snapshots where hashval=? and relpath=?", (hashval, relpath)
+                ).fetchone()
+                is not None
+            ):
+                self._delete(hashval)
+        self.conn.execute(
+            "insert or replace into dirs values (?, ?)", (reldir, _trusted_mtime(mtime_ns))
+        )
+
+    def sync(self) -> None:
+        """Update the index from any metadata directories that have changed"""
+        dirs = {d: m for (d, m) in self.conn.execute("select dir, mtime_ns from dirs")}
+        if "" not in dirs:
+            dirs[""] = -1
+        for reldir, mtime_ns in sorted(dirs.items()):
+            try:
+                current_mtime_ns = os.stat(join(self.md_dir, reldir)).st_mtime_ns
+            except FileNotFoundError:
+                for (hashval,) in self.conn.execute(
+                    "select hashval from snapshots where dir=?", (reldir,)
+                ).fetchall():
+                    self._delete(hashval)
+                self.conn.execute("delete from dirs where dir=?", (reldir,))
+                continue
+            if current_mtime_ns != mtime_ns:
+                self._scan_dir(reldir, current_mtime_ns)
+        self.conn.commit()
+
+    def rebuild(self) -> None:
+        """Rebuild the index from scratch, from the metadata files"""
+        self._create_tables()
+        self.sync()
+
+    def update(self, relpath: str) -> None:
+        """Update the index entry for the metadata file at relpath (relative to
+        md_dir), after it was written"""
+        reldir = os.path.dirname(relpath)
+        fpath = join(self.md_dir, relpath)
+        st = os.stat(fpath)
+        with open(fpath, "r") as f:
+            self._put(reldir, relpath, st, json.load(f))
+        self.conn.commit()
+
+    def remove(self, hashval: str) -> None:
+        """Remove the entry for a snapshot, after its metadata file was deleted"""
+        self._delete(hashval)
+        self.conn.commit()
+
+    def remove_many(self, hashvals: Iterable[str]) -> None:
+        """Remove the entries for several snapshots, in a single transaction"""
+        for hashval in hashvals:
+            self._delete(hashval)
+        self.conn.commit()
+
+    def _fetch_data(self, query: str, args: tuple) -> List[JSONDict]:
+        return [json.loads(data) for (data,) in self.conn.execute(query, args)]
+
+    def get(self, hashval: str) -> Optional[JSONDict]:
+        rows = self._fetch_data("select data from snapshots where hashval=?", (hashval,))
+        return rows[0] if len(rows) > 0 else None
+
+    def get_by_tag(self, tag: str) -> Optional[JSONDict]:
+        rows = self._fetch_data(
+            "select data from snapshots where hashval in "
+            + "(select hashval from tags where tag=?) order by timestamp desc limit 1",
+            (tag,),
+        )
+        return rows[0] if len(rows) > 0 else None
+
+    def get_by_partial_hash(self, partial_hash: str) -> Optional[JSONDict]:
+        # hashes are lowercase hex strings, so they all sort before the "g"
+        rows = self._fetch_data(
+            "select data from snapshots where hashval >= ? and hashval < ? "
+            + "order by hashval limit 1",
+            (partial_hash, partial_hash + "g"),
+        )
+        return rows[0] if len(rows) > 0 else None
+
+    def count(self) -> int:
+        return self.conn.execute("select count(*) from snapshots").fetchone()[0]
+
+    def max_snapshot_number(self, hostname: str) -> int:
+        """Return the highest snapshot number recorded for hostname, or 0 if none"""
+        row = self.conn.execute(
+            "select max(snapshot_number) from snapshots where hostname=?", (hostname,)
+        ).fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def list(self, reverse: bool = True, max_count: Optional[int] = None) -> List[JSONDict]:
+        """Return the metadata of the snapshots, sorted by timestamp"""
+        order = "desc" if reverse else "asc"
+        return self._fetch_data(
+            "select data from snapshots order by timestamp %s, hashval %s limit ?" % (order, order),
+            (max_count if max_count is not None else -1,),
+        )
+
+    def iter(
+        self,
+        reverse: bool = True,
+        page_size: int = 100,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+        tag: Optional[str] = None,
+        hostname: Optional[str] = None,
+    ) -> Iterator[JSONDict]:
+        """Iterate through the metadata of the snapshots that match the filters,
+        sorted by timestamp (and then hash). The time range is [start_time, end_time).
+        Each page of page_size entries is read by a separate query that resumes
+        after the last entry of the previous page, so reading the first n entries
+        costs O(n), independent of the number of snapshots.
+        """
+        if page_size < 1:
+            raise ValueError("Page size must be at least 1, not %d" % page_size)
+        conditions = []  # type: List[str]
+        args = []  # type: List[Any]
+        if start_time is not None:
+            conditions.append("timestamp >= ?")
+            args.append(start_time)
+        if end_time is not None:
+            conditions.append("timestamp < ?")
+            args.append(end_time)
+        if tag is not None:
+            conditions.append("hashval in (select hashval from tags where tag=?)")
+            args.append(tag)
+        if hostname is not None:
+            conditions.append("hostname=?")
+            args.append(hostname)
+        op, order = ("<", "desc") if reverse else (">", "asc")
+        last = None  # type: Optional[tuple]
+        while True:
+            page_conditions = list(conditions)
+            page_args = list(args)
+            if last is not None:
+                page_conditions.append(
+                    "timestamp %s= ? and (timestamp %s ? or hashval %s ?)" % (op, op, op)
+                )
+                page_args.extend([last[0], last[0], last[1]])
+            rows = self.conn.execute(
+                "select timestamp, hashval, data from snapshots%s "
+                % ((" where " + " and ".join(page_conditions)) if len(page_conditions) > 0 else "")
+                + "order by timestamp %s, hashval %s limit ?" % (order, order),
+                tuple(page_args) + (page_size,),
+            ).fetchall()
+            for _, _, data in rows:
+                yield json.loads(data)
+            if len(rows) < page_size:
+                return
+            last = (rows[-1][0], rows[-1][1])
+
+    def list_metrics(self) -> List[str]:
+        """Return the names of the numeric metrics of any snapshot, sorted"""
+        return [
+            metric
+            for (metric,) in self.conn.execute(
+                "select distinct metric from metric_values order by metric"
+            )
+        ]
+
+    def get_metric_values(
+        self, metric: str, hashvals: Optional[Iterable[str]] = None
+    ) -> Dict[str, float]:
+        """Return a map from snapshot hash to value for the metric. If hashvals
+        is specified, only the values for those snapshots are read.
+        """
+        if hashvals is None:
+            return {
+                hashval: value
+                for (hashval, value) in self.conn.execute(
+                    "select hashval, value from metric_values where metric=?", (metric,)
+                )
+            }
+        hashvals = list(hashvals)
+        values = {}  # type: Dict[str, float]
+        for i in range(0, len(hashvals), MAX_QUERY_PARAMS):
+            batch = hashvals[i : i + MAX_QUERY_PARAMS]
+            values.update(
+                self.conn.execute(
+                    "select hashval, value from metric_values where metric=? and hashval in (%s)"
+                    % ", ".join(["?"] * len(batch)),
+                    (metric,) + tuple(batch),
+                )
+            )
+        return values
+
+    def query_metrics(
+        self,
+        metric: str,
+        top_k: Optional[int] = None,
+        where: Iterable[Condition] = (),
+        maximize: bool = True,
+    ) -> List[Tuple[str, str, List[str], float]]:
+        """Return (hash, timestamp, tags, value) for the snapshots that have the metric
+        and satisfy the conditions, best value first (largest if maximize is True,
+        otherwise smallest), up to top_k entries. Ties go to the most recent snapshot.
+        The conditions should have been checked with check_conditions().
+        """
+        conditions = ["m.metric=?"]
+        args = [metric]  # type: List[Any]
+        for other_metric, op, value in where:
+            conditions.append(
+                "m.hashval in (select hashval from metric_values where metric=? and value %s ?)"
+                % op
+            )
+            args.extend([other_metric, value])
+        rows = self.conn.execute(
+            "select m.hashval, s.timestamp, m.value from metric_values m "
+            + "join snapshots s on s.hashval=m.hashval where %s " % " and ".join(conditions)
+            + "order by m.value %s, s.timestamp desc limit ?" % ("desc" if maximize else "asc"),
+            tuple(args) + (top_k if top_k is not None else -1,),
+        ).fetchall()
+        return [
+            (
+                hashval,
+                timestamp,
+                [
+                    tag
+                    for (tag,) in self.conn.execute(
+                        "select tag from tags where hashval=? order by rowid", (hashval,)
+                    )
+                ],
+                value,
+            )
+            for (hashval, timestamp, value) in rows
+        ]
@@ -10,12 +10,12 @@ import re
 import stat
 from tempfile import NamedTemporaryFile
 import shutil
-from typing import Set, List, Pattern, Union, Callable
+from typing import Set, List, Pattern, Union, Callable, Any
 
 import click
 
 from dataworkspaces.errors import ConfigurationError
-from dataworkspaces.utils.file_utils import remove_dir_if_empty
+from dataworkspaces.utils.file_utils import remove_dir_if_empty, walk_sorted
 from dataworkspaces.utils.hash_utils import hash_file
 
 # Timestamps have the form '2018-09-30T14:09:05'
@@ -135,6 +135,24 @@ def copy_file_and_set_readonly(src: str, dest: str) -> None:
 DOT_GIT_RE = re.compile("^" + re.escape(".git") + "$")
 
 
+def _make_skip_dir(
+    base_dir: str, exclude_dirs_re_list: List[Pattern], verbose: bool
+) -> Callable[[Any], bool]:
+    """Directories are excluded if their path relative to base_dir
+    matches one of the regular expressions."""
+
+    def skip_dir(entry: Any) -> bool:
+        rel_dirpath = entry.path[len(base_dir) + 1 :]
+        for exclude_dirs_re in exclude_dirs_re_list:
+            if exclude_dirs_re.match(rel_dirpath):
+                if verbose:
+                    print("Skipping directory %s" % rel_dirpath)
+                return True
+        return False
+
+    return skip_dir
+
+
 def move_current_files_local_fs(
     resource_name: str,
     base_dir: str,
@@ -164,31 +182,20 @@ def move_current_files_local_fs(
         exclude_dirs_res if isinstance(exclude_dirs_res, list) else [exclude_dirs_res,]
     )  # type: List[Pattern]
     exclude_dirs_re_list.append(DOT_GIT_RE)
-    for (dirpath, dirnames, filenames) in os.walk(base_dir):
+    # directories matching exclude_dirs_re_list are skipped, as they represent
+    # results from prior runs
+    for dirpath, dirs, files in walk_sorted(
+        base_dir, skip_dir=_make_skip_dir(base_dir, exclude_dirs_re_list, verbose)
+    ):
         assert dirpath.startswith(base_dir)
         rel_dirpath = dirpath[len(base_dir) + 1 :]
 
-        def join_to_rel_dirpath(f):
-            return join(rel_dirpath, f)
-
-        join_rel_path = join_to_rel_dirpath if len(rel_dirpath) > 0 else lambda f: f
-        # find directories we should skip, as they represent results from
-        # prior runs
-        skip = []
-        for (i, dir_name) in enumerate(dirnames):
-            abs_dirpath = join(dirpath, dir_name)
-            rel_dirpath = abs_dirpath[len(base_dir) + 1 :]
-            for exclude_dirs_re in exclude_dirs_re_list:
-                if exclude_dirs_re.match(rel_dirpath):
-                    skip.append(i)
-                    if verbose:
-                        print("Skipping directory %s" % rel_dirpath)
-        skip.reverse()
-        for i in skip:
-            del dirnames[i]
+        def join_rel_path(f):
+            return join(rel_dirpath, f) if len(rel_dirpath) > 0 else f
+
         # move files to our new directory
         moved_files_out_of_this_dir = False
-        for f in filenames:
+        for f in [entry.name for entry in files]:
             rel_src_file = join_rel_path(f)
             if rel_src_file in exclude_files:
                 if verbose:
@@ -248,30 +255,19 @@ def copy_current_files_local_fs(
         exclude_dirs_res if isinstance(exclude_dirs_res, list) else [exclude_dirs_res,]
     )  # type: List[Pattern]
     exclude_dirs_re_list.append(DOT_GIT_RE)
-    for (dirpath, dirnames, filenames) in os.walk(base_dir):
+    # directories matching exclude_dirs_re_list are skipped, as they represent
+    # results from prior runs
+    for dirpath, dirs, files in walk_sorted(
+        base_dir, skip_dir=_make_skip_dir(base_dir, exclude_dirs_re_list, verbose)
+    ):
         assert dirpath.startswith(base_dir)
         rel_dirpath = dirpath[len(base_dir) + 1 :]
 
-        def join_to_rel_dirpath(f):
-            return join(rel_dirpath, f)
-
-        join_rel_path = join_to_rel_dirpath if len(rel_dirpath) > 0 else lambda f: f
-        # find directories we should skip, as they represent results from
-        # prior runs
-        skip = []
-        for (i, dir_name) in enumerate(dirnames):
-            abs_dirpath = join(dirpath, dir_name)
-            rel_dirpath = abs_dirpath[len(base_dir) + 1 :]
-            for exclude_dirs_re in exclude_dirs_re_list:
-                if exclude_dirs_re.match(rel_dirpath):
-                    skip.append(i)
-                    if verbose:
-                        print("Skipping directory %s" % rel_dirpath)
-        skip.reverse()
-        for i in skip:
-            del dirnames[i]
+        def join_rel_path(f):
+            return join(rel_dirpath, f) if len(rel_dirpath) > 0 else f
+
         # copy files to our new directory
-        for f in filenames:
+        for f in [entry.name for entry in files]:
             rel_src_file = join_rel_path(f)
             if rel_src_file in exclude_files:
                 if verbose:
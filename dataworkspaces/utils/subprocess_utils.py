@@ -7,16 +7,27 @@ from os.path import abspath, expanduser, join, isfile
 import click
 
 from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.utils import timing_utils
 
 
-def call_subprocess(args, cwd, verbose=False):
+def run_subprocess(args, cwd, num_processes=1, **kwargs):
+    """Run a child process with subprocess.run() and return its CompletedProcess,
+    counting it for the timing report (see timing_utils). If args is a shell
+    pipeline, num_processes should be the number of commands in it.
+    """
+    timing_utils.count(timing_utils.SUBPROCESSES, num_processes)
+    return run(args, cwd=cwd, **kwargs)
+
+
+def call_subprocess(args, cwd, verbose=False, input=None):
     """Call an executable as a child process. Returns the standard output.
     If it fails, we will print
     an error and allow CalledProcessError to be thrown.
+    If input is specified, it is passed to the child as its standard input.
     """
     if verbose:
         click.echo(" ".join(args) + " [run in %s]" % cwd)
-    cp = run(args, cwd=cwd, encoding="utf-8", stdout=PIPE, stderr=PIPE)
+    cp = run_subprocess(args, cwd, encoding="utf-8", input=input, stdout=PIPE, stderr=PIPE)
     try:
         cp.check_returncode()
     except CalledProcessError:
@@ -33,7 +44,7 @@ def call_subprocess_for_rc(args, cwd, verbose=False):
     """
     if verbose:
         click.echo(" ".join(args) + " [run in %s]" % cwd)
-    cp = run(args, cwd=cwd, encoding="utf-8", stdout=PIPE, stderr=PIPE)
+    cp = run_subprocess(args, cwd, encoding="utf-8", stdout=PIPE, stderr=PIPE)
     if verbose:
         click.echo(cp.stdout)
         click.echo("%s exited with %d" % (args[0], cp.returncode))
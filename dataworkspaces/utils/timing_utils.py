@@ -0,0 +1,205 @@
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""
+Record the wall time, CPU time and resource usage of the phases of a long-running
+command (e.g. snapshot or restore), so that we can see where the time goes.
+
+A command starts a recording via recording(). Code anywhere in the call tree then
+marks its phases via timed_phase() and its work via count(). When no recording is
+active, these calls do nothing, so they can be left in the code at little cost.
+"""
+
+import datetime
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    import resource as _resource  # not available on Windows
+except ImportError:
+    _resource = None  # type: ignore
+
+# The counters kept for each phase
+FILES_VISITED = "files_visited"
+BYTES_READ = "bytes_read"
+SUBPROCESSES = "subprocesses"
+COUNTERS = [FILES_VISITED, BYTES_READ, SUBPROCESSES]
+
+# Name of the file in the scratch directory where timings are logged
+TIMINGS_LOG_FILE = "dws_timings.jsonl"
+
+
+def _cpu_time() -> float:
+    """Return the CPU time used by this process and its (finished) children"""
+    t = time.process_time()
+    if _resource is not None:
+        ru = _resource.getrusage(_resource.RUSAGE_CHILDREN)
+        t += ru.ru_utime + ru.ru_stime
+    return t
+
+
+class Phase:
+    """The measurements of one phase. The depth is the number of enclosing phases."""
+
+    def __init__(self, name: str, resource: Optional[str], depth: int):
+        self.name = name
+        self.resource = resource
+        self.depth = depth
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.counts = {c: 0 for c in COUNTERS}  # type: Dict[str, int]
+
+    def to_json(self) -> Dict[str, Any]:
+        data = {
+            "name": self.name,
+            "resource": self.resource,
+            "depth": self.depth,
+            "wall_time": round(self.wall_time, 6),
+            "cpu_time": round(self.cpu_time, 6),
+        }  # type: Dict[str, Any]
+        data.update(self.counts)
+        return data
+
+
+class TimingRecorder:
+    """Records the phases of a command. Phases nest: the counts of a phase include
+    those of the phases it encloses. Each thread has its own stack of active phases,
+    so use wrap() when handing work to another thread.
+
+    The CPU time is for the whole process, so the CPU times of phases that run
+    concurrently (e.g. the snapshots of different resources) overlap.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.timestamp = datetime.datetime.now()
+        self.phases = []  # type: List[Phase]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[Phase]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    @contextmanager
+    def phase(self, name: str, resource: Optional[str] = None) -> Iterator[Phase]:
+        stack = self._stack()
+        p = Phase(name, resource, len(stack))
+        with self._lock:
+            self.phases.append(p)
+        stack.append(p)
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        try:
+            yield p
+        finally:
+            p.wall_time = time.perf_counter() - start_wall
+            p.cpu_time = _cpu_time() - start_cpu
+            stack.pop()
+
+    def count(self, counter: str, n: int) -> None:
+        stack = getattr(self._local, "stack", None)
+        if not stack:
+            return
+        with self._lock:
+            for p in stack:
+                p.counts[counter] += n
+
+    def wrap(self, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Return a version of fn which, when called in another thread, runs within
+        the phases currently active in this thread."""
+        parent_stack = list(self._stack())
+
+        def wrapped(*args, **kwargs):
+            self._local.stack = list(parent_stack)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.stack = []
+
+        return wrapped
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "command": self.command,
+            "timestamp": self.timestamp.isoformat(),
+            "phases": [p.to_json() for p in self.phases],
+        }
+
+    def format_report(self) -> str:
+        lines = [
+            "%-40s %10s %10s %10s %14s %9s"
+            % ("Phase", "Wall (s)", "CPU (s)", "Files", "Bytes read", "Subprocs")
+        ]
+        for p in self.phases:
+            name = "  " * p.depth + p.name
+            if p.resource is not None:
+                name += " [%s]" % p.resource
+            lines.append(
+                "%-40s %10.3f %10.3f %10d %14d %9d"
+                % (
+                    name,
+                    p.wall_time,
+                    p.cpu_time,
+                    p.counts[FILES_VISITED],
+                    p.counts[BYTES_READ],
+                    p.counts[SUBPROCESSES],
+                )
+            )
+        return "\n".join(lines)
+
+    def append_to_log(self, log_path: str, **extra: Any) -> None:
+        """Append the timings as a single line of JSON to the file at log_path,
+        along with any extra key/value pairs (e.g. the snapshot hash)."""
+        data = self.to_json()
+        data.update(extra)
+        with open(log_path, "a") as f:
+            f.write(json.dumps(data) + "\n")
+
+
+_recorder = None  # type: Optional[TimingRecorder]
+
+
+@contextmanager
+def recording(command: str, enabled: bool = True) -> Iterator[Optional[TimingRecorder]]:
+    """Record the timings of a command, which run as a single top-level phase.
+    Yields the recorder, or None if not enabled."""
+    global _recorder
+    if not enabled or _recorder is not None:
+        yield None
+        return
+    _recorder = TimingRecorder(command)
+    try:
+        with _recorder.phase(command):
+            yield _recorder
+    finally:
+        _recorder = None
+
+
+@contextmanager
+def timed_phase(name: str, resource: Optional[str] = None) -> Iterator[None]:
+    """Time the enclosed code as a phase of the current recording, if any"""
+    recorder = _recorder
+    if recorder is None:
+        yield
+    else:
+        with recorder.phase(name, resource):
+            yield
+
+
+def count(counter: str, n: int = 1) -> None:
+    """Add n to the counter of the current phases, if we are recording"""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(counter, n)
+
+
+def propagate_phases(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap fn for calling from another thread (e.g. in a thread pool), so that its
+    timings are included in the current phases"""
+    recorder = _recorder
+    return fn if recorder is None else recorder.wrap(fn)
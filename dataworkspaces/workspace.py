@@ -44,7 +44,22 @@ The module ``dataworkspaces.commands.COMMAND`` should look like this::
 
 """
 
-from typing import Dict, Any, Iterable, Optional, List, Tuple, Set, cast, Pattern, Union
+from typing import (
+    Dict,
+    Any,
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    Optional,
+    List,
+    Tuple,
+    Set,
+    cast,
+    Pattern,
+    Union,
+    NamedTuple,
+)
 
 from abc import ABCMeta, abstractmethod
 import importlib
@@ -52,12 +67,14 @@ import os.path
 import os
 import datetime
 import getpass
+import concurrent.futures
 import json
 import re
 from urllib.parse import ParseResult, urlparse
 
 from dataworkspaces.errors import ConfigurationError, PathNotAResourceError, InternalError
 from dataworkspaces.utils.hash_utils import is_a_git_hash, is_a_shortened_git_hash, hash_bytes
+from dataworkspaces.utils.lock_utils import optional_file_lock
 
 from dataworkspaces.utils.param_utils import (
     PARAM_DEFS,
@@ -67,6 +84,7 @@ from dataworkspaces.utils.param_utils import (
     ParamNotFoundError,
     RESULTS_DIR_TEMPLATE,
     RESULTS_MOVE_EXCLUDE_FILES,
+    SNAPSHOT_WORKERS,
     HOSTNAME,
     ResourceParams,
 )
@@ -76,7 +94,14 @@ from dataworkspaces.utils.snapshot_utils import (
     make_re_pattern_for_dir_template,
 )
 from dataworkspaces.utils.file_utils import get_subpath_from_absolute
+from dataworkspaces.utils.metrics_utils import (
+    Condition,
+    check_conditions,
+    conditions_match,
+    numeric_metrics,
+)
 from dataworkspaces.utils.lineage_utils import ResourceRef, LineageStore
+from dataworkspaces.utils import timing_utils
 
 # Standin for a JSON object/dict. The value type is overly
 # permissive, as mypy does not yet support recursive types.
@@ -1071,7 +1096,8 @@ class CentralWorkspaceMixin(metaclass=ABCMeta):
 class SnapshotMetadata:
     """The metadata we store for each snapshot (in addition to the manifest).
     relative_destination_path refers to the path used in resources that copy their current
-    state to a subdirectory for each snapshot.
+    state to a subdirectory for each snapshot. snapshot_number is the number allocated to
+    the snapshot on its host (None for snapshots taken before numbers were recorded).
     """
 
     def __init__(
@@ -1085,6 +1111,7 @@ class SnapshotMetadata:
         restore_hashes: Dict[str, Optional[str]],
         metrics: Optional[JSONDict] = None,
         updated_timestamp: Optional[str] = None,
+        snapshot_number: Optional[int] = None,
     ):
         self.hashval = hashval.lower()  # always normalize to lower case
         self.tags = tags
@@ -1095,6 +1122,7 @@ class SnapshotMetadata:
         self.restore_hashes = restore_hashes
         self.metrics = metrics
         self.updated_timestamp = updated_timestamp
+        self.snapshot_number = snapshot_number
 
     def has_tag(self, tag):
         return True if tag in self.tags else False
@@ -1106,7 +1134,7 @@ class SnapshotMetadata:
         return True if self.hashval.startswith(partial_hash.lower()) else False
 
     def to_json(self) -> JSONDict:
-        v = {
+        v = {  # type: JSONDict
             "hash": self.hashval,
             "tags": self.tags,
             "message": self.message,
@@ -1118,6 +1146,8 @@ class SnapshotMetadata:
         }
         if self.updated_timestamp is not None:
             v["updated_timestamp"] = self.updated_timestamp
+        if self.snapshot_number is not None:
+            v["snapshot_number"] = self.snapshot_number
         return v
 
     @staticmethod
@@ -1132,12 +1162,33 @@ class SnapshotMetadata:
             data["restore_hashes"],
             data.get("metrics"),
             data.get("updated_timestamp"),
+            data.get("snapshot_number"),
         )
 
     def __str__(self):
         return json.dumps(self.to_json())
 
 
+def metrics_match(
+    md: SnapshotMetadata, metric_filter: Optional[Callable[[JSONDict], bool]]
+) -> bool:
+    """Return True if there is no metric filter, or if the snapshot has metrics and
+    they satisfy the filter.
+    """
+    return metric_filter is None or (md.metrics is not None and metric_filter(md.metrics))
+
+
+class MetricValue(NamedTuple):
+    """The value of a metric for a snapshot, as returned by
+    :func:`~SnapshotWorkspaceMixin.query_metrics`.
+    """
+
+    hashval: str
+    timestamp: str
+    tags: List[str]
+    value: float
+
+
 class SnapshotWorkspaceMixin(metaclass=ABCMeta):
     """Mixin class for workspaces that support snapshots and restores.
     """
@@ -1145,9 +1196,9 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
     @abstractmethod
     def get_next_snapshot_number(self) -> int:
         """Return a number that can be used for this snapshot. For a given
-        local copy of thw workspace, it is guaranteed to be unique and increasing.
-        It is not guarenteed to be globally unique (need to combine with hostname
-        to get that).
+        hostname, it is guaranteed to be unique and increasing, even when several
+        processes take snapshots concurrently. It is not guarenteed to be globally
+        unique (need to combine with hostname to get that).
         """
         pass
 
@@ -1158,9 +1209,56 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
 
         This method is called by snapshot()
         """
-        for r in current_resources:
-            if isinstance(r, SnapshotResourceMixin):
-                r.snapshot_precheck()
+        self._run_for_snapshot_resources(
+            current_resources,
+            lambda r: cast(SnapshotResourceMixin, r).snapshot_precheck(),
+            "precheck",
+        )
+
+    def _run_for_snapshot_resources(
+        self, resources: Iterable[Resource], fn: Callable[[Resource], Any], phase_name: str
+    ) -> List[Any]:
+        """Call fn on each of the resources that support snapshots and return the results,
+        in the order of the resources (None for the other resources). Resources that
+        support concurrent snapshots are run in a pool of up to SNAPSHOT_WORKERS
+        threads, after the others have been run one at a time. If calls in the pool
+        raise exceptions, the first one (in the order of the resources) is re-raised
+        once the pool has finished. Each call is timed as a phase named phase_name.
+        """
+        resources = list(resources)
+
+        def run_fn(r: Resource) -> Any:
+            with timing_utils.timed_phase(phase_name, r.name):
+                return fn(r)
+
+        results = [None] * len(resources)  # type: List[Any]
+        concurrent_indexes = []  # type: List[int]
+        for i, r in enumerate(resources):
+            if not isinstance(r, SnapshotResourceMixin):
+                continue
+            if cast(SnapshotResourceMixin, r).supports_concurrent_snapshot():
+                concurrent_indexes.append(i)
+            else:
+                results[i] = run_fn(r)
+        num_workers = min(
+            cast(Workspace, self).get_global_param(SNAPSHOT_WORKERS), len(concurrent_indexes)
+        )
+        if num_workers <= 1:
+            for i in concurrent_indexes:
+                results[i] = run_fn(resources[i])
+            return results
+        errors = []  # type: List[Exception]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pool_fn = timing_utils.propagate_phases(run_fn)
+            futures = [(i, executor.submit(pool_fn, resources[i])) for i in concurrent_indexes]
+            for i, future in futures:
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+        return results
 
     @abstractmethod
     def save_snapshot_metadata_and_manifest(
@@ -1172,12 +1270,14 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
         pass
 
     def snapshot(
-        self, tag: Optional[str] = None, message: str = ""
+        self, tag: Optional[str] = None, message: str = "", rehash: bool = False
     ) -> Tuple[SnapshotMetadata, bytes]:
         """Take snapshot of the resources in the workspace, and metadata
         for the snapshot and a manifest in the workspace.
         We assume that the tag does not already exist
         (checks can be made in the command before calling this method).
+        If rehash is True, resources are asked to bypass any caches when
+        computing their hashes.
 
         We also copy the lineage data if the workspace supports lineage.
 
@@ -1204,8 +1304,13 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
         exclude_dirs_re = re.compile(make_re_pattern_for_dir_template(results_dir_template))
         # Load the resource representation and run the prechecks
         current_resources = [r for r in cast(Workspace, self).get_resources()]
+        if rehash:
+            for r in current_resources:
+                if isinstance(r, SnapshotResourceMixin):
+                    r.bypass_caches()
 
-        self._snapshot_precheck(current_resources)
+        with timing_utils.timed_phase("precheck"):
+            self._snapshot_precheck(current_resources)
 
         # For exported resources, we need to delete any stale lineage.json files before the snapshot
         for r in current_resources:
@@ -1227,26 +1332,45 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
                     if isinstance(data, dict) and "metrics" in data:
                         metrics = data["metrics"]
                 if not r.is_exported():
-                    file_mixin.results_move_current_files(
-                        rel_dest_root, exclude_files, exclude_dirs_re
-                    )
+                    with timing_utils.timed_phase("move results", r.name):
+                        file_mixin.results_move_current_files(
+                            rel_dest_root, exclude_files, exclude_dirs_re
+                        )
                     resources_with_moved_files.append(r.name)
                 else:  # copy the results, but leave the current results in-place
-                    file_mixin.results_copy_current_files(
-                        rel_dest_root, exclude_files, exclude_dirs_re
-                    )
+                    with timing_utils.timed_phase("copy results", r.name):
+                        file_mixin.results_copy_current_files(
+                            rel_dest_root, exclude_files, exclude_dirs_re
+                        )
 
         # Take the actual snapshot
         manifest = []
         map_of_restore_hashes = {}  # type: Dict[str,Optional[str]]
         # compare hashes used for lineage
         map_of_compare_hashes = {}  # type: Dict[str,str]
-        # now take the actual snapshots
-        for r in current_resources:
-            if isinstance(r, SnapshotResourceMixin):
-                (compare_hash, restore_hash) = r.snapshot()
-            else:
-                (compare_hash, restore_hash) = (None, None)
+        # Resources that have not changed since the previous snapshot reuse its hashes
+        previous_hashes = (
+            self._get_previous_snapshot_hashes() if not rehash else {}
+        )  # type: Dict[str, Tuple[str, Optional[str]]]
+
+        def snapshot_resource(r: Resource) -> Tuple[Optional[str], Optional[str]]:
+            mixin = cast(SnapshotResourceMixin, r)
+            if r.name in previous_hashes and not mixin.has_changed_since(
+                previous_hashes[r.name][0]
+            ):
+                if workspace.verbose:
+                    print("Resource %s is unchanged since the previous snapshot" % r.name)
+                return previous_hashes[r.name]
+            return mixin.snapshot()
+
+        # now take the actual snapshots. They may run concurrently, but the
+        # manifest is built in the order of the resources, so that its hash is stable.
+        with timing_utils.timed_phase("resource snapshots"):
+            snapshot_hashes = self._run_for_snapshot_resources(
+                current_resources, snapshot_resource, "snapshot"
+            )
+        for r, hashes in zip(current_resources, snapshot_hashes):
+            compare_hash, restore_hash = hashes if hashes is not None else (None, None)
             if compare_hash is not None:
                 map_of_compare_hashes[r.name] = compare_hash
             map_of_restore_hashes[r.name] = restore_hash
@@ -1265,35 +1389,71 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
             rel_dest_root,
             map_of_restore_hashes,
             metrics,
+            snapshot_number=snapshot_number,
         )
 
         if self.supports_lineage():
-            instance = workspace.get_instance()
-            lstore = self.get_lineage_store()
-            lstore.replace_placeholders(instance, map_of_compare_hashes, verbose=workspace.verbose)
-            lstore.snapshot_lineage(instance, manifest_hash, [r.name for r in current_resources])
-
-            # TODO: consider whether the writing of lineage data and the clearing
-            # of results resources should be done outside of this method.
-
-            # We write the lineage data out after the snapshot, as we want it to
-            # include everything from the snapshot. Since results resources are
-            # additive, we won't be missing anything if we
-            # restore to this snapshot.
-            self.write_result_lineage_for_snapshot(
-                current_resources, metadata.relative_destination_path
-            )
-            self.write_export_lineage_for_snapshot(current_resources)
-
-            # For all the results resources for which we moved the files to a
-            # snapshot-specific subdirectory, we need to clear the lineage.
-            # This needs to happen after the previous step.
-            for rname in resources_with_moved_files:
-                lstore.clear_entry(instance, ResourceRef(rname, None))
-                if cast(Workspace, self).verbose:
-                    print("Cleared lineage for results resource %s" % rname)
+            with timing_utils.timed_phase("lineage"):
+                instance = workspace.get_instance()
+                lstore = self.get_lineage_store()
+                lstore.replace_placeholders(
+                    instance, map_of_compare_hashes, verbose=workspace.verbose
+                )
+                lstore.snapshot_lineage(
+                    instance, manifest_hash, [r.name for r in current_resources]
+                )
+
+                # TODO: consider whether the writing of lineage data and the clearing
+                # of results resources should be done outside of this method.
+
+                # We write the lineage data out after the snapshot, as we want it to
+                # include everything from the snapshot. Since results resources are
+                # additive, we won't be missing anything if we
+                # restore to this snapshot.
+                self.write_result_lineage_for_snapshot(
+                    current_resources, metadata.relative_destination_path
+                )
+                self.write_export_lineage_for_snapshot(current_resources)
+
+                # For all the results resources for which we moved the files to a
+                # snapshot-specific subdirectory, we need to clear the lineage.
+                # This needs to happen after the previous step.
+                for rname in resources_with_moved_files:
+                    lstore.clear_entry(instance, ResourceRef(rname, None))
+                    if cast(Workspace, self).verbose:
+                        print("Cleared lineage for results resource %s" % rname)
         return metadata, manifest_bytes
 
+    def abort_snapshot(self) -> None:
+        """Called by the snapshot command if anything fails between snapshot() and
+        saving the workspace, to discard any state the workspace keeps for the
+        in-progress snapshot. The default implementation does nothing.
+        """
+        pass
+
+    def snapshot_lock(self, shared: bool = False) -> ContextManager[None]:
+        """Return a context manager that holds the snapshot lock of the workspace.
+        Snapshots hold it shared, from taking the resource snapshots until the
+        workspace is saved, so that they can run concurrently. Garbage collection
+        holds it exclusively, so that it does not remove objects written by a
+        snapshot that has not been saved yet. The default implementation does no
+        locking.
+        """
+        return optional_file_lock(None)
+
+    def _get_previous_snapshot_hashes(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Return a mapping from resource names to the (compare, restore) hashes
+        of the resources in the most recent snapshot, if any.
+        """
+        md = self.get_most_recent_snapshot()
+        if md is None:
+            return {}
+        return {
+            entry["name"]: (entry["hash"], md.restore_hashes.get(entry["name"]))
+            for entry in self.get_snapshot_manifest(md.hashval)
+            if entry.get("hash") is not None
+        }
+
     def _restore_precheck(
         self,
         restore_hashes: Dict[str, Optional[str]],
@@ -1310,7 +1470,8 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
         for r in restore_resources:
             hashval = restore_hashes[cast(Resource, r).name]
             assert hashval is not None
-            r.restore_precheck(hashval)
+            with timing_utils.timed_phase("precheck", cast(Resource, r).name):
+                r.restore_precheck(hashval)
 
     def restore(
         self,
@@ -1322,21 +1483,25 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
         The list should have been previously filtered to include only
         those with valid (not None) restore hashes.
         """
-        self._restore_precheck(restore_hashes, restore_resources)
+        with timing_utils.timed_phase("precheck"):
+            self._restore_precheck(restore_hashes, restore_resources)
 
-        for r in restore_resources:
-            hashval = restore_hashes[cast(Resource, r).name]
-            assert hashval is not None
-            r.restore(hashval)
+        with timing_utils.timed_phase("resource restores"):
+            for r in restore_resources:
+                hashval = restore_hashes[cast(Resource, r).name]
+                assert hashval is not None
+                with timing_utils.timed_phase("restore", cast(Resource, r).name):
+                    r.restore(hashval)
 
         if self.supports_lineage():
             assert isinstance(self, Workspace)
-            self.get_lineage_store().restore_lineage(
-                self.get_instance(),
-                snapshot_hash,
-                [cast(Resource, r).name for r in restore_resources],
-                verbose=self.verbose,
-            )
+            with timing_utils.timed_phase("lineage"):
+                self.get_lineage_store().restore_lineage(
+                    self.get_instance(),
+                    snapshot_hash,
+                    [cast(Resource, r).name for r in restore_resources],
+                    verbose=self.verbose,
+                )
 
     @abstractmethod
     def get_snapshot_metadata(self, hash_val: str) -> SnapshotMetadata:
@@ -1399,6 +1564,102 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
         """
         pass
 
+    def iter_snapshots(
+        self,
+        reverse: bool = True,
+        page_size: int = 100,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+        tag: Optional[str] = None,
+        hostname: Optional[str] = None,
+        metric_filter: Optional[Callable[[JSONDict], bool]] = None,
+    ) -> Iterator[SnapshotMetadata]:
+        """Iterate through the snapshot metadata, sorted by timestamp ascending
+        (or descending if reverse is True), returning only the snapshots that
+        match all of the filters which are specified:
+
+        * start_time and end_time: the snapshot's timestamp (an ISO format string)
+          must be at least start_time and less than end_time.
+        * tag: the snapshot must have this tag.
+        * hostname: the snapshot must have been taken on this host.
+        * metric_filter: the snapshot must have metrics, and the function must
+          return True when called on them.
+
+        Backends should override this to read the snapshots lazily, page_size
+        at a time, so that reading the first few costs the same regardless of
+        the number of snapshots. This default implementation filters the
+        result of list_snapshots().
+        """
+        for md in self.list_snapshots(reverse=reverse):
+            if (
+                (start_time is None or md.timestamp >= start_time)
+                and (end_time is None or md.timestamp < end_time)
+                and (tag is None or md.has_tag(tag))
+                and (hostname is None or md.hostname == hostname)
+                and metrics_match(md, metric_filter)
+            ):
+                yield md
+
+    def count_snapshots(self) -> int:
+        """Return the number of snapshots. Backends may override this with
+        something faster than reading all of the snapshot metadata.
+        """
+        return len(list(self.list_snapshots()))
+
+    def list_metrics(self) -> List[str]:
+        """Return the sorted names of the numeric metrics recorded for any snapshot.
+        Only top-level metrics with numeric values can be queried.
+        """
+        metrics = set()  # type: Set[str]
+        for md in self.list_snapshots():
+            metrics.update(numeric_metrics(md.metrics).keys())
+        return sorted(metrics)
+
+    def get_metric_values(
+        self, metric: str, hashvals: Optional[Iterable[str]] = None
+    ) -> Dict[str, float]:
+        """Return a map from snapshot hash to the value of the (numeric)
+        metric, for the snapshots which have that metric. If hashvals is
+        specified, only those snapshots are included.
+        """
+        values = {}  # type: Dict[str, float]
+        if hashvals is None:
+            snapshots = self.list_snapshots()  # type: Iterable[SnapshotMetadata]
+        else:
+            snapshots = [self.get_snapshot_metadata(hashval) for hashval in hashvals]
+        for md in snapshots:
+            metrics = numeric_metrics(md.metrics)
+            if metric in metrics:
+                values[md.hashval] = metrics[metric]
+        return values
+
+    def query_metrics(
+        self,
+        metric: str,
+        top_k: Optional[int] = None,
+        where: Iterable[Condition] = (),
+        maximize: bool = True,
+    ) -> List[MetricValue]:
+        """Return the values of the (numeric) metric, best first: largest first
+        if maximize is True, otherwise smallest first. If top_k is specified, only
+        return that many values. Only snapshots which satisfy all the conditions
+        in where are included. Each condition is a (metric, op, value) triple,
+        such as ``('loss', '<', 0.5)``.
+
+        Backends should override this to use an index of the metric values.
+        This default implementation reads the metadata of every snapshot.
+        """
+        where = list(where)
+        check_conditions(where)
+        results = []  # type: List[MetricValue]
+        for md in self.list_snapshots(reverse=True):
+            metrics = numeric_metrics(md.metrics)
+            if metric in metrics and conditions_match(metrics, where):
+                results.append(MetricValue(md.hashval, md.timestamp, md.tags, metrics[metric]))
+        # a stable sort, so that ties go to the most recent snapshot
+        results.sort(key=lambda r: r.value, reverse=maximize)
+        return results[0:top_k] if top_k is not None else results
+
     def get_most_recent_snapshot(self) -> Optional[SnapshotMetadata]:
         """Helper function to return the metadata for the most recent
         snapshot (by timestamp). Returns None if no snapshot found
@@ -1449,6 +1710,69 @@ class SnapshotWorkspaceMixin(metaclass=ABCMeta):
             instance = cast(Workspace, self).get_instance()
             self.get_lineage_store().delete_snapshot_lineage(instance, hash_val)
 
+    def _delete_snapshots_metadata_and_manifests(self, hash_vals: List[str]) -> None:
+        """Given a list of snapshot hashes, delete the associated metadata. Backends
+        should override this if they can delete many snapshots more efficiently than
+        one at a time.
+        """
+        for hash_val in hash_vals:
+            self._delete_snapshot_metadata_and_manifest(hash_val)
+
+    def delete_snapshots(self, hash_vals: List[str], include_resources=False) -> None:
+        """Delete a set of snapshots, as with delete_snapshot(), but with each of the
+        resources, the metadata, and the lineage store deleting all of their data for the
+        snapshots in one batch. As with delete_snapshot(), the changes are not saved.
+        """
+        snapshots = []  # type: List[SnapshotMetadata]
+        for hash_val in hash_vals:
+            try:
+                snapshots.append(self.get_snapshot_metadata(hash_val))
+            except Exception:
+                raise ConfigurationError(
+                    "Did not find metadata associated with snapshot %s" % hash_val
+                )
+        if include_resources:
+            for rname in cast(Workspace, self).get_resource_names():
+                r = cast(Workspace, self).get_resource(rname)
+                if not isinstance(r, SnapshotResourceMixin):
+                    continue
+                to_delete = []  # type: List[Tuple[str, str, str]]
+                for md in snapshots:
+                    if rname not in md.restore_hashes:
+                        continue
+                    delete_hash = md.restore_hashes[rname]
+                    if delete_hash is not None:
+                        to_delete.append((md.hashval, delete_hash, md.relative_destination_path))
+                    else:
+                        print(
+                            "Cannot delete snapshot %s for resource %s, no restore hash"
+                            % (md.hashval, rname)
+                        )
+                if len(to_delete) > 0:
+                    r.delete_snapshots(to_delete)
+        self._delete_snapshots_metadata_and_manifests([md.hashval for md in snapshots])
+        if self.supports_lineage():
+            instance = cast(Workspace, self).get_instance()
+            self.get_lineage_store().delete_snapshots_lineage(
+                instance, [md.hashval for md in snapshots]
+            )
+
+    def get_snapshot_hashes_by_resource(self) -> Dict[str, Set[str]]:
+        """Return a mapping from each resource name to the set of compare and
+        restore hashes recorded for that resource in any of the snapshots.
+        Anything a resource stores for a snapshot should be reachable from these
+        hashes.
+        """
+        hashes = {}  # type: Dict[str, Set[str]]
+        for md in self.list_snapshots():
+            for entry in self.get_snapshot_manifest(md.hashval):
+                if entry.get("hash") is not None:
+                    hashes.setdefault(entry["name"], set()).add(entry["hash"])
+            for rname, restore_hash in md.restore_hashes.items():
+                if restore_hash is not None:
+                    hashes.setdefault(rname, set()).add(restore_hash)
+        return hashes
+
     @abstractmethod
     def supports_lineage(self) -> bool:
         """Return True if this workspace's backend supports lineage,
@@ -1551,6 +1875,32 @@ class SnapshotResourceMixin(metaclass=ABCMeta):
         """
         pass
 
+    def supports_concurrent_snapshot(self) -> bool:
+        """Return True if snapshot_precheck() and snapshot() can be called in a
+        thread, concurrently with those of other resources. Any git commands that
+        modify a repo (e.g. the workspace's) must then be run while holding the
+        repo's lock (see dataworkspaces.utils.git_utils.get_git_repo_lock()).
+        The default is False: the resource is snapshotted on its own.
+        """
+        return False
+
+    def has_changed_since(self, previous_compare_hash: str) -> bool:
+        """Cheaply check whether the resource may have changed since a snapshot
+        for which snapshot() returned :previous_compare_hash:. If this returns False,
+        the workspace reuses the hashes of the previous snapshot rather than calling
+        snapshot(). Only return False when certain, without walking or reading the
+        resource's data. The default returns True.
+        """
+        return True
+
+    def bypass_caches(self) -> None:
+        """Do not trust any locally cached state (e.g. file hashes keyed
+        by stat data) for the remainder of this command. This is called
+        when the user explicitly asks for all hashes to be recomputed. The
+        default implementation does nothing, as most resources do not cache.
+        """
+        pass
+
     @abstractmethod
     def restore(self, restore_hashval: str) -> None:
         pass
@@ -1564,6 +1914,15 @@ class SnapshotResourceMixin(metaclass=ABCMeta):
         """
         pass
 
+    def delete_snapshots(self, snapshots: List[Tuple[str, str, str]]) -> None:
+        """Delete the state associated with each of the snapshots, given as
+        (workspace_snapshot_hash, resource_restore_hash, relative_path) tuples.
+        Resources should override this if they can delete many snapshots
+        more efficiently than one at a time.
+        """
+        for workspace_snapshot_hash, resource_restore_hash, relative_path in snapshots:
+            self.delete_snapshot(workspace_snapshot_hash, resource_restore_hash, relative_path)
+
     def copy_imported_lineage(self, lineage_store: LineageStore) -> None:
         """If imported lineage, copy the lineage.json file to the lineage store.
         The pull_resources() method on the workspace will call it after pulling the resource.
@@ -1589,3 +1948,113 @@ class SnapshotResourceMixin(metaclass=ABCMeta):
                 % (lineage_data["resource_name"], rname)
             )
         lineage_store.import_lineage_file(rname, lineage_data["lineages"])
+
+
+class FileDiff(NamedTuple):
+    """The file-level differences between two snapshots of a resource,
+    as returned by :func:`~FileDiffResourceMixin.diff_snapshots`. Paths
+    are relative to the root of the resource.
+    """
+
+    added: List[str]
+    removed: List[str]
+    modified: List[str]
+
+
+class FileDiffResourceMixin(metaclass=ABCMeta):
+    """Mixin for snapshot resources that can list the individual files
+    which differ between two of their snapshots.
+    """
+
+    @abstractmethod
+    def diff_snapshots(self, compare_hash1: str, compare_hash2: str) -> FileDiff:
+        """Given the comparison hashes of two snapshots of this resource (as stored in
+        the snapshot manifests), return the files that were added, removed, or modified
+        going from the first to the second. This should only use the state saved for
+        the snapshots, not the current contents of the resource.
+        """
+        pass
+
+
+class UnreachableObjects(NamedTuple):
+    """The objects of a resource that can be garbage collected, as returned by
+    :func:`~GarbageCollectionResourceMixin.find_unreachable_objects`. :paths: are
+    the files to be removed or rewritten, which may include files that also hold
+    reachable objects (e.g. packs). :num_objects: and :num_bytes: count only the
+    unreachable objects and the space freed by removing them.
+    """
+
+    paths: List[str]
+    num_objects: int
+    num_bytes: int
+
+
+class GarbageCollectionResourceMixin(metaclass=ABCMeta):
+    """Mixin for snapshot resources that store objects for each snapshot (e.g. the hash
+    trees of a local files resource), which can be removed once no remaining
+    snapshot refers to them.
+    """
+
+    @abstractmethod
+    def find_unreachable_objects(self, live_hashes: Set[str]) -> UnreachableObjects:
+        """Given the hashes (compare or restore) recorded for this resource in all the
+        remaining snapshots, find the stored objects that cannot be reached from any
+        of them. The paths returned are absolute.
+        """
+        pass
+
+    @abstractmethod
+    def remove_objects(self, paths: List[str], live_hashes: Set[str]) -> None:
+        """Remove the objects whose paths were returned by :func:`~find_unreachable_objects`.
+        :live_hashes: is as passed to that method, for resources that need to
+        rewrite reachable objects stored along with unreachable ones (e.g. in a pack).
+        If the objects are stored in the workspace's git repository, the changes should
+        be staged, but not committed. The caller saves the workspace afterward, so that
+        the removals for all the resources end up in a single commit.
+        """
+        pass
+
+
+class IntegrityCheckResourceMixin(metaclass=ABCMeta):
+    """Mixin for snapshot resources that can check the integrity of the data they
+    store for each snapshot (e.g. the hash trees of a local files resource), as
+    done by the fsck command. Problems are returned as (path, message) pairs,
+    where path is relative to the resource.
+    """
+
+    @abstractmethod
+    def check_snapshot_objects(
+        self, hashval: str, verified: Set[str], bad: Dict[str, str]
+    ) -> List[Tuple[str, str]]:
+        """Check that the objects stored for the snapshot hash :hashval: are present
+        and intact. Objects listed in :verified: have already been checked and can be
+        skipped. Objects in :bad: map to a problem found earlier, which should be
+        reported again for this hash if it refers to them. Objects checked should be
+        added to one of :verified: or :bad:.
+        """
+        pass
+
+    @abstractmethod
+    def check_current_data(
+        self, hashval: str, num_workers: Optional[int] = None
+    ) -> List[Tuple[str, str]]:
+        """Compare the current contents of the resource to the snapshot hash :hashval:,
+        without using any cached state. Returns the differences found. If :num_workers:
+        is provided, it overrides the resource's default number of hashing workers.
+        """
+        pass
+
+
+class ChangeJournalResourceMixin(metaclass=ABCMeta):
+    """Mixin for snapshot resources whose snapshots can be computed incrementally
+    from a journal of changes kept by a watcher (see the watch command and
+    utils/change_journal.py).
+    """
+
+    @abstractmethod
+    def start_watcher(self, use_inotify: bool = True, scan_interval: float = 60.0) -> Any:
+        """Start a new watcher session for the resource and return the watcher,
+        a dataworkspaces.utils.change_journal.Watcher. If :use_inotify: is False or
+        inotify is not available, the resource is scanned every :scan_interval: seconds.
+        """
+        pass
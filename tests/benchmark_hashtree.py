@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Copyright 2018,2019 by MPI-SWS and Data-ken Research. Licensed under Apache 2.0. See LICENSE.txt.
+"""Micro-benchmarks for dataworkspaces.resources.hashtree. These are not
+run as part of the unit tests. Run as:
+
+    python benchmark_hashtree.py [tree] [NUM_ENTRIES ...]
+    python benchmark_hashtree.py algorithms
+    python benchmark_hashtree.py walk [NUM_FILES]
+
+The first form measures building and writing of a single large tree object.
+The second measures generate_hashes() throughput with each available
+hash algorithm, on a few large files and on many small files.
+The third counts the stat calls made when generating and checking a
+size-based signature, which dominate the time on network filesystems.
+"""
+
+import sys
+import os
+import tempfile
+import shutil
+import time
+from os.path import join
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.resources.hashtree import (
+    HashTree,
+    BLOB,
+    HASH_ALGORITHMS,
+    is_hash_algorithm_available,
+    make_hash_fun,
+    generate_hashes,
+    check_hashes,
+    compute_size,
+)
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_WALK_FILES = 20000
+FILES_PER_DIR = 100
+
+# (description, number of files, size of each file in bytes)
+ALGORITHM_DATASETS = [
+    ("large files", 4, 64 * 1024 * 1024),
+    ("small files", 10000, 4 * 1024),
+]
+
+
+def benchmark_tree_build(num_entries, hashdir):
+    names = ["file-%08d.jpg" % i for i in range(num_entries)]
+    # add the entries in a non-sorted order, as os.walk() would
+    names.reverse()
+    start = time.time()
+    t = HashTree(hashdir, "flat")
+    for name in names:
+        t.add(name, BLOB, "%040x" % len(name))
+    added = time.time()
+    # re-adding identical entries is a lookup
+    for name in names:
+        t.add(name, BLOB, "%040x" % len(name))
+    looked_up = time.time()
+    t.write()
+    written = time.time()
+    print(
+        "%8d entries: add %.3fs, re-add %.3fs, write %.3fs, total %.3fs"
+        % (num_entries, added - start, looked_up - added, written - looked_up, written - start)
+    )
+
+
+def _make_dataset(datadir, num_files, file_size):
+    for i in range(num_files):
+        subdir = join(datadir, "dir-%03d" % (i // 1000))
+        if not os.path.isdir(subdir):
+            os.mkdir(subdir)
+        with open(join(subdir, "file-%06d.dat" % i), "wb") as f:
+            f.write(os.urandom(file_size))
+
+
+def benchmark_algorithms(workdir):
+    for desc, num_files, file_size in ALGORITHM_DATASETS:
+        datadir = join(workdir, "data")
+        os.mkdir(datadir)
+        _make_dataset(datadir, num_files, file_size)
+        total_mb = num_files * file_size / (1024.0 * 1024.0)
+        print("%s: %d x %d bytes (%.1f MB)" % (desc, num_files, file_size, total_mb))
+        for algorithm in HASH_ALGORITHMS:
+            if not is_hash_algorithm_available(algorithm):
+                print("  %-8s not installed, skipping" % algorithm)
+                continue
+            hashdir = join(workdir, "hashes")
+            os.mkdir(hashdir)
+            start = time.time()
+            generate_hashes(hashdir, datadir, hash_fun=make_hash_fun(algorithm), add_to_git=False)
+            elapsed = time.time() - start
+            print("  %-8s %.3fs, %.1f MB/s" % (algorithm, elapsed, total_mb / elapsed))
+            shutil.rmtree(hashdir)
+        shutil.rmtree(datadir)
+
+
+class _StatCounter:
+    """Count the stat calls made via os.stat(), os.lstat() and the
+    (cached) stat() method of the entries returned by os.scandir()."""
+
+    def __init__(self):
+        self.count = 0
+        self.saved = (os.stat, os.lstat, os.scandir)
+
+    def __enter__(self):
+        real_stat, real_lstat, real_scandir = self.saved
+        counter = self
+
+        def stat(*args, **kwargs):
+            counter.count += 1
+            return real_stat(*args, **kwargs)
+
+        def lstat(*args, **kwargs):
+            counter.count += 1
+            return real_lstat(*args, **kwargs)
+
+        class CountingEntry:
+            def __init__(self, entry):
+                self._entry = entry
+                self._stat_called = False
+                self.name = entry.name
+                self.path = entry.path
+
+            def stat(self, *args, **kwargs):
+                if not self._stat_called:  # DirEntry caches the result
+                    counter.count += 1
+                    self._stat_called = True
+                return self._entry.stat(*args, **kwargs)
+
+            def __getattr__(self, name):
+                return getattr(self._entry, name)
+
+        class CountingScandir:
+            def __init__(self, path):
+                self._it = real_scandir(path)
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                return CountingEntry(next(self._it))
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._it.close()
+
+        os.stat = stat
+        os.lstat = lstat
+        os.scandir = CountingScandir
+        return self
+
+    def __exit__(self, *args):
+        os.stat, os.lstat, os.scandir = self.saved
+
+
+def benchmark_walk(num_files, workdir):
+    datadir = join(workdir, "data")
+    hashdir = join(workdir, "hashes")
+    os.mkdir(datadir)
+    os.mkdir(hashdir)
+    for i in range(num_files):
+        subdir = join(datadir, "dir-%05d" % (i // FILES_PER_DIR))
+        if not os.path.isdir(subdir):
+            os.mkdir(subdir)
+        with open(join(subdir, "file-%06d.txt" % i), "w") as f:
+            f.write("%d\n" % i)
+    start = time.time()
+    with _StatCounter() as counter:
+        h = generate_hashes(hashdir, datadir, hash_fun=compute_size, add_to_git=False)
+    generated = time.time()
+    print(
+        "%8d files: generate %.3fs, %d stat calls (%.2f per file)"
+        % (num_files, generated - start, counter.count, counter.count / num_files)
+    )
+    with _StatCounter() as counter:
+        assert check_hashes(h, hashdir, datadir, hash_fun=compute_size)
+    print(
+        "%8d files: check    %.3fs, %d stat calls (%.2f per file)"
+        % (num_files, time.time() - generated, counter.count, counter.count / num_files)
+    )
+
+
+def main(argv=sys.argv[1:]):
+    workdir = tempfile.mkdtemp()
+    try:
+        if len(argv) > 0 and argv[0] == "algorithms":
+            benchmark_algorithms(workdir)
+        elif len(argv) > 0 and argv[0] == "walk":
+            benchmark_walk(int(argv[1]) if len(argv) > 1 else DEFAULT_WALK_FILES, workdir)
+        else:
+            if len(argv) > 0 and argv[0] == "tree":
+                argv = argv[1:]
+            sizes = [int(arg) for arg in argv] if len(argv) > 0 else DEFAULT_SIZES
+            for num_entries in sizes:
+                benchmark_tree_build(num_entries, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,7 +22,9 @@ except ImportError:
 from dataworkspaces.utils.git_utils import GIT_EXE_PATH
 
 from dataworkspaces.api import get_resource_info, take_snapshot,\
-                               get_snapshot_history, restore
+                               get_snapshot_history, iter_snapshot_history, restore,\
+                               query_metrics, get_metric_values
+from dataworkspaces.errors import ApiParamError
 
 
 def makefile(relpath, contents):
@@ -120,6 +122,41 @@ class TestApi(unittest.TestCase):
         restore('V2', TEMPDIR)
         self._assert_contents('code/test.py',
                               'print("This is a test")\nprint("Version 2")\n')
+        # the most recent snapshot comes first, and repeated calls do not change
+        # the numbering
+        history = get_snapshot_history(TEMPDIR, max_count=1, reverse=True)
+        self.assertEqual([(2, hash2)], [(h.snapshot_number, h.hashval) for h in history])
+        history = get_snapshot_history(TEMPDIR, max_count=1, reverse=True)
+        self.assertEqual(2, history[0].snapshot_number)
+        self.assertEqual([hash2, hash1], [md.hashval for md in iter_snapshot_history(TEMPDIR)])
+        self.assertEqual([hash2],
+                         [md.hashval for md in
+                          iter_snapshot_history(TEMPDIR, page_size=1,
+                                                metric_filter=lambda m: m['accuracy']>0.98)])
+        self.assertEqual([hash1], [md.hashval for md in iter_snapshot_history(TEMPDIR, tag='V1')])
+
+    def test_query_metrics(self):
+        self._write_metrics({'accuracy':0.95, 'precision':0.8, 'roc':0.8})
+        hash1 = take_snapshot(TEMPDIR, tag='V1')
+        with open(join(TEMPDIR, 'code/test.py'), 'a') as f:
+            f.write('print("Version 2")\n')
+        self._write_metrics({'accuracy':0.99, 'precision':0.7})
+        hash2 = take_snapshot(TEMPDIR, tag='V2')
+        results = query_metrics('accuracy', top_k=1, workspace_uri_or_path=TEMPDIR)
+        self.assertEqual([(hash2, ['V2'], 0.99)],
+                         [(r.hashval, r.tags, r.value) for r in results])
+        results = query_metrics('accuracy', where=[('precision', '>=', 0.8)],
+                                workspace_uri_or_path=TEMPDIR)
+        self.assertEqual([hash1], [r.hashval for r in results])
+        self.assertEqual({'roc':{hash1:0.8}},
+                         get_metric_values(TEMPDIR, metrics=['roc']))
+        self.assertEqual(['accuracy', 'precision', 'roc'],
+                         sorted(get_metric_values(TEMPDIR).keys()))
+        self.assertEqual({'accuracy':{hash2:0.99}, 'roc':{}},
+                         get_metric_values(TEMPDIR, metrics=['accuracy', 'roc'],
+                                           snapshot_hashes=[hash2]))
+        self.assertRaises(ApiParamError, query_metrics, 'accuracy',
+                          where=[('precision', '=>', 0.8)], workspace_uri_or_path=TEMPDIR)
 
 
 
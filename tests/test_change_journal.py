@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Test the change journal and its watchers
+"""
+import os.path
+import unittest
+import sys
+import shutil
+import time
+from os.path import join
+
+TEMPDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
+DATADIR=join(TEMPDIR, 'data')
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils.change_journal import ChangeJournal, InotifyWatcher, ScanWatcher,\
+    is_inotify_available
+
+
+def skip_dir(entry):
+    return entry.name == 'skip_me'
+
+
+class TestChangeJournal(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+        os.mkdir(TEMPDIR)
+        os.makedirs(join(DATADIR, 'a/b'))
+        os.makedirs(join(DATADIR, 'skip_me'))
+        for path in ['f1.txt', 'a/f2.txt', 'a/b/f3.txt']:
+            with open(join(DATADIR, path), 'w') as f:
+                f.write(path)
+        self.journal = ChangeJournal(join(TEMPDIR, 'journal.sqlite'))
+
+    def tearDown(self):
+        self.journal.close()
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+
+    def test_sessions(self):
+        self.assertIsNone(self.journal.get_active_session())
+        session = self.journal.start_session()
+        self.assertEqual(session, self.journal.get_active_session())
+        # no base until a snapshot is taken during the session
+        self.assertIsNone(self.journal.get_base(session))
+        self.journal.mark_dirty([('a', False), ('a', True), ('', False)])
+        (max_seq, dirty) = self.journal.get_dirty()
+        self.assertEqual({'a':True, '':False}, dirty)
+        self.journal.mark_dirty([('a/b', False)])
+        self.journal.snapshot_taken('abcd', session, max_seq, {'': 1})
+        self.assertEqual('abcd', self.journal.get_base(session))
+        # only the entries added after the snapshot started are left
+        self.assertEqual({'a/b':False}, self.journal.get_dirty()[1])
+        # a new session invalidates the base
+        session2 = self.journal.start_session()
+        self.assertIsNone(self.journal.get_base(session2))
+        self.journal.end_session(session2)
+        self.assertIsNone(self.journal.get_active_session())
+
+    def test_verify_dir_mtimes(self):
+        mtimes = {'': os.stat(DATADIR).st_mtime_ns,
+                  'a': os.stat(join(DATADIR, 'a')).st_mtime_ns,
+                  'a/b': os.stat(join(DATADIR, 'a/b')).st_mtime_ns}
+        self.journal.snapshot_taken('abcd', 'session', 0, mtimes)
+        self.assertEqual(0, self.journal.verify_dir_mtimes(DATADIR))
+        os.utime(join(DATADIR, 'a'), ns=(mtimes['a'] + 10**9, mtimes['a'] + 10**9))
+        self.assertEqual(1, self.journal.verify_dir_mtimes(DATADIR))
+        self.assertEqual({'a':True}, self.journal.get_dirty()[1])
+        # a change the watcher saw does not need a rescan
+        self.journal.mark_dirty([('a/b', False)])
+        os.utime(join(DATADIR, 'a/b'), ns=(mtimes['a'] + 10**9, mtimes['a'] + 10**9))
+        self.assertEqual(0, self.journal.verify_dir_mtimes(DATADIR))
+        self.assertEqual({'a':True, 'a/b':False}, self.journal.get_dirty()[1])
+
+    def _check_watcher(self, watcher):
+        try:
+            self.assertEqual(watcher.session, self.journal.get_active_session())
+            watcher.process(True)
+            self.assertEqual({}, self.journal.get_dirty()[1])
+            with open(join(DATADIR, 'a/b/f3.txt'), 'w') as f:
+                f.write('changed')
+            os.mkdir(join(DATADIR, 'a/c'))
+            with open(join(DATADIR, 'skip_me/f4.txt'), 'w') as f:
+                f.write('ignored')
+            time.sleep(0.1)
+            watcher.process(True)
+            dirty = self.journal.get_dirty()[1]
+            self.assertEqual({'a':False, 'a/b':False, 'a/c':True}, dirty)
+        finally:
+            watcher.close()
+        self.assertIsNone(self.journal.get_active_session())
+
+    def test_scan_watcher(self):
+        self._check_watcher(ScanWatcher(DATADIR, self.journal, skip_dir, False))
+
+    @unittest.skipUnless(is_inotify_available(), "inotify is not available")
+    def test_inotify_watcher(self):
+        self._check_watcher(InotifyWatcher(DATADIR, self.journal, skip_dir, False))
+
+    @unittest.skipUnless(is_inotify_available(), "inotify is not available")
+    def test_inotify_moved_dir(self):
+        watcher = InotifyWatcher(DATADIR, self.journal, skip_dir, False)
+        try:
+            os.rename(join(DATADIR, 'a/b'), join(DATADIR, 'b'))
+            watcher.process(True)
+            with open(join(DATADIR, 'b/f5.txt'), 'w') as f:
+                f.write('new file')
+            watcher.process(True)
+            self.assertEqual({'':False, 'a':False, 'b':True}, self.journal.get_dirty()[1])
+        finally:
+            watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Test content-defined chunking
+"""
+import unittest
+import sys
+import os
+import io
+import random
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils.chunk_utils import ChunkParams, iter_chunks, numpy
+
+# small chunks, so that the pure python version runs quickly
+PARAMS = ChunkParams(min_size=1024, avg_size=4096, max_size=16384)
+
+def random_bytes(size, seed):
+    return random.Random(seed).getrandbits(8*size).to_bytes(size, 'big')
+
+def chunk(data, read_size=10000, use_numpy=False):
+    return [bytes(c) for c in iter_chunks(io.BytesIO(data), PARAMS, read_size=read_size,
+                                          use_numpy=use_numpy)]
+
+class TestChunkUtils(unittest.TestCase):
+    def test_chunks(self):
+        data = random_bytes(200000, 1) + (b'\0' * 50000)
+        chunks = chunk(data)
+        self.assertEqual(data, b''.join(chunks))
+        for c in chunks[:-1]:
+            self.assertTrue(PARAMS.min_size <= len(c) <= PARAMS.max_size)
+        # the long run of zeros has no boundaries, so it is cut at the maximum size
+        self.assertEqual(PARAMS.max_size, len(chunks[-2]))
+        # chunking does not depend on how the file is read
+        self.assertEqual(chunks, chunk(data, read_size=3000))
+        self.assertEqual(chunks, chunk(data, read_size=len(data)))
+        self.assertEqual([], chunk(b''))
+        self.assertEqual([b'abc'], chunk(b'abc'))
+
+    def test_insertion_changes_few_chunks(self):
+        data = random_bytes(200000, 2)
+        chunks = chunk(data)
+        changed = chunk(data[:100000] + b'inserted' + data[100000:])
+        new_chunks = set(changed) - set(chunks)
+        self.assertTrue(len(new_chunks) <= 2, "%d new chunks" % len(new_chunks))
+
+    @unittest.skipUnless(numpy is not None, "numpy is not installed")
+    def test_numpy_matches_python(self):
+        data = random_bytes(200000, 3) + (b'\0' * 50000)
+        for read_size in (3000, 10000, len(data)):
+            self.assertEqual(chunk(data, read_size, use_numpy=False),
+                             chunk(data, read_size, use_numpy=True))
+
+    def test_invalid_params(self):
+        self.assertRaises(ValueError, ChunkParams(16, 4096, 16384).validate)
+        self.assertRaises(ValueError, ChunkParams(1024, 3000, 16384).validate)
+        self.assertRaises(ValueError, ChunkParams(1024, 4096, 4096).validate)
+
+
+if __name__ == '__main__':
+    unittest.main()
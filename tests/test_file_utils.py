@@ -17,7 +17,7 @@ try:
 except ImportError:
     sys.path.append(os.path.abspath(".."))
 
-from dataworkspaces.utils.file_utils import safe_rename
+from dataworkspaces.utils.file_utils import safe_rename, walk_sorted
 
 class TestFileUtils(unittest.TestCase):
     def setUp(self):
@@ -48,6 +48,33 @@ class TestFileUtils(unittest.TestCase):
             if os.path.exists(testfile.name):
                 os.remove(testfile.name)
 
+    def test_walk_sorted(self):
+        for d in ['b', 'a', 'a/skip', 'a/skip/c', 'a/d']:
+            os.mkdir(os.path.join(TEMPDIR, d))
+        for f in ['z.txt', 'y.txt', 'a/x.txt', 'a/skip/w.txt', 'a/d/v.txt']:
+            with open(os.path.join(TEMPDIR, f), 'w') as fobj:
+                fobj.write(f)
+        os.symlink(os.path.join(TEMPDIR, 'a'), os.path.join(TEMPDIR, 'link'))
+        def walk(topdown):
+            return [(os.path.relpath(dirpath, TEMPDIR), [d.name for d in dirs],
+                     [f.name for f in files])
+                    for (dirpath, dirs, files) in
+                    walk_sorted(TEMPDIR, topdown=topdown,
+                                skip_dir=lambda entry: entry.name=='skip')]
+        expected = [('.', ['a', 'b', 'link'], ['y.txt', 'z.txt']),
+                    ('a', ['d'], ['x.txt']),
+                    ('a/d', [], ['v.txt']),
+                    ('b', [], [])]
+        self.assertEqual(expected, walk(True))
+        self.assertEqual([expected[2], expected[1], expected[3], expected[0]], walk(False))
+        # os.walk() gives the same results, other than ordering
+        for ((dirpath, dirs, files), (dirpath2, dirs2, files2)) in \
+            zip(walk_sorted(TEMPDIR), os.walk(TEMPDIR)):
+            self.assertEqual(dirpath, dirpath2)
+            self.assertEqual([d.name for d in dirs], sorted(dirs2))
+            self.assertEqual([f.name for f in files], sorted(files2))
+            dirs2.sort()
+
 
 
 if __name__ == '__main__':
@@ -26,7 +26,7 @@ from dataworkspaces.utils.git_utils import \
     get_local_head_hash, commit_changes_in_repo_subdir,\
     checkout_subdir_and_apply_commit, GIT_EXE_PATH,\
     get_subdirectory_hash, get_json_file_from_remote,\
-    git_remove_subtree, git_remove_file
+    git_remove_subtree, git_remove_subtrees, git_remove_file
 
 
 def makefile(relpath, contents):
@@ -470,6 +470,15 @@ class TestRemove(BaseCase):
         self._run(['commit', '-m', 'test commit'])
         self._run(['push', 'origin', 'master'])
 
+    def test_delete_trees(self):
+        git_remove_subtrees(REPODIR, ['to-delete', 'to-delete-files', 'not-there'],
+                            verbose=True)
+        self._run(['commit', '-m', 'test commit'])
+        self.assertFalse(is_git_dirty(REPODIR))
+        self.assert_file_not_exists('to-delete')
+        self.assert_file_not_exists('to-delete-files')
+        self.assert_file_exists('to-keep/keep1.txt')
+
 
 
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Test hashing utilities
+"""
+import os.path
+import unittest
+import sys
+import shutil
+import hashlib
+import subprocess
+
+TEMPDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils.hash_utils import hash_file, hash_bytes, update_hash_from_file
+from dataworkspaces.utils.git_utils import GIT_EXE_PATH
+
+# sizes chosen to cross the buffer boundary used in the tests
+FILE_SIZES = [0, 1, 4095, 4096, 4097, 3*4096 + 17]
+
+class TestHashUtils(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+        os.mkdir(TEMPDIR)
+        self.files = []
+        for size in FILE_SIZES:
+            fpath = os.path.join(TEMPDIR, 'file_%d' % size)
+            with open(fpath, 'wb') as f:
+                f.write(os.urandom(size))
+            self.files.append(fpath)
+
+    def tearDown(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+
+    def test_update_hash_from_file(self):
+        for fpath in self.files:
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            expected = hashlib.sha1(data).hexdigest()
+            for mmap_threshold in (None, 1):
+                m = hashlib.sha1()
+                n = update_hash_from_file(m, fpath, buf_size=4096,
+                                          mmap_threshold=mmap_threshold)
+                self.assertEqual(len(data), n)
+                self.assertEqual(expected, m.hexdigest(),
+                                 "Hash mismatch for %s (mmap_threshold=%s)" %
+                                 (fpath, mmap_threshold))
+
+    def test_hash_file_matches_git(self):
+        for fpath in self.files:
+            git_hash = subprocess.check_output([GIT_EXE_PATH, 'hash-object', fpath],
+                                               encoding='utf-8').strip()
+            self.assertEqual(git_hash, hash_file(fpath, buf_size=4096, mmap_threshold=None))
+            self.assertEqual(git_hash, hash_file(fpath, buf_size=4096, mmap_threshold=1))
+            with open(fpath, 'rb') as f:
+                self.assertEqual(git_hash, hash_bytes(f.read()))
+
+
+if __name__ == '__main__':
+    unittest.main()
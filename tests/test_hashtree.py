@@ -9,6 +9,9 @@ import os
 import os.path
 from os.path import join, basename
 import shutil
+import sqlite3
+import subprocess
+import tempfile
 
 CURRENTDIR=os.path.dirname(os.path.abspath(os.path.expanduser(__file__)))
 HASHDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
@@ -26,7 +29,12 @@ except ImportError:
     sys.path.append(os.path.abspath(".."))
 
 from dataworkspaces.resources.hashtree import generate_hashes, check_hashes,\
-      compute_hash, compute_size
+      compute_hash, compute_size, FileHashCache, HashTree, HashBlob, BLOB, TREE,\
+      diff_hashes, make_hash_fun, get_hash_algorithm, ChunkedHashFun, ChunkIndex,\
+      changed_chunk_ranges, read_tree_object, read_chunk_list, is_chunked_hash,\
+      find_reachable_objects, repack_objects, ObjectStore, verify_objects, iter_mismatches
+from dataworkspaces.utils.pack_utils import is_pack_index
+from dataworkspaces.utils.chunk_utils import ChunkParams
 
 IGNORE_DIRS= ['skip_me']# ['test_jupyter_kit.ipynb']
 
@@ -96,6 +104,441 @@ class TestHashTree(unittest.TestCase):
     def test_size_based_hashing(self):
         self._run_hash_and_check(compute_size)
 
+    def test_nested_ignored_dir(self):
+        """The contents of ignored directories, including their subdirectories,
+        should not be hashed or checked."""
+        os.mkdir(join(SKIP_SUBDIR, 'inner'))
+        with open(join(SKIP_SUBDIR, 'inner', 'inner.txt'), 'w') as f:
+            f.write("Should also be skipped!\n")
+        h = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_size,
+                            add_to_git=False)
+        num_objects = len(os.listdir(HASHDIR))
+        self.assertEqual(2, num_objects) # just the root and subdir trees
+        with open(join(SKIP_SUBDIR, 'inner', 'inner.txt'), 'w') as f:
+            f.write("Changed, but still skipped\n")
+        self.assertTrue(check_hashes(h, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                     hash_fun=compute_size))
+
+    def test_blake2b_hashing(self):
+        self._run_hash_and_check(make_hash_fun('blake2b'))
+
+    def test_change_of_hash_algorithm(self):
+        """Trees hashed with sha1 should still verify after the resource
+        switches algorithms, as each entry records its algorithm.
+        """
+        self.assertEqual('sha1', get_hash_algorithm(compute_hash(FILE_TO_OVERWRITE)))
+        self.assertEqual('blake2b',
+                         get_hash_algorithm(make_hash_fun('blake2b')(FILE_TO_OVERWRITE)))
+        h = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                            add_to_git=False)
+        self.assertTrue(check_hashes(h, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                     hash_fun=make_hash_fun('blake2b')))
+        with open(FILE_TO_OVERWRITE, 'w') as f:
+            f.write("Overwritten!")
+        self.assertFalse(check_hashes(h, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                      hash_fun=make_hash_fun('blake2b')))
+
+    def _run_parallel_hash(self, use_processes):
+        serial_hashdir = HASHDIR + '_serial'
+        if os.path.exists(serial_hashdir):
+            shutil.rmtree(serial_hashdir)
+        os.mkdir(serial_hashdir)
+        try:
+            h1 = generate_hashes(serial_hashdir, DATADIR, ignore=IGNORE_DIRS,
+                                 hash_fun=compute_hash, add_to_git=False)
+            h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                 hash_fun=compute_hash, add_to_git=False,
+                                 num_workers=4, use_processes=use_processes)
+            self.assertEqual(h1, h2)
+            self.assertEqual(sorted(os.listdir(serial_hashdir)), sorted(os.listdir(HASHDIR)))
+            for objname in os.listdir(HASHDIR):
+                with open(join(serial_hashdir, objname), 'r') as f1, \
+                     open(join(HASHDIR, objname), 'r') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+            self.assertTrue(check_hashes(h2, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                         hash_fun=compute_hash, num_workers=4,
+                                         use_processes=use_processes))
+            with open(FILE_TO_OVERWRITE, 'w') as f:
+                f.write("Overwritten!")
+            self.assertFalse(check_hashes(h2, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                          hash_fun=compute_hash, num_workers=4,
+                                          use_processes=use_processes))
+        finally:
+            shutil.rmtree(serial_hashdir)
+
+    def test_diff_hashes(self):
+        h1 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False)
+        self.assertEqual(([], [], []), diff_hashes(h1, h1, HASHDIR))
+        with open(EXTRA_FILE, 'w') as f:
+            f.write("AHA")
+        with open(FILE_TO_OVERWRITE, 'w') as f:
+            f.write("Overwritten!")
+        os.remove(join(DATADIR, 'utils_for_tests.py'))
+        os.mkdir(join(DATADIR, 'newdir'))
+        with open(join(DATADIR, 'newdir', 'new.txt'), 'w') as f:
+            f.write("new")
+        h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False)
+        (added, removed, modified) = diff_hashes(h1, h2, HASHDIR)
+        self.assertEqual(['newdir/new.txt', 'subdir/extra_file.txt'], added)
+        self.assertEqual(['utils_for_tests.py'], removed)
+        self.assertEqual(['test_hashtree.py'], modified)
+        self.assertEqual((removed, added, modified), diff_hashes(h2, h1, HASHDIR))
+
+    def test_add_to_git(self):
+        subprocess.run(['git', 'init'], cwd=HASHDIR, check=True)
+        h = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                            add_to_git=True)
+        objects = sorted([f for f in os.listdir(HASHDIR) if f!='.git'])
+        self.assertTrue(h in objects)
+        def get_tracked():
+            cp = subprocess.run(['git', 'ls-files'], cwd=HASHDIR, check=True,
+                                stdout=subprocess.PIPE, encoding='utf-8')
+            return sorted(cp.stdout.split())
+        self.assertEqual(objects, get_tracked())
+        # existing objects are left alone on a second run
+        mtimes = {f:os.stat(join(HASHDIR, f)).st_mtime_ns for f in objects}
+        with open(EXTRA_FILE, 'w') as f:
+            f.write("AHA")
+        h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=True)
+        self.assertNotEqual(h, h2)
+        for f in objects:
+            self.assertEqual(mtimes[f], os.stat(join(HASHDIR, f)).st_mtime_ns)
+        self.assertEqual(sorted([f for f in os.listdir(HASHDIR) if f!='.git']), get_tracked())
+
+    def test_packed_trees(self):
+        subprocess.run(['git', 'init'], cwd=HASHDIR, check=True)
+        h1 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             packed=True)
+        # just the pack and its index
+        files1 = sorted([f for f in os.listdir(HASHDIR) if f!='.git'])
+        self.assertEqual(2, len(files1))
+        self.assertEqual(1, len([f for f in files1 if is_pack_index(f)]))
+        self.assertTrue(check_hashes(h1, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                     hash_fun=compute_hash))
+        # the same trees as when writing loose objects
+        loose_hashdir = HASHDIR + '_loose'
+        os.mkdir(loose_hashdir)
+        try:
+            self.assertEqual(h1, generate_hashes(loose_hashdir, DATADIR, ignore=IGNORE_DIRS,
+                                                 hash_fun=compute_hash, add_to_git=False))
+        finally:
+            shutil.rmtree(loose_hashdir)
+        # an unchanged tree does not add a pack
+        self.assertEqual(h1, generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                             hash_fun=compute_hash, packed=True))
+        self.assertEqual(files1, sorted([f for f in os.listdir(HASHDIR) if f!='.git']))
+        # the second pack just has the new root tree
+        with open(join(DATADIR, 'extra_file.txt'), 'w') as f:
+            f.write("AHA")
+        h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             packed=True)
+        files2 = sorted([f for f in os.listdir(HASHDIR) if f!='.git'])
+        self.assertEqual(4, len(files2))
+        cp = subprocess.run(['git', 'ls-files'], cwd=HASHDIR, check=True,
+                            stdout=subprocess.PIPE, encoding='utf-8')
+        self.assertEqual(files2, sorted(cp.stdout.split()))
+        with ObjectStore(HASHDIR) as store:
+            self.assertEqual([1, 2], sorted([len(list(pack)) for pack in store.packs()]))
+        self.assertTrue(check_hashes(h2, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                     hash_fun=compute_hash))
+        self.assertEqual((['extra_file.txt'], [], []), diff_hashes(h1, h2, HASHDIR))
+        # repacking the first pack keeps just the subdir tree, which is still
+        # reachable from h2
+        reachable = find_reachable_objects(HASHDIR, [h2])
+        self.assertEqual(2, len(reachable))
+        first_pack = [join(HASHDIR, f) for f in files1 if is_pack_index(f)]
+        new_files = repack_objects(HASHDIR, first_pack, reachable)
+        self.assertEqual(2, len(new_files))
+        for f in files1:
+            os.remove(join(HASHDIR, f))
+        with ObjectStore(HASHDIR) as store:
+            self.assertEqual([1, 1], [len(list(pack)) for pack in store.packs()])
+        self.assertTrue(check_hashes(h2, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                     hash_fun=compute_hash))
+        self.assertRaises(FileNotFoundError, read_tree_object, HASHDIR, h1)
+
+    def test_packed_after_loose(self):
+        h1 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False)
+        loose = set(os.listdir(HASHDIR))
+        with open(EXTRA_FILE, 'w') as f:
+            f.write("AHA")
+        h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False, packed=True)
+        # the unchanged loose tree is not copied into the pack
+        with ObjectStore(HASHDIR) as store:
+            self.assertEqual([2], [len(list(pack)) for pack in store.packs()])
+        self.assertFalse(check_hashes(h1, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                      hash_fun=compute_hash))
+        self.assertTrue(check_hashes(h2, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                     hash_fun=compute_hash))
+        self.assertEqual((['subdir/extra_file.txt'], [], []), diff_hashes(h1, h2, HASHDIR))
+        self.assertTrue(loose.issubset(set(os.listdir(HASHDIR))))
+
+    def test_verify_objects(self):
+        h = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                            add_to_git=False)
+        verified = set()
+        self.assertEqual([], verify_objects(HASHDIR, h, verified))
+        self.assertEqual(2, len(verified))
+        # already verified objects are skipped
+        self.assertEqual([], verify_objects(HASHDIR, h, verified))
+        subdir_hash = read_tree_object(HASHDIR, h)['subdir'][0]
+        with open(join(HASHDIR, subdir_hash), 'a') as f:
+            f.write("garbage")
+        problems = verify_objects(HASHDIR, h, set())
+        self.assertEqual(['subdir'], [path for (path, message) in problems])
+        os.remove(join(HASHDIR, subdir_hash))
+        problems = verify_objects(HASHDIR, h, set())
+        self.assertEqual(['subdir'], [path for (path, message) in problems])
+
+    def test_verify_shared_bad_object(self):
+        h1 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False)
+        with open(join(DATADIR, 'new_file.txt'), 'w') as f:
+            f.write("new\n")
+        h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False)
+        subdir_hash = read_tree_object(HASHDIR, h1)['subdir'][0]
+        self.assertEqual(subdir_hash, read_tree_object(HASHDIR, h2)['subdir'][0])
+        with open(join(HASHDIR, subdir_hash), 'a') as f:
+            f.write("garbage")
+        # the damaged subdirectory is reported for both trees
+        verified = set()
+        bad = {}
+        for h in (h1, h2):
+            problems = verify_objects(HASHDIR, h, verified, bad)
+            self.assertEqual(['subdir'], [path for (path, message) in problems])
+        self.assertEqual([subdir_hash], list(bad.keys()))
+        self.assertFalse(h1 in verified or h2 in verified)
+
+    def test_iter_mismatches(self):
+        h = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                            add_to_git=False)
+        self.assertEqual([], list(iter_mismatches(h, HASHDIR, DATADIR, ignore=IGNORE_DIRS)))
+        with open(EXTRA_FILE, 'w') as f:
+            f.write("AHA")
+        with open(FILE_TO_OVERWRITE, 'w') as f:
+            f.write("Overwritten!")
+        os.remove(join(DATADIR, 'utils_for_tests.py'))
+        # unlike check_hashes(), all the differences are found
+        self.assertEqual(['subdir/extra_file.txt', 'test_hashtree.py', 'utils_for_tests.py'],
+                         sorted([path for (path, message) in
+                                 iter_mismatches(h, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                                 num_workers=2)]))
+
+    def test_incremental(self):
+        dir_mtimes = {}
+        h1 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False, dir_mtimes=dir_mtimes)
+        self.assertEqual(['', 'subdir'], sorted(dir_mtimes.keys()))
+        with open(EXTRA_FILE, 'w') as f:
+            f.write("AHA")
+        # a clean subdirectory is not walked, but its hash is reused from the base tree
+        dir_mtimes = {}
+        h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False, base_roothash=h1, dirty_dirs={},
+                             dir_mtimes=dir_mtimes)
+        self.assertEqual(h1, h2)
+        self.assertEqual([''], list(dir_mtimes.keys()))
+        # with the subdirectory marked dirty, we get the same result as a full walk
+        h3 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False, base_roothash=h1, dirty_dirs={'subdir':False})
+        h4 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False)
+        self.assertNotEqual(h1, h4)
+        self.assertEqual(h4, h3)
+        # a recursive entry for the root rescans everything
+        os.remove(EXTRA_FILE)
+        h5 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                             add_to_git=False, base_roothash=h4, dirty_dirs={'':True})
+        self.assertEqual(h1, h5)
+
+    def test_hash_cache(self):
+        # move the modification times out of the window where caching is unsafe
+        old_time = 1500000000
+        for (dirpath, dirnames, filenames) in os.walk(DATADIR):
+            for fname in filenames:
+                os.utime(join(dirpath, fname), (old_time, old_time))
+        hashed = []
+        def counting_hash(path):
+            hashed.append(path)
+            return compute_hash(path)
+        cache_file = join(HASHDIR, 'cache.sqlite')
+        def run_with_cache(use_cached_hashes=True):
+            cache = FileHashCache(cache_file, 'sha1', use_cached_hashes=use_cached_hashes)
+            try:
+                return generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                       hash_fun=counting_hash, add_to_git=False,
+                                       cache=cache)
+            finally:
+                cache.close()
+        h1 = run_with_cache()
+        num_files = len(hashed)
+        self.assertTrue(num_files > 0)
+        del hashed[:]
+        h2 = run_with_cache()
+        self.assertEqual(h1, h2)
+        self.assertEqual(0, len(hashed), "Files should not be rehashed: %s" % hashed)
+        cache = FileHashCache(cache_file, 'sha1')
+        try:
+            self.assertTrue(check_hashes(h1, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                         hash_fun=counting_hash, cache=cache))
+        finally:
+            cache.close()
+        self.assertEqual(0, len(hashed), "Files should not be rehashed: %s" % hashed)
+        # changing the file should invalidate its entry
+        with open(FILE_TO_OVERWRITE, 'w') as f:
+            f.write("Overwritten!")
+        os.utime(FILE_TO_OVERWRITE, (old_time + 10, old_time + 10))
+        h3 = run_with_cache()
+        self.assertNotEqual(h1, h3)
+        self.assertEqual([FILE_TO_OVERWRITE], hashed)
+        # bypassing the cache rehashes everything
+        del hashed[:]
+        h4 = run_with_cache(use_cached_hashes=False)
+        self.assertEqual(h3, h4)
+        self.assertEqual(num_files, len(hashed))
+
+    def test_recorded_stats(self):
+        old_time = 1500000000
+        for (dirpath, dirnames, filenames) in os.walk(DATADIR):
+            for fname in filenames:
+                os.utime(join(dirpath, fname), (old_time, old_time))
+        hashed = []
+        def counting_hash(path):
+            hashed.append(path)
+            return compute_hash(path)
+        cache_file = join(HASHDIR, 'cache.sqlite')
+        def check(use_cached_hashes=True):
+            del hashed[:]
+            cache = FileHashCache(cache_file, 'sha1', use_cached_hashes=use_cached_hashes)
+            try:
+                return check_hashes(h, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                    hash_fun=counting_hash, cache=cache)
+            finally:
+                cache.close()
+        cache = FileHashCache(cache_file, 'sha1')
+        try:
+            h = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=counting_hash,
+                                add_to_git=False, cache=cache)
+        finally:
+            cache.close()
+        num_files = len(hashed)
+        # a copy has a new inode and ctime, so the cached hash cannot be used,
+        # but the size and mtime recorded for the tree still match
+        shutil.copy2(FILE_TO_OVERWRITE, FILE_TO_OVERWRITE + '.tmp')
+        os.rename(FILE_TO_OVERWRITE + '.tmp', FILE_TO_OVERWRITE)
+        self.assertTrue(check())
+        self.assertEqual(0, len(hashed), "Files should not be rehashed: %s" % hashed)
+        # a different mtime means the file is rehashed
+        os.utime(FILE_TO_OVERWRITE, (old_time + 10, old_time + 10))
+        self.assertTrue(check())
+        self.assertEqual([FILE_TO_OVERWRITE], hashed)
+        self.assertTrue(check(use_cached_hashes=False))
+        self.assertEqual(num_files, len(hashed))
+        # only the stats of the most recent snapshot are kept for each file
+        with open(FILE_TO_OVERWRITE, 'a') as f:
+            f.write("more data\n")
+        os.utime(FILE_TO_OVERWRITE, (old_time + 20, old_time + 20))
+        cache = FileHashCache(cache_file, 'sha1')
+        try:
+            generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=compute_hash,
+                            add_to_git=False, cache=cache)
+        finally:
+            cache.close()
+        conn = sqlite3.connect(cache_file)
+        try:
+            self.assertEqual(num_files,
+                             conn.execute("select count(*) from snapshot_stats").fetchone()[0])
+        finally:
+            conn.close()
+
+    def test_chunked_hashing(self):
+        params = ChunkParams(min_size=1024, avg_size=4096, max_size=16384)
+        big_file = join(DATADIR, 'big_file.dat')
+        with open(big_file, 'wb') as f:
+            f.write(os.urandom(100000))
+        hash_fun = ChunkedHashFun(HASHDIR, params=params, min_file_size=50000)
+        index = ChunkIndex(join(HASHDIR + '_index.sqlite'))
+        try:
+            h1 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=hash_fun,
+                                 add_to_git=False, chunk_index=index)
+            big_entry1 = read_tree_object(HASHDIR, h1)['big_file.dat'][0]
+            self.assertTrue(is_chunked_hash(big_entry1))
+            self.assertEqual('sha1', get_hash_algorithm(
+                read_tree_object(HASHDIR, h1)['test_hashtree.py'][0]))
+            self.assertTrue(check_hashes(h1, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                         hash_fun=ChunkedHashFun(None, params=params,
+                                                                 min_file_size=50000)))
+            # the stored chunk list is used to check files if chunking is turned off
+            self.assertTrue(check_hashes(h1, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                         hash_fun=compute_hash))
+            with open(big_file, 'ab') as f:
+                f.write(os.urandom(1000))
+            self.assertFalse(check_hashes(h1, HASHDIR, DATADIR, ignore=IGNORE_DIRS,
+                                          hash_fun=compute_hash))
+            h2 = generate_hashes(HASHDIR, DATADIR, ignore=IGNORE_DIRS, hash_fun=hash_fun,
+                                 add_to_git=False, chunk_index=index)
+            big_entry2 = read_tree_object(HASHDIR, h2)['big_file.dat'][0]
+            # only the end of the file changed
+            ranges = changed_chunk_ranges(HASHDIR, big_entry1, big_entry2)
+            self.assertEqual(1, len(ranges))
+            (offset, length) = ranges[0]
+            self.assertEqual(101000, offset+length)
+            self.assertTrue(length < 16384+1000, "changed range too large: %s" % length)
+            self.assertEqual([], changed_chunk_ranges(HASHDIR, big_entry1, big_entry1))
+            # unchanged chunks map back to where they were first seen
+            (_, _, chunks) = read_chunk_list(HASHDIR, big_entry2)
+            self.assertEqual(('big_file.dat', 0, chunks[0][1]), index.lookup(chunks[0][0], 'sha1'))
+        finally:
+            index.close()
+            os.remove(HASHDIR + '_index.sqlite')
+
+    def test_parallel_hashing_threads(self):
+        self._run_parallel_hash(use_processes=False)
+
+    def test_parallel_hashing_processes(self):
+        self._run_parallel_hash(use_processes=True)
+
+
+class TestHashTreeObject(unittest.TestCase):
+    def test_entries(self):
+        t = HashTree('/tmp', 'root')
+        t.add('b.txt', BLOB, '2'*40)
+        t.add('a.txt', BLOB, '1'*40)
+        t.add('subdir', TREE, '3'*40)
+        t.add('a.txt', BLOB, '1'*40) # identical re-add is ok
+        with self.assertRaises(ValueError):
+            t.add('a.txt', BLOB, '4'*40)
+        t.add('a.txt', BLOB, '4'*40, force=True)
+        self.assertEqual(3, len(t))
+        self.assertEqual(['a.txt', 'b.txt', 'subdir'], [e.name for e in t])
+        self.assertEqual(['subdir', 'b.txt', 'a.txt'], [e.name for e in reversed(t)])
+        self.assertEqual('4'*40, t[0].sha)
+        self.assertEqual(['b.txt'], [e.name for e in t[1:2]])
+        self.assertEqual(['subdir'], [e.name for e in t.trees()])
+        self.assertTrue(HashBlob('b.txt', '2'*40) in t)
+        self.assertFalse(HashBlob('b.txt', '4'*40) in t)
+        del t['b.txt']
+        self.assertEqual(['a.txt', 'subdir'], [e.name for e in t])
+
+    def test_names_with_line_boundaries(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            t = HashTree(tmpdir, 'root')
+            names = ['a\x0bb.txt', 'c\x1cd.txt', 'e\u2028f.txt', 'g\rh.txt']
+            for (i, name) in enumerate(names):
+                t.add(name, BLOB, str(i)*40)
+            h = t.write()
+            self.assertEqual({name:(str(i)*40, BLOB) for (i, name) in enumerate(names)},
+                             read_tree_object(tmpdir, h))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     if len(sys.argv)>1 and sys.argv[1]=='--keep-outputs':
@@ -6,6 +6,7 @@ import shutil
 import datetime
 import json
 from copy import copy
+from multiprocessing import Pool
 from abc import ABCMeta, abstractmethod
 
 try:
@@ -378,6 +379,13 @@ LOCAL_STORE_DIR=os.path.join(TEMPDIR, 'local_store')
 SNAPSHOT_DIR=os.path.join(TEMPDIR, 'lineage_snapshots')
 SNAPSHOT1_DIR=os.path.join(SNAPSHOT_DIR, 'snapshot1')
 SNAPSHOT2_DIR=os.path.join(SNAPSHOT_DIR, 'snapshot2')
+LOCK_PATH=os.path.join(TEMPDIR, 'lineage.lock')
+
+def store_source_data_lineage(subpath):
+    """Store an entry from a separate store instance, as another process would"""
+    store = FileLineageStore('test_inst', LOCAL_STORE_DIR, SNAPSHOT_DIR, lock_path=LOCK_PATH)
+    ref = ResourceRef('intermediate', subpath)
+    store.store_entry('test_inst', SourceDataLineage(HashCertificate(ref, subpath + '_hash', '')))
 
 class TestFileLineageStore(unittest.TestCase, TstStoreMixin):
     """Tests for the lineage store api file-based implementation"""
@@ -387,17 +395,44 @@ class TestFileLineageStore(unittest.TestCase, TstStoreMixin):
         os.mkdir(TEMPDIR)
         os.mkdir(LOCAL_STORE_DIR)
         os.mkdir(SNAPSHOT_DIR)
-        self.store = FileLineageStore('test_inst', LOCAL_STORE_DIR, SNAPSHOT_DIR)
+        self.store = FileLineageStore('test_inst', LOCAL_STORE_DIR, SNAPSHOT_DIR,
+                                      lock_path=LOCK_PATH)
 
     def _get_store(self):
         return self.store
 
     def _make_another_store_instance(self):
-        self.store = FileLineageStore('test_inst', LOCAL_STORE_DIR, SNAPSHOT_DIR)
+        self.store = FileLineageStore('test_inst', LOCAL_STORE_DIR, SNAPSHOT_DIR,
+                                      lock_path=LOCK_PATH)
 
     def _get_instance(self):
         return 'test_inst'
 
+    def test_concurrent_store_entry(self):
+        """Entries stored concurrently into the same resource file are not lost"""
+        subpaths = ['s%d' % i for i in range(16)]
+        with Pool(8) as pool:
+            pool.map(store_source_data_lineage, subpaths)
+        self._make_another_store_instance()
+        refs = self.store.get_refs_for_resource('test_inst', 'intermediate')
+        self.assertEqual(sorted(subpaths), sorted([ref.subpath for ref in refs]))
+        for subpath in subpaths:
+            self._assert_datasource_hash(ResourceRef('intermediate', subpath), subpath + '_hash')
+
+    def test_reads_after_other_writes(self):
+        """Reads see the entries stored by another process since they were cached"""
+        store_source_data_lineage('s1')
+        ref2 = ResourceRef('intermediate', 's2')
+        self.assertEqual(['s1'], [ref.subpath for ref in
+                                  self.store.get_refs_for_resource('test_inst', 'intermediate')])
+        self.assertFalse(self.store.has_entry('test_inst', ref2))
+        store_source_data_lineage('s2')
+        self.assertEqual(['s1', 's2'],
+                         sorted([ref.subpath for ref in
+                                 self.store.get_refs_for_resource('test_inst', 'intermediate')]))
+        self.assertTrue(self.store.has_entry('test_inst', ref2))
+        self._assert_datasource_hash(ref2, 's2_hash')
+
     def tearDown(self):
         if exists(TEMPDIR) and not KEEP_OUTPUTS:
             shutil.rmtree(TEMPDIR)
@@ -11,10 +11,15 @@ import shutil
 import subprocess
 import filecmp
 import json
+import time
 
 
 from utils_for_tests import BaseCase, TEMPDIR, WS_DIR, WS_ORIGIN, OTHER_WS
 
+from dataworkspaces.workspace import find_and_load_workspace
+from dataworkspaces.errors import ConfigurationError
+from dataworkspaces.utils.change_journal import ChangeJournal
+
 LOCAL_RESOURCE=join(WS_DIR, 'local-data')
 DATA=join(LOCAL_RESOURCE, 'data.txt')
 
@@ -32,6 +37,312 @@ class TestLocalFiles(BaseCase):
         self._run_dws(['push'], cwd=WS_DIR)
         self._run_dws(['pull'], cwd=OTHER_WS)
 
+    def test_compute_hash_with_cache(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        self._run_dws(['config', '--resource', 'local-data', 'hash_workers', '2'])
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        self.assertTrue(exists(join(WS_DIR, '.dataworkspace/scratch/local-data/hash_cache.sqlite')))
+        with open(DATA, 'w') as f:
+            f.write("testing 2\n")
+        self._run_dws(['snapshot', 'S2'], cwd=WS_DIR)
+        self._run_dws(['snapshot', '--rehash', 'S3'], cwd=WS_DIR)
+
+    def test_hash_algorithm(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       '--hash-algorithm', 'blake2b', LOCAL_RESOURCE])
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        # switching back to sha1 must not break the existing snapshot
+        self._run_dws(['config', '--resource', 'local-data', 'hash_algorithm', 'sha1'])
+        self._run_dws(['snapshot', 'S2'], cwd=WS_DIR)
+        self._run_dws(['restore', 'S1'], cwd=WS_DIR)
+
+    def test_hash_files_commit(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        # a file staged by someone else is not committed with the hash files
+        with open(join(WS_DIR, 'other.txt'), 'w') as f:
+            f.write("other\n")
+        self._run_git(['add', 'other.txt'])
+        workspace = find_and_load_workspace(True, False, WS_DIR)
+        workspace.get_resource('local-data').snapshot()
+        self.assertNotEqual('', subprocess.check_output(
+            ['git', 'ls-tree', '-r', 'HEAD', '.dataworkspace/file/source-data/local-data'],
+            cwd=WS_DIR, encoding='utf-8'))
+        self.assertEqual('', subprocess.check_output(['git', 'ls-tree', 'HEAD', 'other.txt'],
+                                                     cwd=WS_DIR, encoding='utf-8'))
+        self.assertEqual('A  other.txt\n',
+                         subprocess.check_output(['git', 'status', '--porcelain'], cwd=WS_DIR,
+                                                 encoding='utf-8'))
+
+    def test_failed_snapshot(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        from dataworkspaces.commands.snapshot import snapshot_command
+        workspace = find_and_load_workspace(True, False, WS_DIR)
+        def fail(md, manifest):
+            raise Exception("simulated failure")
+        workspace.save_snapshot_metadata_and_manifest = fail
+        with self.assertRaises(Exception):
+            snapshot_command(workspace, 'S1')
+        # the hash files staged by the resource are unstaged
+        self.assertEqual(0, subprocess.run(['git', 'diff', '--cached', '--quiet'],
+                                           cwd=WS_DIR).returncode)
+        # the next snapshot commits all of them
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        self.assertEqual('', subprocess.check_output(
+            ['git', 'status', '--porcelain', '.dataworkspace'],
+            cwd=WS_DIR, encoding='utf-8'))
+        self._run_dws(['fsck'], cwd=WS_DIR)
+
+    def test_restore_precheck_quick(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        # outside the window in which stat data is not trusted
+        os.utime(DATA, (1500000000, 1500000000))
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        def precheck(full_verify):
+            workspace = find_and_load_workspace(True, False, WS_DIR)
+            (h,) = workspace.get_snapshot_hashes_by_resource()['local-data']
+            r = workspace.get_resource('local-data')
+            if full_verify:
+                r.bypass_caches()
+            r.restore_precheck(h)
+        # copying the file back with its mtime changes the inode and ctime, but it
+        # still matches the size and mtime recorded for the snapshot
+        shutil.copy2(DATA, DATA + '.bak')
+        os.remove(DATA)
+        shutil.copy2(DATA + '.bak', DATA)
+        os.remove(DATA + '.bak')
+        precheck(full_verify=False)
+        precheck(full_verify=True)
+        # a change that keeps the size and mtime is only caught by a full verify
+        with open(DATA, 'w') as f:
+            f.write("TESTING\n")
+        os.utime(DATA, (1500000000, 1500000000))
+        precheck(full_verify=False)
+        self.assertRaises(ConfigurationError, precheck, full_verify=True)
+
+    def test_watch(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(join(LOCAL_RESOURCE, 'subdir'))
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        journal = ChangeJournal(join(WS_DIR, '.dataworkspace/scratch/local-data/change_journal.sqlite'))
+        watcher = subprocess.Popen(self.dws.split() + ['--batch', 'watch', '--scan',
+                                                       '--scan-interval', '1'], cwd=WS_DIR)
+        try:
+            for i in range(100):
+                if journal.get_active_session() is not None:
+                    break
+                time.sleep(0.1)
+            session = journal.get_active_session()
+            self.assertIsNotNone(session)
+            # the first snapshot walks all the files, later ones use the journal
+            self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+            self.assertIsNotNone(journal.get_base(session))
+            with open(join(LOCAL_RESOURCE, 'subdir/data2.txt'), 'w') as f:
+                f.write("testing\n")
+            self._run_dws(['snapshot', 'S2'], cwd=WS_DIR)
+            self.assertEqual({}, journal.get_dirty()[1])
+            # with no changes, the journal tells us to reuse the previous hash
+            r = subprocess.run(self.dws + ' --verbose --batch snapshot S3', cwd=WS_DIR,
+                               shell=True, stdout=subprocess.PIPE, encoding='utf-8')
+            r.check_returncode()
+            self.assertIn("Resource local-data is unchanged", r.stdout)
+        finally:
+            watcher.terminate()
+            watcher.wait()
+            journal.close()
+        # the incremental snapshot matches the current data
+        self._run_dws(['fsck', '--check-data'], cwd=WS_DIR)
+
+    def test_fsck(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(join(LOCAL_RESOURCE, 'subdir'))
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        with open(join(LOCAL_RESOURCE, 'subdir/data2.txt'), 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        with open(DATA, 'w') as f:
+            f.write("testing 2\n")
+        self._run_dws(['snapshot', 'S2'], cwd=WS_DIR)
+        report_file = join(TEMPDIR, 'fsck.json')
+        def fsck(args):
+            if exists(report_file):
+                os.remove(report_file)
+            try:
+                self._run_dws(['fsck', '--output', report_file] + args, cwd=WS_DIR)
+            finally:
+                with open(report_file, 'r') as f:
+                    self.report = json.load(f)
+        fsck(['--check-data', '--workers', '2'])
+        self.assertTrue(self.report['ok'])
+        self.assertEqual(2, self.report['snapshots_checked'])
+        self.assertEqual(2, self.report['hashes_checked'])
+        # the current data no longer matches the latest snapshot
+        with open(join(LOCAL_RESOURCE, 'subdir/data2.txt'), 'w') as f:
+            f.write("changed\n")
+        with open(join(LOCAL_RESOURCE, 'subdir/data3.txt'), 'w') as f:
+            f.write("new\n")
+        self.assertRaises(subprocess.CalledProcessError, fsck, ['--check-data'])
+        self.assertFalse(self.report['ok'])
+        self.assertEqual(['subdir/data2.txt', 'subdir/data3.txt'],
+                         sorted([p['path'] for p in self.report['problems']]))
+        self.assertEqual({'data'}, set([p['check'] for p in self.report['problems']]))
+        fsck([])
+        # resume from a checkpoint where the first hash has already been checked
+        checkpoint = {'check_data': False, 'done': [['objects', 'local-data', 'dummy']],
+                      'problems': [{'check': 'objects', 'resource': 'local-data',
+                                    'hash': 'dummy', 'snapshots': [], 'path': '',
+                                    'message': 'from checkpoint'}]}
+        checkpoint_file = join(WS_DIR, 'scratch/fsck_checkpoint.json')
+        with open(checkpoint_file, 'w') as f:
+            json.dump(checkpoint, f)
+        self.assertRaises(subprocess.CalledProcessError, fsck, [])
+        self.assertEqual(['from checkpoint'], [p['message'] for p in self.report['problems']])
+        self.assertFalse(exists(checkpoint_file))
+        # missing tree objects
+        rsrc_dir = join(WS_DIR, '.dataworkspace/file/source-data/local-data')
+        for name in os.listdir(rsrc_dir):
+            if name.startswith('pack-'):
+                os.remove(join(rsrc_dir, name))
+        self.assertRaises(subprocess.CalledProcessError, fsck, [])
+        self.assertEqual(2, len(self.report['problems']))
+        self.assertEqual({'objects'}, set([p['check'] for p in self.report['problems']]))
+
+    def test_chunked_hashing(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        with open(join(LOCAL_RESOURCE, 'big.dat'), 'wb') as f:
+            f.write(os.urandom(9*1024*1024))
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        self._run_dws(['config', '--resource', 'local-data', 'chunked_hashing', 'true'])
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        self.assertTrue(exists(join(WS_DIR, '.dataworkspace/scratch/local-data/chunk_index.sqlite')))
+        # the chunk list should have been committed along with the trees,
+        # which are in a pack
+        rsrc_dir = '.dataworkspace/file/source-data/local-data'
+        chunk_lists = []
+        for objname in os.listdir(join(WS_DIR, rsrc_dir)):
+            if len(objname) != 40:
+                continue
+            with open(join(WS_DIR, rsrc_dir, objname), 'r') as f:
+                if f.readline().startswith('chunks '):
+                    chunk_lists.append(objname)
+        self.assertEqual(1, len(chunk_lists))
+        self._assert_file_git_tracked(rsrc_dir + '/' + chunk_lists[0])
+        self._run_dws(['restore', 'S1'], cwd=WS_DIR)
+
+    def test_gc(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(join(LOCAL_RESOURCE, 'subdir'))
+        os.makedirs(join(LOCAL_RESOURCE, 'unchanged'))
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        with open(join(LOCAL_RESOURCE, 'subdir/data2.txt'), 'w') as f:
+            f.write("testing\n")
+        with open(join(LOCAL_RESOURCE, 'unchanged/data3.txt'), 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        rsrc_dir = join(WS_DIR, '.dataworkspace/file/source-data/local-data')
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        s1_objects = set(os.listdir(rsrc_dir))
+        with open(join(LOCAL_RESOURCE, 'subdir/data2.txt'), 'w') as f:
+            f.write("testing 2\n")
+        self._run_dws(['snapshot', 'S2'], cwd=WS_DIR)
+        s2_objects = set(os.listdir(rsrc_dir)) - s1_objects
+        self.assertEqual(2, len(s2_objects)) # a pack with the new root and subdir trees
+        # nothing to collect yet
+        self._run_dws(['gc'], cwd=WS_DIR)
+        self.assertEqual(s1_objects.union(s2_objects), set(os.listdir(rsrc_dir)))
+        self._run_dws(['delete-snapshot', 'S1'], cwd=WS_DIR)
+        # only the root and subdir trees of S1 are unreachable, but its whole pack
+        # has to be rewritten
+        workspace = find_and_load_workspace(True, False, WS_DIR)
+        unreachable = workspace.get_resource('local-data').find_unreachable_objects(
+            workspace.get_snapshot_hashes_by_resource()['local-data'])
+        self.assertEqual(2, unreachable.num_objects)
+        self.assertEqual(2, len(unreachable.paths))
+        self.assertLess(unreachable.num_bytes,
+                        sum([os.stat(path).st_size for path in unreachable.paths]))
+        self._run_dws(['gc', '--dry-run'], cwd=WS_DIR)
+        self.assertEqual(s1_objects.union(s2_objects), set(os.listdir(rsrc_dir)))
+        num_commits = subprocess.check_output(['git', 'rev-list', '--count', 'HEAD'],
+                                              cwd=WS_DIR, encoding='utf-8')
+        # gc waits for snapshots in progress
+        with workspace.snapshot_lock(shared=True):
+            with self.assertRaises(subprocess.TimeoutExpired):
+                subprocess.run([self.dws, '--batch', 'gc'], cwd=WS_DIR, timeout=3)
+        self.assertEqual(s1_objects.union(s2_objects), set(os.listdir(rsrc_dir)))
+        self._run_dws(['gc'], cwd=WS_DIR)
+        # the pack for S1 is removed, but the tree for the unchanged
+        # directory is still referenced by S2, so it is repacked
+        remaining = set(os.listdir(rsrc_dir))
+        self.assertEqual(2, len(s1_objects - remaining))
+        self.assertEqual(2, len(remaining - s1_objects - s2_objects))
+        self.assertTrue('dummy.txt' in remaining)
+        self.assertTrue(s2_objects.issubset(remaining))
+        for objname in s1_objects - remaining:
+            self._assert_file_not_git_tracked('.dataworkspace/file/source-data/local-data/'
+                                              + objname)
+        self.assertEqual(int(num_commits) + 1,
+                         int(subprocess.check_output(['git', 'rev-list', '--count', 'HEAD'],
+                                                     cwd=WS_DIR, encoding='utf-8')))
+        self._run_dws(['restore', 'S2'], cwd=WS_DIR)
+
+    def test_file_diff(self):
+        self._setup_initial_repo(create_resources=None)
+        os.makedirs(LOCAL_RESOURCE)
+        with open(DATA, 'w') as f:
+            f.write("testing\n")
+        self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                       LOCAL_RESOURCE])
+        self._run_dws(['snapshot', 'S1'], cwd=WS_DIR)
+        with open(DATA, 'w') as f:
+            f.write("testing 2\n")
+        with open(join(LOCAL_RESOURCE, 'new.txt'), 'w') as f:
+            f.write("new\n")
+        self._run_dws(['snapshot', 'S2'], cwd=WS_DIR)
+        self._run_dws(['diff', '--files', 'S1', 'S2'], cwd=WS_DIR)
+        from dataworkspaces.api import get_file_diff
+        diff = get_file_diff('local-data', 'S1', 'S2', workspace_uri_or_path=WS_DIR)
+        self.assertEqual(['new.txt'], diff.added)
+        self.assertEqual([], diff.removed)
+        self.assertEqual(['data.txt'], diff.modified)
+        # a missing hash tree is reported, but does not stop the diff
+        shutil.rmtree(join(WS_DIR, '.dataworkspace/file/source-data/local-data'))
+        self._run_dws(['diff', '--files', 'S1', 'S2'], cwd=WS_DIR)
+
     def test_local_path_override(self):
         # create a primary ws, the origin, and the second ws
         self._setup_initial_repo(create_resources=None)
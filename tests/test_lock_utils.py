@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Test the file locking and atomic writes
+"""
+import os.path
+import unittest
+import sys
+import json
+import shutil
+from multiprocessing import Pool
+from os.path import join
+
+TEMPDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
+LOCK_PATH=join(TEMPDIR, 'counter.lock')
+COUNTER_PATH=join(TEMPDIR, 'counter.json')
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils.lock_utils import file_lock, atomic_write, write_json_atomically
+
+
+def increment_counter(n):
+    """Read-modify-write the counter file n times, holding the lock"""
+    for i in range(n):
+        with file_lock(LOCK_PATH):
+            with open(COUNTER_PATH, 'r') as f:
+                value = json.load(f)['value']
+            write_json_atomically(COUNTER_PATH, {'value':value+1})
+
+
+class TestLockUtils(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+        os.mkdir(TEMPDIR)
+
+    def tearDown(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+
+    def test_concurrent_increments(self):
+        write_json_atomically(COUNTER_PATH, {'value':0})
+        with Pool(4) as pool:
+            pool.map(increment_counter, [25]*4)
+        with open(COUNTER_PATH, 'r') as f:
+            self.assertEqual(100, json.load(f)['value'])
+
+    def test_shared_locks(self):
+        with file_lock(LOCK_PATH, shared=True):
+            with file_lock(LOCK_PATH, shared=True):
+                pass
+
+    def test_failed_write_leaves_file_unchanged(self):
+        path = join(TEMPDIR, 'data.txt')
+        with atomic_write(path) as f:
+            f.write('old')
+        with self.assertRaises(ValueError):
+            with atomic_write(path) as f:
+                f.write('new')
+                raise ValueError('failed in the middle of the write')
+        with open(path, 'r') as f:
+            self.assertEqual('old', f.read())
+        self.assertEqual(['data.txt'], os.listdir(TEMPDIR))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Test pack files
+"""
+import os.path
+import unittest
+import sys
+import shutil
+import hashlib
+
+TEMPDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils.pack_utils import PackReader, PackWriter, is_pack_index
+
+
+def make_object(i):
+    data = ("object %d\n" % i).encode('ascii') * (i % 7)
+    return (hashlib.sha1(data).hexdigest(), data)
+
+
+class TestPackUtils(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+        os.mkdir(TEMPDIR)
+
+    def tearDown(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+
+    def test_write_and_read(self):
+        objects = dict([make_object(i) for i in range(100)])
+        writer = PackWriter(TEMPDIR)
+        for (h, data) in objects.items():
+            self.assertTrue(writer.add(h, data))
+        self.assertFalse(writer.add(*make_object(5)))
+        (pack_path, index_path) = writer.finish()
+        self.assertTrue(is_pack_index(os.path.basename(index_path)))
+        self.assertEqual(sorted([os.path.basename(pack_path), os.path.basename(index_path)]),
+                         sorted(os.listdir(TEMPDIR)))
+        reader = PackReader(index_path)
+        try:
+            self.assertEqual(len(objects), reader.num_objects)
+            self.assertEqual(sorted(objects.keys()), list(reader))
+            for (h, data) in objects.items():
+                self.assertTrue(h in reader)
+                self.assertEqual(data, reader.read(h))
+            missing = hashlib.sha1(b'missing').hexdigest()
+            self.assertFalse(missing in reader)
+            self.assertIsNone(reader.read(missing))
+            self.assertIsNone(reader.read('not a hash'))
+        finally:
+            reader.close()
+        # the same objects, added in the same order, give the same pack
+        writer = PackWriter(TEMPDIR)
+        for (h, data) in objects.items():
+            writer.add(h, data)
+        self.assertEqual([pack_path, index_path], writer.finish())
+        self.assertEqual(2, len(os.listdir(TEMPDIR)))
+
+    def test_empty_and_aborted(self):
+        self.assertEqual([], PackWriter(TEMPDIR).finish())
+        writer = PackWriter(TEMPDIR)
+        writer.add(*make_object(1))
+        writer.abort()
+        self.assertEqual([], os.listdir(TEMPDIR))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Test the index of snapshot metadata files
+"""
+import os.path
+import unittest
+import sys
+import json
+import shutil
+from os.path import join
+
+TEMPDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
+MD_DIR=join(TEMPDIR, 'snapshot_metadata')
+DB_PATH=join(TEMPDIR, 'index.sqlite')
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils.snapshot_index import SnapshotIndex
+
+
+def make_md(hashval, timestamp, tags=[], metrics=None, snapshot_number=None):
+    md = {'hash':hashval, 'tags':tags, 'message':'', 'hostname':'test',
+          'timestamp':timestamp, 'relative_destination_path':'snapshots/%s' % hashval,
+          'restore_hashes':{}, 'metrics':metrics}
+    if snapshot_number is not None:
+        md['snapshot_number'] = snapshot_number
+    return md
+
+
+def write_md(md, subdir=None):
+    dirpath = MD_DIR if subdir is None else join(MD_DIR, subdir)
+    os.makedirs(dirpath, exist_ok=True)
+    relpath = md['hash'] + '_md.json'
+    with open(join(dirpath, relpath), 'w') as f:
+        json.dump(md, f)
+    return relpath if subdir is None else join(subdir, relpath)
+
+
+class TestSnapshotIndex(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+        os.mkdir(TEMPDIR)
+        write_md(make_md('aa11', '2020-01-01T10:00:00', ['v1']))
+        write_md(make_md('ab22', '2020-01-02T10:00:00', ['v2', 'best'], {'accuracy':0.9}, 7))
+        write_md(make_md('bc33', '2020-01-03T10:00:00'))
+        self.index = SnapshotIndex(DB_PATH, MD_DIR)
+        self.index.sync()
+
+    def tearDown(self):
+        self.index.close()
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+
+    def _hashes(self, **kwargs):
+        return [md['hash'] for md in self.index.list(**kwargs)]
+
+    def test_lookups(self):
+        self.assertEqual(3, self.index.count())
+        self.assertEqual('ab22', self.index.get_by_tag('best')['hash'])
+        self.assertIsNone(self.index.get_by_tag('v3'))
+        self.assertEqual('ab22', self.index.get_by_partial_hash('ab')['hash'])
+        self.assertEqual('aa11', self.index.get_by_partial_hash('a')['hash'])
+        self.assertIsNone(self.index.get_by_partial_hash('c'))
+        self.assertEqual({'accuracy':0.9}, self.index.get('ab22')['metrics'])
+        self.assertEqual(['bc33', 'ab22', 'aa11'], self._hashes())
+        self.assertEqual(['aa11', 'ab22'], self._hashes(reverse=False, max_count=2))
+        self.assertEqual(7, self.index.max_snapshot_number('test'))
+        self.assertEqual(0, self.index.max_snapshot_number('other'))
+
+    def test_update_and_remove(self):
+        md = make_md('ab22', '2020-01-02T10:00:00', ['v2'])
+        self.index.update(write_md(md))
+        self.assertIsNone(self.index.get_by_tag('best'))
+        self.assertEqual('ab22', self.index.get_by_tag('v2')['hash'])
+        os.remove(join(MD_DIR, 'aa11_md.json'))
+        self.index.remove('aa11')
+        self.assertEqual(['bc33', 'ab22'], self._hashes())
+
+    def test_sync(self):
+        """Changes made by others (e.g. a pull) are picked up, including those in
+        subdirectories"""
+        write_md(make_md('cd44', '2020-01-04T10:00:00', ['v4']))
+        os.remove(join(MD_DIR, 'bc33_md.json'))
+        write_md(make_md('de55', '2020-01-05T10:00:00', ['v5']), subdir='de')
+        self.index.sync()
+        self.assertEqual(['de55', 'cd44', 'ab22', 'aa11'], self._hashes())
+        self.assertEqual('de55', self.index.get_by_tag('v5')['hash'])
+        shutil.rmtree(join(MD_DIR, 'de'))
+        self.index.sync()
+        self.assertEqual(['cd44', 'ab22', 'aa11'], self._hashes())
+        # a reopened index is still up to date, and can be rebuilt
+        self.index.close()
+        self.index = SnapshotIndex(DB_PATH, MD_DIR)
+        self.index.sync()
+        self.assertEqual(['cd44', 'ab22', 'aa11'], self._hashes())
+        self.index.rebuild()
+        self.assertEqual(['cd44', 'ab22', 'aa11'], self._hashes())
+
+    def test_iter(self):
+        """Paging and filters give the same results as listing"""
+        write_md(make_md('ac44', '2020-01-02T10:00:00'))
+        self.index.sync()
+        for page_size in [1, 2, 100]:
+            self.assertEqual(['bc33', 'ac44', 'ab22', 'aa11'],
+                             [md['hash'] for md in self.index.iter(page_size=page_size)])
+            self.assertEqual(['aa11', 'ab22', 'ac44', 'bc33'],
+                             [md['hash'] for md in self.index.iter(reverse=False,
+                                                                   page_size=page_size)])
+        self.assertEqual(['ac44', 'ab22'],
+                         [md['hash'] for md in self.index.iter(page_size=1,
+                                                               start_time='2020-01-02',
+                                                               end_time='2020-01-03')])
+        self.assertEqual(['ab22'], [md['hash'] for md in self.index.iter(tag='v2')])
+        self.assertEqual([], list(self.index.iter(hostname='other')))
+        self.assertRaises(ValueError, list, self.index.iter(page_size=0))
+
+    def test_metrics(self):
+        """Only numeric metrics go in the metrics table, and it follows updates"""
+        write_md(make_md('cd44', '2020-01-04T10:00:00', ['v4'],
+                         {'accuracy':0.8, 'loss':0.3, 'model':'svm', 'ok':True}))
+        write_md(make_md('de55', '2020-01-05T10:00:00', [],
+                         {'accuracy':0.9, 'loss':0.7, 'params':{'depth':3}}))
+        self.index.sync()
+        self.assertEqual(['accuracy', 'loss'], self.index.list_metrics())
+        self.assertEqual({'ab22':0.9, 'cd44':0.8, 'de55':0.9},
+                         self.index.get_metric_values('accuracy'))
+        self.assertEqual({'cd44':0.8},
+                         self.index.get_metric_values('accuracy', ['bc33', 'cd44']))
+        self.assertEqual([('de55', '2020-01-05T10:00:00', [], 0.9),
+                          ('ab22', '2020-01-02T10:00:00', ['v2', 'best'], 0.9)],
+                         self.index.query_metrics('accuracy', top_k=2))
+        self.assertEqual(['cd44'],
+                         [r[0] for r in self.index.query_metrics('accuracy', top_k=1,
+                                                                 maximize=False)])
+        self.assertEqual(['cd44'],
+                         [r[0] for r in self.index.query_metrics('accuracy',
+                                                                 where=[('loss', '<', 0.5)])])
+        self.index.update(write_md(make_md('de55', '2020-01-05T10:00:00', [], None)))
+        self.assertEqual(['ab22', 'cd44'],
+                         [r[0] for r in self.index.query_metrics('accuracy')])
+        self.assertEqual({'cd44':0.3}, self.index.get_metric_values('loss'))
+
+    def test_non_finite_metrics(self):
+        """NaN and infinite metric values are left out of the metrics table"""
+        write_md(make_md('cd44', '2020-01-04T10:00:00', [],
+                         {'accuracy':float('nan'), 'loss':float('inf'), 'roc':0.7}))
+        self.index.sync()
+        self.assertEqual(['accuracy', 'roc'], self.index.list_metrics())
+        self.assertEqual({'ab22':0.9}, self.index.get_metric_values('accuracy'))
+        self.assertEqual('cd44', self._hashes()[0])
+
+    def test_sync_after_sharding(self):
+        """Files moved into subdirectories keep their entries"""
+        for hashval in ['aa11', 'ab22', 'bc33']:
+            os.makedirs(join(MD_DIR, hashval[0:2]), exist_ok=True)
+            os.rename(join(MD_DIR, hashval + '_md.json'),
+                      join(MD_DIR, hashval[0:2], hashval + '_md.json'))
+        self.index.sync()
+        self.assertEqual(['bc33', 'ab22', 'aa11'], self._hashes())
+        self.assertEqual('ab22', self.index.get_by_tag('best')['hash'])
+
+
+if __name__ == '__main__':
+    unittest.main()
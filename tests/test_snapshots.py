@@ -11,6 +11,7 @@ from os.path import join, exists, isdir
 import shutil
 import subprocess
 import json
+from multiprocessing import Pool
 
 
 # If set to True, by --keep-outputs option, leave the output data
@@ -29,6 +30,12 @@ except ImportError:
 from dataworkspaces.utils.git_utils import GIT_EXE_PATH
 from dataworkspaces.utils.subprocess_utils import find_exe
 
+def allocate_snapshot_numbers(n):
+    """Allocate n snapshot numbers from a separately loaded workspace"""
+    from dataworkspaces.workspace import find_and_load_workspace
+    ws = find_and_load_workspace(True, False, WS_DIR)
+    return [ws.get_next_snapshot_number() for i in range(n)]
+
 class BaseCase(unittest.TestCase):
     def setUp(self):
         if os.path.exists(TEMPDIR):
@@ -120,6 +127,209 @@ class TestSnapshots(BaseCase):
         if not got_error:
             self.fail("Did not get an error when calling snapshot for tag S1 a second time")
 
+    def test_concurrent_snapshot(self):
+        """Resources are snapshotted concurrently by default. The manifest should be
+        the same as when they are snapshotted one at a time.
+        """
+        self._run_dws(['init', '--create-resources=code,results'])
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test')\n")
+        for name in ['data1', 'data2']:
+            os.mkdir(join(WS_DIR, name))
+            with open(join(WS_DIR, name + '/data.txt'), 'w') as f:
+                f.write(name + "\n")
+            self._run_dws(['add', 'local-files', '--role', 'source-data', '--compute-hash',
+                           join(WS_DIR, name)])
+        self._run_dws(['snapshot', 'S1'])
+        with open(join(WS_DIR, 'data2/data.txt'), 'w') as f:
+            f.write("changed\n")
+        self._run_dws(['config', 'snapshot.workers', '1'])
+        self._run_dws(['snapshot', 'S2'])
+        from dataworkspaces.workspace import find_and_load_workspace
+        ws = find_and_load_workspace(True, False, WS_DIR)
+        manifests = [ws.get_snapshot_manifest(ws.get_snapshot_by_tag(tag).hashval)
+                     for tag in ['S1', 'S2']]
+        names = [r.name for r in ws.get_resources()]
+        self.assertEqual(['code', 'results', 'data1', 'data2'], names)
+        for manifest in manifests:
+            self.assertEqual(names, [entry['name'] for entry in manifest])
+        self.assertEqual([entry['hash'] for entry in manifests[0][:3]],
+                         [entry['hash'] for entry in manifests[1][:3]])
+        self.assertNotEqual(manifests[0][3]['hash'], manifests[1][3]['hash'])
+
+    def test_concurrent_snapshot_numbers(self):
+        """Snapshot numbers allocated concurrently by several processes are unique,
+        and later snapshots get higher numbers.
+        """
+        self._run_dws(['init', '--create-resources=code,results'])
+        self._run_dws(['snapshot'])
+        with Pool(4) as pool:
+            numbers = [n for ns in pool.map(allocate_snapshot_numbers, [5]*4) for n in ns]
+        self.assertEqual(20, len(set(numbers)))
+        self.assertGreater(min(numbers), 1)
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test')\n")
+        self._run_dws(['snapshot'])
+        from dataworkspaces.workspace import find_and_load_workspace
+        ws = find_and_load_workspace(True, False, WS_DIR)
+        snapshot_numbers = [md.snapshot_number for md in ws.list_snapshots(reverse=False)]
+        self.assertEqual([1, max(numbers)+1], snapshot_numbers)
+
+    def test_single_commit_snapshot(self):
+        """A snapshot, including the changes to the code and the moved results,
+        should add exactly one commit to the workspace's repo, and the subdirectory
+        resources should still be restorable.
+        """
+        self._run_dws(['init', '--hostname=test', '--create-resources=code,results'])
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test')\n")
+        self._write_results({'accuracy':0.95})
+        def count_commits():
+            return int(subprocess.check_output([GIT_EXE_PATH, 'rev-list', '--count', 'HEAD'],
+                                               cwd=WS_DIR))
+        before = count_commits()
+        self._run_dws(['snapshot', 'S1'])
+        self.assertEqual(before + 1, count_commits())
+        self._run_git(['diff', '--exit-code', '--quiet', 'HEAD'])
+        self._assert_results('test-S1', {'accuracy':0.95})
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test for the second snapshot')\n")
+        self._run_dws(['snapshot', 'S2'])
+        self._run_dws(['restore', 'S1'])
+        self._assert_file_contents(join(CODE_DIR, 'test.py'),
+                                   "print('this is a test')\n")
+
+
+    def test_failed_snapshot(self):
+        """If a snapshot fails after resources staged their changes, the changes are
+        unstaged and the workspace has no transaction left to be saved later.
+        """
+        self._run_dws(['init', '--hostname=test', '--create-resources=code,results'])
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test')\n")
+        self._write_results({'accuracy':0.95})
+        from dataworkspaces.workspace import find_and_load_workspace
+        from dataworkspaces.commands.snapshot import snapshot_command
+        ws = find_and_load_workspace(True, False, WS_DIR)
+        def fail(md, manifest):
+            raise Exception("simulated failure")
+        ws.save_snapshot_metadata_and_manifest = fail
+        with self.assertRaises(Exception):
+            snapshot_command(ws, 'S1')
+        self.assertIsNone(ws.snapshot_transaction)
+        status = subprocess.check_output([GIT_EXE_PATH, 'status', '--porcelain',
+                                          '--untracked-files=no'],
+                                         cwd=WS_DIR, encoding='utf-8')
+        self.assertEqual('', status)
+        # the moved results are kept, and saved by the next snapshot
+        self._run_dws(['snapshot', 'S1'])
+        self._run_git(['diff', '--exit-code', '--quiet', 'HEAD'])
+        self.assertIn('results.json',
+                      subprocess.check_output([GIT_EXE_PATH, 'ls-files', 'results/snapshots'],
+                                              cwd=WS_DIR, encoding='utf-8'))
+
+    def test_unchanged_resources(self):
+        """Resources that have not changed since the previous snapshot reuse its hashes.
+        """
+        self._run_dws(['init', '--create-resources=code,results'])
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test')\n")
+        self._run_dws(['snapshot', 'S1'])
+        def snapshot_output(tag):
+            r = subprocess.run(self.dws + ' --verbose --batch snapshot ' + tag, cwd=WS_DIR,
+                               shell=True, stdout=subprocess.PIPE, encoding='utf-8')
+            r.check_returncode()
+            return r.stdout
+        self.assertIn("Resource code is unchanged", snapshot_output('S2'))
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test for the third snapshot')\n")
+        self.assertNotIn("Resource code is unchanged", snapshot_output('S3'))
+        from dataworkspaces.workspace import find_and_load_workspace
+        ws = find_and_load_workspace(True, False, WS_DIR)
+        hashes = [ws.get_snapshot_manifest(ws.get_snapshot_by_tag(tag).hashval)[0]['hash']
+                  for tag in ['S1', 'S2', 'S3']]
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertNotEqual(hashes[1], hashes[2])
+        self._run_dws(['restore', 'S2'])
+        self._assert_file_contents(join(CODE_DIR, 'test.py'),
+                                   "print('this is a test')\n")
+
+    def test_timings(self):
+        """With the timings_log param set, each snapshot and restore appends its
+        phase timings to the log in the scratch directory.
+        """
+        self._run_dws(['init', '--create-resources=code,results'])
+        self._run_dws(['config', 'timings_log', 'true'])
+        with open(join(CODE_DIR, 'test.py'), 'w') as f:
+            f.write("print('this is a test')\n")
+        self._run_dws(['snapshot', '--timings', 'S1'])
+        self._run_dws(['restore', '--timings', 'S1'])
+        from dataworkspaces.workspace import find_and_load_workspace
+        ws = find_and_load_workspace(True, False, WS_DIR)
+        with open(join(ws.get_scratch_directory(), 'dws_timings.jsonl'), 'r') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(['snapshot', 'restore'], [data['command'] for data in lines])
+        self.assertEqual(ws.get_snapshot_by_tag('S1').hashval, lines[0]['snapshot'])
+        phases = [(p['name'], p['resource']) for p in lines[0]['phases']]
+        for phase in [('snapshot', None), ('precheck', None), ('resource snapshots', None),
+                      ('snapshot', 'code'), ('save', None)]:
+            self.assertIn(phase, phases)
+        # the git subprocesses of the resources are included in the total
+        self.assertGreater(lines[0]['phases'][0]['subprocesses'], 0)
+
+
+class TestSnapshotLayout(BaseCase):
+    def _snapshot_files(self, tag):
+        from dataworkspaces.workspace import find_and_load_workspace
+        ws = find_and_load_workspace(True, False, WS_DIR)
+        return ws._find_snapshot_files(ws.get_snapshot_by_tag(tag).hashval)
+
+    def _list_snapshots(self):
+        from dataworkspaces.workspace import find_and_load_workspace
+        return find_and_load_workspace(True, False, WS_DIR).list_snapshots()
+
+    def _run_git_for_output(self, git_args):
+        r = subprocess.run([GIT_EXE_PATH]+git_args, cwd=WS_DIR, stdout=subprocess.PIPE,
+                           encoding='utf-8')
+        r.check_returncode()
+        return r.stdout
+
+    def test_migrate_snapshot_layout(self):
+        """Snapshots taken in the flat layout can still be used, and are moved into
+        subdirectories by the migration."""
+        self._run_dws(['init', '--create-resources=code,results'])
+        self._run_dws(['config', 'snapshot.metadata_layout', 'flat'])
+        for tag in ['S1', 'S2']:
+            with open(join(CODE_DIR, 'test.py'), 'w') as f:
+                f.write("print('this is a test for %s')\n" % tag)
+            self._run_dws(['snapshot', tag])
+        (manifest, md) = self._snapshot_files('S1')
+        self.assertEqual('.dataworkspace/snapshot_metadata', os.path.dirname(md))
+        self._run_dws(['migrate-snapshot-layout'])
+        self.assertEqual('', self._run_git_for_output(['status', '--porcelain']))
+        from dataworkspaces.workspace import find_and_load_workspace
+        self.assertEqual('sharded', find_and_load_workspace(True, False, WS_DIR)
+                         .get_global_param('snapshot.metadata_layout'))
+        for tag in ['S1', 'S2']:
+            for path in self._snapshot_files(tag):
+                self.assertTrue(exists(join(WS_DIR, path)))
+                self.assertEqual(os.path.basename(path).replace('snapshot-', '')[0:2],
+                                 os.path.basename(os.path.dirname(path)))
+        self.assertEqual([], [f for f in os.listdir(join(WS_DIR, '.dataworkspace/snapshots'))
+                              if f.endswith('.json')])
+        self._run_dws(['restore', 'S1'])
+        self._assert_file_contents(join(CODE_DIR, 'test.py'), "print('this is a test for S1')\n")
+        self._run_dws(['delete-snapshot', 'S2'])
+        self.assertEqual(['S1'], [tag for md in self._list_snapshots() for tag in md.tags])
+
+    def test_new_workspace_is_sharded(self):
+        self._run_dws(['init', '--create-resources=code,results'])
+        self._run_dws(['snapshot', 'S1'])
+        (manifest, md) = self._snapshot_files('S1')
+        self.assertEqual(os.path.basename(md)[0:2], os.path.basename(os.path.dirname(md)))
+        self.assertIn(md, self._run_git_for_output(['ls-files']))
+
+
 class TestDeleteSnapshot(BaseCase):
     def test_delete_snapshot(self):
         self._run_dws(['init', '--hostname=test', '--create-resources=code,results'])
@@ -135,6 +345,47 @@ class TestDeleteSnapshot(BaseCase):
         self._run_dws(['delete-snapshot', 'snapshot-tag'])
         self.assertFalse(isdir(snapshot_dir))
 
+
+class TestPrune(BaseCase):
+    def _list_snapshots(self):
+        from dataworkspaces.workspace import find_and_load_workspace
+        return find_and_load_workspace(True, False, WS_DIR).list_snapshots(reverse=True)
+
+    def _count_commits(self):
+        return int(subprocess.check_output([GIT_EXE_PATH, 'rev-list', '--count', 'HEAD'],
+                                           cwd=WS_DIR))
+
+    def test_prune(self):
+        self._run_dws(['init', '--hostname=test', '--create-resources=code,results'])
+        for (tag, accuracy) in [('S1', 0.5), (None, 0.99), (None, 0.6), (None, 0.7)]:
+            self._write_results({'accuracy':accuracy})
+            self._run_dws(['snapshot'] + ([tag] if tag is not None else []))
+        snapshots = self._list_snapshots()
+        self.assertEqual(4, len(snapshots))
+        pruned = snapshots[1]
+        self.assertEqual(0.6, pruned.metrics['accuracy'])
+        pruned_results = join(RESULTS_DIR, pruned.relative_destination_path)
+        self.assertTrue(isdir(pruned_results))
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run_dws(['prune'])
+        policies = ['--keep-tagged', '--keep-best', 'accuracy', '1', '--keep-last', '1']
+        self._run_dws(['prune', '--dry-run'] + policies)
+        self.assertEqual(4, len(self._list_snapshots()))
+        before = self._count_commits()
+        self._run_dws(['prune'] + policies)
+        self.assertEqual(before + 1, self._count_commits())
+        self._run_git(['diff', '--exit-code', '--quiet', 'HEAD'])
+        self.assertEqual([snapshots[0].hashval, snapshots[2].hashval, snapshots[3].hashval],
+                         [md.hashval for md in self._list_snapshots()])
+        self.assertFalse(isdir(pruned_results))
+        self.assertFalse(isdir(join(WS_DIR, '.dataworkspace/snapshot_lineage', pruned.hashval)))
+        # all the snapshots were taken on the same day, so only the last is kept
+        self._run_dws(['prune', '--keep-daily'])
+        self.assertEqual([snapshots[0].hashval], [md.hashval for md in self._list_snapshots()])
+        self.assertTrue(isdir(join(RESULTS_DIR, snapshots[0].relative_destination_path)))
+        self.assertFalse(isdir(join(RESULTS_DIR, snapshots[3].relative_destination_path)))
+        self._run_git(['diff', '--exit-code', '--quiet', 'HEAD'])
+
 if __name__ == '__main__':
     if len(sys.argv)>1 and sys.argv[1]=='--keep-outputs':
         KEEP_OUTPUTS=True
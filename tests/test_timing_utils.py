@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Test the recording of phase timings
+"""
+import os.path
+import unittest
+import sys
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+TEMPDIR=os.path.abspath(os.path.expanduser(__file__)).replace('.py', '_data')
+
+try:
+    import dataworkspaces
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+
+from dataworkspaces.utils import timing_utils
+from dataworkspaces.utils.timing_utils import recording, timed_phase, count, \
+    propagate_phases, FILES_VISITED, BYTES_READ, SUBPROCESSES
+from dataworkspaces.utils.subprocess_utils import call_subprocess, call_subprocess_for_rc, \
+    run_subprocess
+
+
+class TestTimingUtils(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+        os.mkdir(TEMPDIR)
+
+    def tearDown(self):
+        if os.path.exists(TEMPDIR):
+            shutil.rmtree(TEMPDIR)
+
+    def test_not_recording(self):
+        with recording('test', enabled=False) as recorder:
+            self.assertIsNone(recorder)
+            with timed_phase('phase'):
+                count(FILES_VISITED, 10)
+        self.assertIsNone(timing_utils._recorder)
+
+    def test_nested_phases(self):
+        with recording('test') as recorder:
+            assert recorder is not None
+            with timed_phase('outer'):
+                count(FILES_VISITED, 2)
+                with timed_phase('inner', 'rsrc'):
+                    count(BYTES_READ, 100)
+                    call_subprocess(['true'], cwd=TEMPDIR)
+            count(FILES_VISITED, 1)
+        self.assertIsNone(timing_utils._recorder)
+        self.assertEqual([('test', None, 0), ('outer', None, 1), ('inner', 'rsrc', 2)],
+                         [(p.name, p.resource, p.depth) for p in recorder.phases])
+        self.assertEqual([{FILES_VISITED:3, BYTES_READ:100, SUBPROCESSES:1},
+                          {FILES_VISITED:2, BYTES_READ:100, SUBPROCESSES:1},
+                          {FILES_VISITED:0, BYTES_READ:100, SUBPROCESSES:1}],
+                         [p.counts for p in recorder.phases])
+        for p in recorder.phases:
+            self.assertGreaterEqual(p.wall_time, 0.0)
+        self.assertIn('  inner [rsrc]', recorder.format_report())
+        log_path = join(TEMPDIR, 'timings.jsonl')
+        recorder.append_to_log(log_path, snapshot='abcd')
+        recorder.append_to_log(log_path, snapshot='efgh')
+        with open(log_path, 'r') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(['abcd', 'efgh'], [data['snapshot'] for data in lines])
+        self.assertEqual('test', lines[0]['command'])
+        self.assertEqual(100, lines[0]['phases'][2][BYTES_READ])
+
+    def test_subprocess_counts(self):
+        with recording('test') as recorder:
+            assert recorder is not None
+            call_subprocess_for_rc(['true'], cwd=TEMPDIR)
+            run_subprocess(['true'], TEMPDIR)
+            run_subprocess('true | true', TEMPDIR, num_processes=2, shell=True)
+        self.assertEqual(4, recorder.phases[0].counts[SUBPROCESSES])
+
+    def test_threads(self):
+        """Counts from a thread pool go to the phases of the submitting thread,
+        but only if propagated."""
+        def work(n):
+            with timed_phase('work', str(n)):
+                count(BYTES_READ, n)
+        with recording('test') as recorder:
+            assert recorder is not None
+            with timed_phase('pool'):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    list(executor.map(propagate_phases(work), [1, 2, 3]))
+                    list(executor.map(work, [100]))
+        pool = recorder.phases[1]
+        self.assertEqual('pool', pool.name)
+        self.assertEqual(6, pool.counts[BYTES_READ])
+        work_phases = sorted([p for p in recorder.phases if p.name == 'work' and p.depth == 2],
+                             key=lambda p: p.resource)
+        self.assertEqual([1, 2, 3], [p.counts[BYTES_READ] for p in work_phases])
+
+
+if __name__ == '__main__':
+    unittest.main()